@@ -0,0 +1,615 @@
+import os
+import gc
+import sys
+import json
+import math
+import time
+import random
+import platform
+import argparse
+import datetime
+import itertools
+
+from interface.backend import BACKEND_ENV
+from interface.backend import BACKEND_SIM
+
+# Every device is simulated, results do not depend on the board
+os.environ[ BACKEND_ENV ] = BACKEND_SIM
+
+from interface import sim
+from interface import SPI
+from interface import GPIO
+from interface import Display
+from interface import Reactor
+from interface import AT42QT1085
+from interface import AlarmRule
+from interface import AlarmEngine
+from interface.i2c import get_bus
+from interface.clock import monotonic
+from interface.crc24 import crc24
+from interface.alarm import EVERYDAY
+
+
+KPD_SPI_BUS = 32766
+KPD_SPI_CLIENT = 0
+KPD_CHANGE_GPIO = 83
+
+KEY_SNOOZE = 2
+
+# No settle time, the simulated keypad is always ready
+TIMING_NONE = {
+    'read' : 0,
+    'write' : 0,
+    'reset' : 0.020,
+    'reset_poll' : 0.001,
+}
+
+# Time difference allowed before a benchmark is reported as a regression
+DEF_THRESHOLD = 0.10
+
+RESULTS_VERSION = 1
+
+
+
+#=========================================================================================
+class NullSPIDevice:
+
+    # Accepts every ioctl, measures the host side of a transfer only
+
+    #----------------------------------------------------------------------------
+    def __init__( self ):
+        self.ioctls = 0
+
+
+    #----------------------------------------------------------------------------
+    def close( self ):
+        pass
+
+
+    #----------------------------------------------------------------------------
+    def ioctl( self, request, arg, mutate = True ):
+
+        self.ioctls += 1
+        return 0
+
+
+    #----------------------------------------------------------------------------
+    def get_stats( self ):
+        return { "ioctls": self.ioctls }
+
+
+
+#----------------------------------------------------------------------------
+# Statistics
+#----------------------------------------------------------------------------
+def median( values ):
+
+    values = sorted( values )
+    middle = len( values ) / 2
+
+    if len( values ) % 2:
+        return values[ middle ]
+
+    return ( values[ middle - 1 ] + values[ middle ] ) / 2.0
+
+
+#----------------------------------------------------------------------------
+def summarize( samples ):
+
+    mean = sum( samples ) / len( samples )
+
+    if len( samples ) > 1:
+        stdev = math.sqrt( sum([ ( s - mean ) ** 2 for s in samples ]) / ( len( samples ) - 1 ))
+    else:
+        stdev = 0.0
+
+    return {
+        "min": min( samples ),
+        "median": median( samples ),
+        "mean": mean,
+        "stdev": stdev,
+        "max": max( samples ),
+    }
+
+
+#----------------------------------------------------------------------------
+def counter_delta( before, after, ops ):
+
+    return dict([ ( name, ( after[ name ] - before[ name ] ) / float( ops ))
+                  for name in after ])
+
+
+
+#=========================================================================================
+class Runner:
+
+    #----------------------------------------------------------------------------
+    def __init__( self, repeat = 7, scale = 1.0, pattern = None ):
+
+        self.repeat = repeat
+        self.scale = scale
+        self.pattern = pattern
+        self.results = {}
+
+
+    #----------------------------------------------------------------------------
+    def selected( self, name ):
+        return self.pattern is None or self.pattern in name
+
+
+    #----------------------------------------------------------------------------
+    def bench( self, name, func, number, counters = None, setup = None ):
+
+        # func() is timed number times per sample, counters() returns cumulative
+        # syscall and bus counts, reported per call.
+        if not self.selected( name ):
+            return
+
+        number = max( 1, int( round( number * self.scale )))
+
+        samples = []
+        totals = None
+
+        enabled = gc.isenabled()
+        gc.disable()
+
+        try:
+            for sample in range( self.repeat ):
+                if setup is not None:
+                    setup()
+
+                before = counters() if counters is not None else None
+                start = monotonic()
+
+                for i in xrange( number ):
+                    func()
+
+                elapsed = monotonic() - start
+                samples.append( elapsed * 1e6 / number )
+
+                if counters is not None:
+                    totals = counter_delta( before, counters(), number )
+
+        finally:
+            if enabled:
+                gc.enable()
+
+        self.add( name, samples, number, totals )
+
+
+    #----------------------------------------------------------------------------
+    def add( self, name, samples, number, counters = None ):
+
+        result = summarize( samples )
+        result[ "unit" ] = "us"
+        result[ "number" ] = number
+        result[ "counters" ] = counters or {}
+
+        self.results[ name ] = result
+
+        sys.stderr.write( "%-36s %10.2f us  +- %6.2f" % ( name, result[ "median" ], result[ "stdev" ] ))
+
+        for key in sorted( result[ "counters" ] ):
+            sys.stderr.write( "  %s=%g" % ( key, result[ "counters" ][ key ] ))
+
+        sys.stderr.write( "\n" )
+
+
+
+#----------------------------------------------------------------------------
+# Devices
+#----------------------------------------------------------------------------
+def keypad_counters( device ):
+
+    def counters():
+        stats = device.get_stats()
+        return { "spi_ioctls": stats[ "ioctls" ], "spi_bytes": stats[ "bytes" ] }
+
+    return counters
+
+
+#----------------------------------------------------------------------------
+def display_counters( bus ):
+
+    device = bus.device
+
+    def counters():
+        stats = device.get_stats()
+        return { "i2c_ioctls": stats[ "ioctls" ], "i2c_messages": stats[ "messages" ],
+                 "i2c_bytes": stats[ "bytes" ] }
+
+    return counters
+
+
+#----------------------------------------------------------------------------
+def open_keypad( client = KPD_SPI_CLIENT, change = None ):
+
+    keypad = AT42QT1085( KPD_SPI_BUS, client, timing = TIMING_NONE, change = change )
+
+    key_config = [ keypad.gen_config_key() ] * 7 + [ keypad.gen_config_key( enabled = False ) ]
+    keypad.write_config_object( AT42QT1085.OBJ_TYPE_KEY, key_config )
+
+    # Drain the reset status
+    list( keypad.messages() )
+
+    return keypad
+
+
+
+#----------------------------------------------------------------------------
+# Benchmarks
+#----------------------------------------------------------------------------
+def bench_spi( runner ):
+
+    device = NullSPIDevice()
+    spi = SPI( KPD_SPI_BUS, 99, SPI.SPI_MODE_3, 550000, device = device )
+
+    counters = lambda: { "spi_ioctls": device.ioctls }
+
+    ## Object read : address, length and data, each byte in its own transfer ##
+    block = bytearray( 3 + 8 )
+    runner.bench( "spi.frame.byte_delay", lambda: spi.transfer_byte_delay( block, 0.02 ),
+                  20000, counters )
+
+    ## Message burst, descriptors come from the segment cache ##
+    data = bytearray( 4 * 8 )
+    segments = ( [( 1, 20, False )] * 7 + [( 1, 2000, True )] ) * 4
+    runner.bench( "spi.frame.segments", lambda: spi.transfer_segments( data, segments ),
+                  20000, counters )
+
+    runner.bench( "spi.frame.single", lambda: spi.transfer( block ), 20000, counters )
+
+
+#----------------------------------------------------------------------------
+def bench_crc24( runner ):
+
+    random.seed( 24 )
+
+    info = bytearray([ random.randrange( 256 ) for i in range( 7 + 6 * 6 ) ])
+    runner.bench( "crc24.info_block", lambda: crc24( info ), 20000 )
+
+    block = bytearray([ random.randrange( 256 ) for i in range( 1024 ) ])
+    runner.bench( "crc24.1k", lambda: crc24( block ), 2000 )
+
+
+#----------------------------------------------------------------------------
+def gen_rules( nrules, today ):
+
+    # 60% weekly, 30% on dates within a year, 10% one time
+    rules = []
+
+    for i in xrange( nrules ):
+        kind = random.random()
+
+        if kind < 0.6:
+            rule = AlarmRule( i, random.randrange( 24 ), random.randrange( 60 ),
+                              days = random.randrange( 1, EVERYDAY + 1 ))
+        elif kind < 0.9:
+            dates = [ today + datetime.timedelta( random.randrange( 365 )) for n in range( 4 ) ]
+            rule = AlarmRule( i, random.randrange( 24 ), random.randrange( 60 ), dates = dates )
+        else:
+            rule = AlarmRule( i, random.randrange( 24 ), random.randrange( 60 ))
+
+        rules.append( rule )
+
+    return rules
+
+
+#----------------------------------------------------------------------------
+def bench_alarm( runner ):
+
+    now = time.time()
+    today = datetime.date.fromtimestamp( now )
+
+    for nrules in ( 1000, 20000 ):
+        random.seed( nrules )
+
+        rules = gen_rules( nrules, today )
+        prefix = "alarm.%d." % ( nrules )
+
+        state = { "engine": None }
+
+        def fill():
+            state[ "engine" ] = AlarmEngine()
+
+            for rule in rules:
+                rule.enabled = True
+                rule.skip_date = None
+                rule.snooze_until = None
+
+                state[ "engine" ].add( rule, now )
+
+        runner.bench( prefix + "add_all", fill, 1 )
+
+        fill()
+        engine = state[ "engine" ]
+
+        runner.bench( prefix + "next_due", engine.next_due, 10000 )
+
+        ids = itertools.cycle( random.sample( xrange( nrules ), 100 ))
+        runner.bench( prefix + "skip_next", lambda: engine.skip_next( next( ids ), now ), 100 )
+
+        runner.bench( prefix + "recompute", lambda: engine.recompute( now ), 5 )
+
+
+        ## Naive scan of every rule, once per tick ##
+        runner.bench( prefix + "scan_all", lambda: min(
+            [ when for when in ( rule.next_time( now ) for rule in rules ) if when is not None ] ), 3 )
+
+
+        ## A simulated day, a minute at a time ##
+        def one_day():
+            for minute in xrange( 24 * 60 ):
+                state[ "engine" ].pop_due( now + minute * 60 )
+
+        runner.bench( prefix + "pop_due.one_day", one_day, 1, setup = fill )
+
+
+#----------------------------------------------------------------------------
+def bench_keypad( runner ):
+
+    keypad = open_keypad()
+    device = sim.get_spi_device( KPD_SPI_BUS, KPD_SPI_CLIENT )
+    counters = keypad_counters( device )
+
+    runner.bench( "at42qt1085.read_object_table", lambda: keypad.read_object_table( False ),
+                  200, counters )
+
+
+    ## Message throughput, the queue is refilled before each sample ##
+    count = max( 1, int( 200 * runner.scale ))
+
+    def fill():
+        for i in range( count ):
+            device.push_message( AT42QT1085.OBJ_TYPE_KEY, i % 7, [ i & 0x01 ] )
+
+    runner.bench( "at42qt1085.read_next_message", keypad.read_next_message,
+                  count / runner.scale, counters, setup = fill )
+
+    # The queue is emptied in bursts of drain_batch messages
+    def drain():
+        fill()
+
+        start = monotonic()
+        messages = keypad.read_messages()
+
+        return ( monotonic() - start, len( messages ))
+
+    if runner.selected( "at42qt1085.read_messages" ):
+        samples = []
+
+        for sample in range( runner.repeat ):
+            before = counters()
+            elapsed, read = drain()
+
+            samples.append( elapsed * 1e6 / read )
+            totals = counter_delta( before, counters(), read )
+
+        runner.add( "at42qt1085.read_messages", samples, count, totals )
+
+
+#----------------------------------------------------------------------------
+def bench_display( runner ):
+
+    disp = Display( 0 )
+    counters = display_counters( get_bus( 0 ))
+
+    texts = iter( [ "1234", "5678" ] * 1000000 )
+    runner.bench( "display.set_display", lambda: disp.set_display( next( texts )),
+                  2000, counters )
+
+
+    ## Consecutive minutes, served by the minute table ##
+    start = time.mktime(( 2024, 1, 1, 0, 0, 0, 0, 0, -1 ))
+    minutes = [ time.localtime( start + m * 60 ) for m in range( 24 * 60 ) ]
+
+    state = { "index": 0 }
+
+    def next_minute():
+        state[ "index" ] += 1
+        disp.print_time( minutes[ state[ "index" ] % len( minutes ) ] )
+
+    disp.print_time( minutes[0] )
+    runner.bench( "display.print_time.next_minute", next_minute, 2000, counters )
+
+
+    ## Time set, every call jumps to an unrelated minute ##
+    random.seed( 60 )
+    jumps = iter( [ random.choice( minutes ) for i in range( 4096 ) ] * 1000 )
+
+    runner.bench( "display.print_time.jump", lambda: disp.print_time( next( jumps )),
+                  2000, counters )
+
+
+#----------------------------------------------------------------------------
+def bench_key_latency( runner ):
+
+    if not runner.selected( "key.edge_to_commit" ):
+        return
+
+    change = sim.open_gpio( KPD_CHANGE_GPIO, GPIO.PIN_INPUT )
+    change.set_edge( GPIO.EDGE_FALLING )
+
+    device = sim.get_spi_device( KPD_SPI_BUS, KPD_SPI_CLIENT )
+    device.attach_change( KPD_CHANGE_GPIO )
+
+    keypad = open_keypad( change = change )
+    disp = Display( 0 )
+
+    spi_counters = keypad_counters( device )
+    i2c_counters = display_counters( get_bus( 0 ))
+
+    counters = lambda: dict( spi_counters().items() + i2c_counters().items() )
+
+
+    ## Same path as the application : reactor, CHANGE edge, messages, display ##
+    state = { "edge": None, "latency": None, "count": 0 }
+
+    def handle_keypad():
+        events = change.read_events()
+
+        if events:
+            state[ "edge" ] = events[ -1 ].timestamp_ns / 1e9
+
+        for msg in keypad.messages():
+            if msg.type == AT42QT1085.OBJ_TYPE_KEY and msg.data[0]:
+                state[ "count" ] += 1
+                disp.set_display( "%4d" % ( state[ "count" ] % 10000 ))
+
+                state[ "latency" ] = monotonic() - state[ "edge" ]
+
+    reactor = Reactor()
+    reactor.add_gpio( change, handle_keypad )
+
+    samples = []
+    totals = {}
+    number = max( 1, int( 200 * runner.scale ))
+
+    for sample in range( runner.repeat ):
+        latencies = []
+        before = counters()
+
+        for i in range( number ):
+            state[ "latency" ] = None
+            device.set_key( KEY_SNOOZE, True )
+
+            deadline = monotonic() + 1.0
+
+            while state[ "latency" ] is None:
+                if monotonic() > deadline:
+                    raise RuntimeError( "No display update after the key press" )
+
+                reactor.run_once( 100 )
+
+            latencies.append( state[ "latency" ] )
+
+            # Release, not part of the measure
+            after = counters()
+            device.set_key( KEY_SNOOZE, False )
+            reactor.run_once( 100 )
+
+            for name, value in counter_delta( after, counters(), 1 ).items():
+                before[ name ] += value
+
+        samples.append( median( latencies ) * 1e6 )
+        totals = counter_delta( before, counters(), number )
+
+    reactor.remove( change )
+    reactor.close()
+    change.close()
+
+    runner.add( "key.edge_to_commit", samples, number, totals )
+
+
+
+BENCHMARKS = (
+    bench_spi,
+    bench_crc24,
+    bench_alarm,
+    bench_keypad,
+    bench_display,
+    bench_key_latency,
+)
+
+
+
+#----------------------------------------------------------------------------
+# Baseline comparison
+#----------------------------------------------------------------------------
+def compare( results, baseline, threshold, selected = lambda name: True ):
+
+    # Times regress past the threshold, syscall and bus counts are exact and
+    # regress on any increase.
+    regressions = []
+
+    for name in sorted( results ):
+        current = results[ name ]
+        base = baseline.get( name )
+
+        if base is None:
+            sys.stderr.write( "%-36s new\n" % ( name ))
+            continue
+
+        ratio = current[ "median" ] / base[ "median" ] if base[ "median" ] else 1.0
+        flags = []
+
+        if ratio > 1.0 + threshold:
+            flags.append( "time %+.1f%%" % (( ratio - 1.0 ) * 100 ))
+
+        for key, value in sorted( current[ "counters" ].items() ):
+            old = base.get( "counters", {} ).get( key )
+
+            if old is not None and value > old + 1e-9:
+                flags.append( "%s %g -> %g" % ( key, old, value ))
+
+        if flags:
+            regressions.append(( name, flags ))
+
+        sys.stderr.write( "%-36s %+7.1f%%  %s\n" % ( name, ( ratio - 1.0 ) * 100,
+                                                   "REGRESSION " + ", ".join( flags ) if flags else "ok" ))
+
+    for name in sorted( set( baseline ) - set( results )):
+        if selected( name ):
+            sys.stderr.write( "%-36s missing\n" % ( name ))
+
+    return regressions
+
+
+
+#----------------------------------------------------------------------------
+def main():
+
+    parser = argparse.ArgumentParser( description = "Bus, display and keypad benchmarks "
+                                                    "on the simulated devices" )
+    parser.add_argument( "-o", "--output", help = "write the results to this JSON file" )
+    parser.add_argument( "-r", "--repeat", type = int, default = 7, help = "samples per benchmark" )
+    parser.add_argument( "-s", "--scale", type = float, default = 1.0,
+                         help = "multiplier of the calls per sample" )
+    parser.add_argument( "-k", "--filter", help = "only run benchmarks whose name contains this" )
+    parser.add_argument( "--compare", metavar = "BASELINE", help = "JSON results to compare against" )
+    parser.add_argument( "--threshold", type = float, default = DEF_THRESHOLD,
+                         help = "relative slow down reported as a regression (default %(default)s)" )
+
+    args = parser.parse_args()
+
+    runner = Runner( args.repeat, args.scale, args.filter )
+
+    for benchmark in BENCHMARKS:
+        benchmark( runner )
+
+    output = {
+        "version": RESULTS_VERSION,
+        "created": time.strftime( "%Y-%m-%dT%H:%M:%S" ),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "repeat": args.repeat,
+        "benchmarks": runner.results,
+    }
+
+    if args.output:
+        with open( args.output, "w" ) as f:
+            json.dump( output, f, indent = 2, sort_keys = True )
+    else:
+        json.dump( output, sys.stdout, indent = 2, sort_keys = True )
+        sys.stdout.write( "\n" )
+
+
+    if args.compare:
+        with open( args.compare, "r" ) as f:
+            baseline = json.load( f )
+
+        if baseline.get( "version" ) != RESULTS_VERSION:
+            sys.stderr.write( "Baseline format %r is not supported\n" % ( baseline.get( "version" )))
+            return 2
+
+        sys.stderr.write( "\nCompared with %s\n" % ( args.compare ))
+
+        if compare( runner.results, baseline[ "benchmarks" ], args.threshold, runner.selected ):
+            return 1
+
+    return 0
+
+
+
+if __name__ == "__main__":
+    sys.exit( main() )
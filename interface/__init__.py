@@ -1,5 +1,11 @@
 from gpio import GPIO
+from gpio import open_gpio
+from gpiochip import GPIOLine
+from gpiochip import GPIOChipDevice
+from gpiochip import FakeGPIOChip
 from spi import SPI
+from i2c import I2CBus
+from scheduler import BusScheduler
 
 from pca9634 import PCA9634
 from pca9634 import Digit
@@ -7,4 +13,15 @@ from pca9634 import Digit
 from display import Display
 
 from at42qt1085 import AT42QT1085
+from at42qt1085 import Message
 
+from crc24 import CRC24
+
+from reactor import Reactor
+from timerfd import TimerFD
+
+from alarm import AlarmEngine
+from alarm import AlarmRule
+
+from sim import AT42QT1085Sim
+from sim import I2CBusSim
@@ -0,0 +1,438 @@
+import time
+import heapq
+import errno
+import datetime
+
+from timerfd import TimerFD
+from timerfd import CLOCK_REALTIME
+from timerfd import TFD_TIMER_ABSTIME
+from timerfd import TFD_TIMER_CANCEL_ON_SET
+
+
+#----------------------------------------------------------------------------
+# Weekdays, bit n is tm_wday n (monday = 0)
+#----------------------------------------------------------------------------
+MONDAY      = 0x01
+TUESDAY     = 0x02
+WEDNESDAY   = 0x04
+THURSDAY    = 0x08
+FRIDAY      = 0x10
+SATURDAY    = 0x20
+SUNDAY      = 0x40
+
+WORKDAYS    = MONDAY | TUESDAY | WEDNESDAY | THURSDAY | FRIDAY
+WEEKEND     = SATURDAY | SUNDAY
+EVERYDAY    = WORKDAYS | WEEKEND
+
+SNOOZE_TIME = 9 * 60
+
+
+#=========================================================================================
+class LocalDays:
+
+    # Local dates and midnights, valid until the timezone changes
+
+    #----------------------------------------------------------------------------
+    def __init__( self ):
+
+        self.starts = {}
+
+        self.last_time = None
+        self.last_date = None
+
+
+    #----------------------------------------------------------------------------
+    def date( self, when ):
+
+        if when != self.last_time:
+            self.last_date = datetime.date.fromtimestamp( when )
+            self.last_time = when
+
+        return self.last_date
+
+
+    #----------------------------------------------------------------------------
+    def start( self, date ):
+
+        # Local midnight of a day without an offset change, None otherwise
+        try:
+            return self.starts[ date ]
+        except KeyError:
+            pass
+
+        start = time.mktime(( date.year, date.month, date.day, 0, 0, 0, 0, 0, -1 ))
+        end = time.mktime(( date.year, date.month, date.day, 23, 59, 0, 0, 0, -1 ))
+
+        if end - start != 23 * 3600 + 59 * 60:
+            start = None
+
+        self.starts[ date ] = start
+
+        return start
+
+
+
+#=========================================================================================
+class AlarmRule:
+
+    #----------------------------------------------------------------------------
+    def __init__( self, id, hour, minute, days = 0, dates = None, enabled = True,
+                  label = "" ):
+
+        self.id = id
+        self.hour = hour
+        self.minute = minute
+
+        # Repeats on the weekdays in the mask and on the listed dates, rings once
+        # at the next hour:minute when neither is given.
+        self.days = days
+        self.dates = sorted( dates or [] )
+
+        self.enabled = enabled
+        self.label = label
+
+        # Day of the occurrence to skip, set by skip_next()
+        self.skip_date = None
+
+        # Snoozed until, overrides the next occurrence
+        self.snooze_until = None
+
+
+    #----------------------------------------------------------------------------
+    def __repr__( self ):
+        return "AlarmRule(%r, %02d:%02d)" % ( self.id, self.hour, self.minute )
+
+
+    #----------------------------------------------------------------------------
+    def at( self, date, local = None ):
+
+        if local is not None:
+            start = local.start( date )
+
+            if start is not None:
+                return start + self.hour * 3600 + self.minute * 60
+
+        # Local time, mktime picks the UTC offset in effect at that time
+        return time.mktime(( date.year, date.month, date.day,
+                             self.hour, self.minute, 0, 0, 0, -1 ))
+
+
+    #----------------------------------------------------------------------------
+    def occurrence( self, after, local = None ):
+
+        if local is not None:
+            today = local.date( after )
+        else:
+            today = datetime.date.fromtimestamp( after )
+        best = None
+
+        ## Weekly, or once ##
+        if self.days or not self.dates:
+            for offset in range( 8 ):
+                date = today + datetime.timedelta( offset )
+
+                if self.days and not ( self.days >> date.weekday() ) & 0x01:
+                    continue
+
+                when = self.at( date, local )
+
+                if when > after:
+                    best = when
+                    break
+
+
+        ## Specific dates ##
+        for date in self.dates:
+            if date < today:
+                continue
+
+            when = self.at( date, local )
+
+            if when > after:
+                if best is None or when < best:
+                    best = when
+                break
+
+        return best
+
+
+    #----------------------------------------------------------------------------
+    def next_time( self, after, local = None ):
+
+        # A one time alarm is disabled once it fired, its snooze still rings
+        if self.snooze_until is not None:
+            return self.snooze_until
+
+        if not self.enabled:
+            return None
+
+        when = self.occurrence( after, local )
+
+        if ( self.skip_date is not None and when is not None and 
+             datetime.date.fromtimestamp( when ) == self.skip_date ):
+            when = self.occurrence( when, local )
+
+        return when
+
+
+    #----------------------------------------------------------------------------
+    def is_once( self ):
+        return not self.days and not self.dates
+
+
+    #----------------------------------------------------------------------------
+    def skip_next( self, now = None ):
+
+        if now is None:
+            now = time.time()
+
+        when = self.occurrence( now )
+
+        if when is not None:
+            self.skip_date = datetime.date.fromtimestamp( when )
+
+
+
+#=========================================================================================
+class AlarmEngine:
+
+    #----------------------------------------------------------------------------
+    def __init__( self, snooze_time = SNOOZE_TIME ):
+
+        self.rules = {}
+        self.snooze_time = snooze_time
+
+        # Heap of ( time, seq, rule id ), entries whose seq no longer matches the
+        # rule's current one are stale and skipped.
+        self.heap = []
+        self.seq = 0
+        self.current = {}
+
+        self.timer = None
+        self.callback = None
+
+        self.tz_state = self.get_tz_state()
+
+        self.local = LocalDays()
+
+
+    #----------------------------------------------------------------------------
+    def get_tz_state( self ):
+        return ( time.timezone, time.altzone, time.daylight, time.tzname )
+
+
+    #----------------------------------------------------------------------------
+    def schedule( self, rule, now ):
+
+        self.seq += 1
+        when = rule.next_time( now, self.local )
+
+        if when is None:
+            self.current.pop( rule.id, None )
+            return
+
+        self.current[ rule.id ] = self.seq
+        heapq.heappush( self.heap, ( when, self.seq, rule.id ))
+
+        # Drop the stale entries once they outnumber the live ones
+        if len( self.heap ) > 2 * len( self.current ) + 64:
+            self.heap = [ entry for entry in self.heap if self.current.get( entry[2] ) == entry[1] ]
+            heapq.heapify( self.heap )
+
+
+    #----------------------------------------------------------------------------
+    def add( self, rule, now = None ):
+
+        if now is None:
+            now = time.time()
+
+        self.rules[ rule.id ] = rule
+
+        self.schedule( rule, now )
+        self.rearm()
+
+
+    #----------------------------------------------------------------------------
+    def update( self, rule, now = None ):
+        self.add( rule, now )
+
+
+    #----------------------------------------------------------------------------
+    def remove( self, rule_id ):
+
+        self.rules.pop( rule_id, None )
+        self.current.pop( rule_id, None )
+
+        self.rearm()
+
+
+    #----------------------------------------------------------------------------
+    def recompute( self, now = None ):
+
+        # Local times moved (timezone or DST rules changed), rebuild in O(n)
+        if now is None:
+            now = time.time()
+
+        self.heap = []
+        self.current = {}
+        self.local = LocalDays()
+
+        for rule in self.rules.values():
+            when = rule.next_time( now, self.local )
+
+            if when is not None:
+                self.seq += 1
+                self.current[ rule.id ] = self.seq
+                self.heap.append(( when, self.seq, rule.id ))
+
+        heapq.heapify( self.heap )
+
+        self.tz_state = self.get_tz_state()
+        self.rearm()
+
+
+    #----------------------------------------------------------------------------
+    def check_timezone( self ):
+
+        if self.get_tz_state() != self.tz_state:
+            self.recompute()
+
+
+    #----------------------------------------------------------------------------
+    def next_due( self ):
+
+        heap = self.heap
+
+        while heap:
+            when, seq, rule_id = heap[0]
+
+            if self.current.get( rule_id ) == seq:
+                return ( when, self.rules[ rule_id ] )
+
+            heapq.heappop( heap )
+
+        return None
+
+
+    #----------------------------------------------------------------------------
+    def pop_due( self, now = None ):
+
+        if now is None:
+            now = time.time()
+
+        fired = []
+
+        while True:
+            due = self.next_due()
+
+            if due is None or due[0] > now:
+                break
+
+            when, rule = due
+            heapq.heappop( self.heap )
+
+            fired.append( rule )
+
+
+            ## Reschedule from the firing time ##
+            rule.snooze_until = None
+            rule.skip_date = None
+
+            if rule.is_once():
+                rule.enabled = False
+
+            self.schedule( rule, max( when, now ))
+
+        return fired
+
+
+    #----------------------------------------------------------------------------
+    def snooze( self, rule_id, now = None ):
+
+        if now is None:
+            now = time.time()
+
+        rule = self.rules[ rule_id ]
+        rule.snooze_until = now + self.snooze_time
+
+        self.schedule( rule, now )
+
+        self.rearm()
+
+
+    #----------------------------------------------------------------------------
+    def dismiss( self, rule_id, now = None ):
+
+        if now is None:
+            now = time.time()
+
+        rule = self.rules[ rule_id ]
+        rule.snooze_until = None
+
+        self.schedule( rule, now )
+        self.rearm()
+
+
+    #----------------------------------------------------------------------------
+    def skip_next( self, rule_id, now = None ):
+
+        if now is None:
+            now = time.time()
+
+        rule = self.rules[ rule_id ]
+        rule.skip_next( now )
+
+        self.schedule( rule, now )
+        self.rearm()
+
+
+    #----------------------------------------------------------------------------
+    def attach( self, reactor, callback ):
+
+        # Sleeps on a timerfd until the next alarm is due, callback( rule ) is
+        # called for each alarm going off.
+        self.callback = callback
+        self.timer = TimerFD( CLOCK_REALTIME )
+
+        reactor.add_reader( self.timer, self.expired )
+
+        self.rearm()
+
+
+    #----------------------------------------------------------------------------
+    def detach( self, reactor ):
+
+        if self.timer is not None:
+            reactor.remove_timer( self.timer )
+            self.timer = None
+
+
+    #----------------------------------------------------------------------------
+    def rearm( self ):
+
+        if self.timer is None:
+            return
+
+        due = self.next_due()
+
+        if due is None:
+            self.timer.disarm()
+        else:
+            self.timer.set( due[0], 0, TFD_TIMER_ABSTIME | TFD_TIMER_CANCEL_ON_SET )
+
+
+    #----------------------------------------------------------------------------
+    def expired( self ):
+
+        try:
+            self.timer.read()
+
+        except OSError as e:
+            # The clock was set, alarms now in the past go off right away
+            if e.errno != errno.ECANCELED:
+                raise
+
+        for rule in self.pop_due():
+            self.callback( rule )
+
+        self.rearm()
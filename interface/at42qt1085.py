@@ -1,15 +1,30 @@
+import os
+import json
 import time
+from array import array
+from collections import namedtuple
 
 from spi import SPI
 from timeit import timeit
 from gpio import GPIO
+from clock import monotonic
+from crc24 import CRC24
+
+import metrics
+
+
+
+#=========================================================================================
+class Message( namedtuple( "Message", "type inst data" )):
+    __slots__ = ()
 
 
 
 #=========================================================================================
 class AT42QT1085:
     obj_table = {}
-    report_id = []
+    report_type = array( 'B' )
+    report_inst = array( 'B' )
 
 
     #-----------------------------
@@ -30,6 +45,9 @@ class AT42QT1085:
     COMMAND_CALIBRATE = 2
     COMMAND_REPORT = 3
     
+    # T6 status, first byte of the command processor messages
+    STATUS_RESET = 0x80
+    
 
     #-----------------------------
     # T13 : Key config
@@ -95,16 +113,69 @@ class AT42QT1085:
     HAPTIC_SOURCE_GPIO = 4
     
     
+    # Objects that must always be accessed on the device
+    VOLATILE_OBJECTS = ( OBJ_TYPE_MESSAGE, OBJ_TYPE_COMMAND )
+    
+    # Address and length bytes sent before the data of each frame
+    FRAME_HEADER_SIZE = 3
+    
+    
+    #-----------------------------
+    # Timing profile (seconds)
+    #-----------------------------
+    TIMING_DEFAULT = {
+        'read' : 0.002,         # Settle time after a block read
+        'write' : 0.010,        # Settle time after a block write
+        'reset' : 0.065,        # Worst case reset time
+        'reset_poll' : 0.005,   # Interval between ready probes after a reset
+    }
+    
     
     
     
     
     #----------------------------------------------------------------------------
-    def __init__( self, bus, client):
+    def __init__( self, bus, client, timing = None, shadow = False, cache_file = None,
+                  reset = True, change = None ):
+        
+        self.timing = dict( self.TIMING_DEFAULT )
+        if timing is not None:
+            self.timing.update( timing )
+        
+        self.busy_until = 0
+        
+        ## Host copy of the configuration objects ##
+        self.shadow = {} if shadow else None
+        
+        # A reset was sent, the report it causes is not an unexpected reset
+        self.reset_pending = False
+        
+        ## Object table cache, keyed by the information block header ##
+        self.cache_file = cache_file
+        
+        ## CHANGE line, asserted (low) while messages are pending ##
+        self.change = change
+        
+        # Largest number of messages read per burst when draining the message queue
+        self.drain_batch = 4
+        self.drain_frames = {}
+        
+        # Frames read per drain at most, more than the message queue holds. Ends
+        # the drain when the CHANGE line is stuck low (wiring fault, held in reset).
+        self.drain_limit = 32
+        self.drain_count = 0
         
         self.spi = SPI( bus, client, SPI.SPI_MODE_3, 550000 )
         
-        self.read_object_table()
+        name = "spidev%d.%d" % ( bus, client )
+        self.metric_read = metrics.histogram( "at42qt1085.read_messages", name )
+        self.metric_messages = metrics.counter( "at42qt1085.messages", name )
+        
+        # Gap between two bytes of a frame. It used to be provided by the
+        # overhead of sending each byte in its own ioctl.
+        self.byte_delay_ms = 0.02
+        
+        self.read_object_table( reset )
     
     
     #----------------------------------------------------------------------------
@@ -113,77 +184,164 @@ class AT42QT1085:
 
         
     #----------------------------------------------------------------------------
-    def read_object_table( self ):
+    def read_object_table( self, reset = True ):
         
         self.obj_table = {}
-        self.report_id = []
+        self.report_type = array( 'B' )
+        self.report_inst = array( 'B' )
         
-        info = self.read_block( 0x00, 0x00, 7 )
-
-        nobj = info[6]
-        info = self.read_block( 0x00, 0x00, 10 + ( nobj * 6 ))
+        self.invalidate_shadow()
+        self.drain_frames = {}
         
-        crc = info[ -1 ] << 16 | info[ -2 ] << 8 | info[ -3 ]
-        if not self.crc24( info[ :-3 ] ) == crc:
-            raise IOError( "Invalid checksum for information block" )
+        header = self.read_block( 0x00, 0x00, 7 )
         
+        if not self.load_object_table( header ):
+            
+            nobj = header[6]
+            info = self.read_block( 0x00, 0x00, 10 + ( nobj * 6 ))
+            
+            crc = info[ -1 ] << 16 | info[ -2 ] << 8 | info[ -3 ]
+            if not self.crc24( info[ :-3 ] ) == crc:
+                raise IOError( "Invalid checksum for information block" )
+            
+            self.parse_object_table( info[ 7:-3 ] )
+            self.save_object_table( header, info[ 7:-3 ], crc )
         
-        for i in range( nobj ):
+        
+        ## Send reset command ##
+        if reset:
+            self.send_command( self.COMMAND_RESET )
+            self.wait_reset( header[0] )
+    
+    
+    #----------------------------------------------------------------------------
+    def parse_object_table( self, table ):
+        
+        for i in range( len( table ) / 6 ):
             
-            start = 7 + ( i * 6 )
-            obj_type = info[ start ]
+            start = i * 6
+            obj_type = table[ start ]
             
-            ninst = info[ start + 4 ] + 1
-            nreports = info[ start + 5 ]
+            ninst = table[ start + 4 ] + 1
+            nreports = table[ start + 5 ]
             
             self.obj_table[obj_type] = {
-                'lsb' : info[ start + 1 ],
-                'msb' : info[ start + 2 ],
-                'size' : info[ start + 3 ] + 1,
+                'lsb' : table[ start + 1 ],
+                'msb' : table[ start + 2 ],
+                'size' : table[ start + 3 ] + 1,
                 'ninst' : ninst,
                 'nreports' : nreports
             }
             
+            ## Report ID lookup, indexed by report ID - 1 ##
             for n in range( nreports * ninst ):
-                self.report_id.append({
-                    'type' : obj_type,
-                    'inst' : n 
-                })
-
-        ## Send reset command ##
-        self.send_command( self.COMMAND_RESET )
-        time.sleep( 0.065 )
-
-
+                self.report_type.append( obj_type )
+                self.report_inst.append( n )
+    
+    
+    #----------------------------------------------------------------------------
+    def load_object_table( self, header ):
+        
+        if self.cache_file is None:
+            return False
+        
+        try:
+            with open( self.cache_file, "r" ) as f:
+                cache = json.load( f )
+            
+            if cache[ 'header' ] != list( header ):
+                return False
+            
+            table = bytearray( cache[ 'table' ] )
+            
+        except ( IOError, ValueError, KeyError, TypeError ):
+            return False
+        
+        
+        ## Validate the cache against the information block checksum ##
+        addr = 7 + len( table )
+        received = self.read_block( addr & 0xFF, addr >> 8, 3 )
+        
+        if ( received[2] << 16 | received[1] << 8 | received[0] ) != cache[ 'crc' ]:
+            return False
+        
+        self.parse_object_table( table )
+        
+        return True
+    
+    
     #----------------------------------------------------------------------------
-    def read_config_object( self, obj_type, instance = None ):
+    def save_object_table( self, header, table, crc ):
+        
+        if self.cache_file is None:
+            return
+        
+        cache = {
+            'header' : list( header ),
+            'table' : list( table ),
+            'crc' : crc
+        }
+        
+        try:
+            tmp = self.cache_file + ".tmp"
+            
+            with open( tmp, "w" ) as f:
+                json.dump( cache, f )
+            
+            os.rename( tmp, self.cache_file )
+            
+        except ( IOError, OSError ):
+            pass
+    
+    
+    #----------------------------------------------------------------------------
+    def read_config_object( self, obj_type, instance = None, refresh = False ):
         
         if not obj_type in self.obj_table:
             raise ValueError( "Object (T%d) does not exists." % ( obj_type ))
         
-        lsb = self.obj_table[ obj_type ][ 'lsb' ]
-        msb = self.obj_table[ obj_type ][ 'msb' ]
         size = self.obj_table[ obj_type ][ 'size' ]
         ninst = self.obj_table[ obj_type ][ 'ninst' ]
         
-        
         if instance is None:
-            block = self.read_block( lsb, msb, size * ninst )
-        
-            obj = []
-            for i in range( ninst ):
-                obj.append( block[ i * size : ( i * size ) + size ] )
+            first = 0
+            count = ninst
             
-            return obj
         else:
             
             if ( instance < 0 ) or ( instance > ninst - 1 ):
                 raise ValueError( "Invalid instance ID for this type of object (T%d@%d)" % ( obj_type, instance ))
             
-            lsb += ( instance * size )
-            msb += ( lsb & 0xFF00 ) >> 8 
+            first = instance
+            count = 1
+        
+        start = first * size
+        end = start + ( count * size )
+        
+        
+        ## Serve the read from the shadow if it holds the requested instances ##
+        shadow = self.get_shadow( obj_type )
+        
+        if shadow is not None and not refresh and all( shadow[ 'valid' ][ first : first + count ] ):
+            block = shadow[ 'image' ][ start : end ]
+            
+        else:
+            lsb, msb = self.object_address( obj_type, start )
+            block = self.read_block( lsb, msb, end - start )
+            
+            if shadow is not None:
+                shadow[ 'image' ][ start : end ] = block
+                shadow[ 'valid' ][ first : first + count ] = [ True ] * count
+        
+        
+        if instance is None:
+            obj = []
+            for i in range( ninst ):
+                obj.append( block[ i * size : ( i * size ) + size ] )
             
-            return self.read_block( lsb, msb, size )
+            return obj
+        else:
+            return block
     
     
     #----------------------------------------------------------------------------
@@ -192,25 +350,24 @@ class AT42QT1085:
         if not obj_type in self.obj_table:
             raise ValueError( "Object (T%d) does not exists." % ( obj_type ))
         
-        lsb = self.obj_table[ obj_type ][ 'lsb' ]
-        msb = self.obj_table[ obj_type ][ 'msb' ]
         size = self.obj_table[ obj_type ][ 'size' ]
         ninst = self.obj_table[ obj_type ][ 'ninst' ]        
         
+        data = bytearray()
+        
         if instance is None:
             
             if len( config ) != ninst:
                 raise ValueError( "Invalid number of blocks for object (T%d)" % ( obj_type ))
             
-            data = []
             for i in range( ninst ):
                 if len( config[ i ] ) != size:
                     raise ValueError( "Invalid block size for object (T%d@%d)" % ( obj_type, i ))
                 
                 data.extend( config[ i ] )
             
-            
-            return self.write_block( lsb, msb, data )
+            first = 0
+            count = ninst
         
         else:
             
@@ -220,38 +377,261 @@ class AT42QT1085:
             if len( config ) != size:
                 raise ValueError( "Invalid block size for object (T%d@%d)" % ( obj_type, instance ))
             
-            lsb += ( instance * size )
-            msb += ( lsb & 0xFF00 ) >> 8 
+            data.extend( config )
             
-            return self.write_block( lsb, msb, config )
-
-
+            first = instance
+            count = 1
+        
+        start = first * size
+        
+        
+        ## Only send the bytes that differs from the shadow ##
+        shadow = self.get_shadow( obj_type )
+        
+        if shadow is not None and all( shadow[ 'valid' ][ first : first + count ] ):
+            ranges = self.changed_ranges( shadow[ 'image' ][ start : start + len( data ) ], data )
+        else:
+            ranges = [( 0, len( data ))]
+        
+        result = True
+        for begin, end in ranges:
+            lsb, msb = self.object_address( obj_type, start + begin )
+            
+            if not self.write_block( lsb, msb, data[ begin : end ] ):
+                result = False
+        
+        if shadow is not None:
+            shadow[ 'image' ][ start : start + len( data ) ] = data
+            shadow[ 'valid' ][ first : first + count ] = [ result ] * count
+        
+        return result
+    
+    
+    #----------------------------------------------------------------------------
+    def object_address( self, obj_type, offset = 0 ):
+        
+        addr = ( self.obj_table[ obj_type ][ 'msb' ] << 8 ) | self.obj_table[ obj_type ][ 'lsb' ]
+        addr += offset
+        
+        return ( addr & 0xFF, addr >> 8 )
+    
+    
+    #----------------------------------------------------------------------------
+    def get_shadow( self, obj_type ):
+        
+        if self.shadow is None or obj_type in self.VOLATILE_OBJECTS:
+            return None
+        
+        if not obj_type in self.shadow:
+            size = self.obj_table[ obj_type ][ 'size' ]
+            ninst = self.obj_table[ obj_type ][ 'ninst' ]
+            
+            self.shadow[ obj_type ] = {
+                'image' : bytearray( size * ninst ),
+                'valid' : [ False ] * ninst
+            }
+        
+        return self.shadow[ obj_type ]
+    
+    
+    #----------------------------------------------------------------------------
+    def invalidate_shadow( self ):
+        
+        if self.shadow is not None:
+            self.shadow = {}
+    
+    
+    #----------------------------------------------------------------------------
+    def changed_ranges( self, old, new ):
+        
+        ranges = []
+        
+        for i in range( len( new )):
+            if old[ i ] == new[ i ]:
+                continue
+            
+            # Merge with the previous range when the gap costs less than 
+            # the header of a new frame.
+            if ranges and i - ranges[ -1 ][ 1 ] <= self.FRAME_HEADER_SIZE:
+                ranges[ -1 ][ 1 ] = i + 1
+            else:
+                ranges.append([ i, i + 1 ])
+        
+        return ranges
+    
+    
     #----------------------------------------------------------------------------
     def read_next_message( self ):
         
+        start_time = monotonic() if metrics.enabled else None
+        
         msg = self.read_config_object( self.OBJ_TYPE_MESSAGE )
+        msg = self.decode_message( msg[0] )
+        
+        if start_time is not None:
+            self.metric_read.observe( monotonic() - start_time )
+            self.metric_messages.add( 0 if msg is None else 1 )
         
-        idx = msg[0][0] - 1
+        return msg
+    
+    
+    #----------------------------------------------------------------------------
+    def read_messages( self, limit = None ):
+        
+        start_time = monotonic() if metrics.enabled else None
+        
+        if limit is None:
+            limit = self.drain_limit
+        
+        messages = []
+        
+        # The first message is read alone, larger bursts only while the
+        # CHANGE line tells more are pending.
+        count = 1
+        self.drain_count = 0
+        
+        try:
+            while True:
+                
+                ## Read a burst of messages, each in its own frame ##
+                size = self.obj_table[ self.OBJ_TYPE_MESSAGE ][ 'size' ]
+                
+                received = self.read_message_frames( count )
+                empty = False
+                
+                self.drain_count += count
+                
+                # A report may land in the queue while the burst is clocked
+                # out, frames after an empty one still carry messages.
+                for i in range( count ):
+                    start = i * ( size + self.FRAME_HEADER_SIZE ) + self.FRAME_HEADER_SIZE
+                    
+                    msg = self.decode_message( received[ start : start + size ] )
+                    if msg is None:
+                        empty = True
+                    else:
+                        messages.append( msg )
+                
+                
+                ## The CHANGE line is released once the queue is empty ##
+                if self.change is not None:
+                    if self.change.read() != 0:
+                        return messages
+                
+                elif empty:
+                    return messages
+                
+                if self.drain_count >= limit:
+                    return messages
+                
+                count = min( count * 2, self.drain_batch, limit - self.drain_count )
+        
+        finally:
+            if start_time is not None:
+                self.metric_read.observe( monotonic() - start_time )
+                self.metric_messages.add( len( messages ))
+    
+    
+    #----------------------------------------------------------------------------
+    def messages( self ):
+        
+        ## Yield pending messages until the CHANGE line is released ##
+        budget = self.drain_limit
+        
+        while True:
+            for msg in self.read_messages( budget ):
+                yield msg
+            
+            if self.change is None or self.change.read() != 0:
+                return
+            
+            # Still asserted, left to the caller to retry later
+            budget -= self.drain_count
+            if budget <= 0:
+                return
+    
+    
+    #----------------------------------------------------------------------------
+    def read_message_frames( self, count ):
+        
+        if not count in self.drain_frames:
+            
+            lsb, msb = self.object_address( self.OBJ_TYPE_MESSAGE )
+            size = self.obj_table[ self.OBJ_TYPE_MESSAGE ][ 'size' ]
+            
+            byte_delay = int( self.byte_delay_ms * 1000 )
+            read_delay = min( int( self.timing[ 'read' ] * 1000000 ), 0xFFFF )
+            
+            data = bytearray()
+            segments = []
+            
+            for i in range( count ):
+                addr_low, addr_hi = self.encode_address( lsb, msb, True )
+                
+                data.extend(( addr_low, addr_hi, size ))
+                data.extend( [ 0x00 ] * size )
+                
+                # Release the chip select after each message, leaving the
+                # device its read settle time before the next one.
+                segments.extend( [( 1, byte_delay, False )] * ( size + self.FRAME_HEADER_SIZE - 1 ))
+                segments.append(( 1, read_delay, True ))
+            
+            self.drain_frames[ count ] = ( data, segments, bytearray( len( data )))
+        
+        data, segments, rxbuf = self.drain_frames[ count ]
+        
+        self.wait_ready()
+        
+        # The read settle time is already part of the last frame
+        self.spi.transfer_segments( data, segments, rxbuf = rxbuf )
+        
+        return rxbuf
+    
+    
+    #----------------------------------------------------------------------------
+    def decode_message( self, msg ):
+        
+        idx = msg[0] - 1
         if idx == 254:
             return None
         
-        report = self.report_id[ idx ]
-        report['data'] = msg[0][1:-1]
+        msg = Message( self.report_type[ idx ], self.report_inst[ idx ], tuple( msg[1:-1] ))
         
-        return report
+        ## The device reset on its own (brown-out), its configuration came back from NVM ##
+        if msg.type == self.OBJ_TYPE_COMMAND:
+            expected = self.reset_pending
+            self.reset_pending = False
+            
+            if msg.data[0] & self.STATUS_RESET and not expected:
+                self.invalidate_shadow()
+        
+        return msg
     
     
     #----------------------------------------------------------------------------
-    def read_block( self, addr_low, addr_hi, size ):
+    def encode_address( self, addr_low, addr_hi, read ):
+        
         addr_hi = (( addr_low & 0x80 ) >> 7 ) + ( addr_hi << 1 )
-        addr_low = (( addr_low & 0x7f ) << 1 ) | 0x01
+        addr_low = (( addr_low & 0x7f ) << 1 )
+        
+        if read:
+            addr_low |= 0x01
+        
+        return ( addr_low, addr_hi )
+    
+    
+    #----------------------------------------------------------------------------
+    def read_block( self, addr_low, addr_hi, size ):
+        addr_low, addr_hi = self.encode_address( addr_low, addr_hi, True )
         
-        data = [ addr_low, addr_hi, size]
-        data.extend( [0x00] * size )
+        data = bytearray( size + 3 )
+        data[ 0:3 ] = ( addr_low, addr_hi, size )
         
-        received = self.spi.transfer_byte_delay( data )
+        self.wait_ready()
         
-        time.sleep ( 0.002 )
+        received = self.spi.transfer_byte_delay( data, self.byte_delay_ms )
+        
+        self.set_busy( 'read' )
         
         return received[3:]
 
@@ -259,39 +639,53 @@ class AT42QT1085:
     #----------------------------------------------------------------------------
     def write_block( self, addr_low, addr_hi, block ):
         
-        addr_hi = (( addr_low & 0x80 ) >> 7 ) + ( addr_hi << 1 )
-        addr_low = (( addr_low & 0x7f ) << 1 )
+        addr_low, addr_hi = self.encode_address( addr_low, addr_hi, False )
         
-        data = [ addr_low, addr_hi, len( block ) ]
+        data = bytearray(( addr_low, addr_hi, len( block ) ))
         data.extend( block )
         
-        received = self.spi.transfer_byte_delay( data )
+        self.wait_ready()
         
-        time.sleep( 0.010 )
-
+        received = self.spi.transfer_byte_delay( data, self.byte_delay_ms )
+        
+        self.set_busy( 'write' )
         
         return sum( received[ 3: ] ) == ( 0xAA * len( block ))
     
     
     #----------------------------------------------------------------------------
-    def crc24( self, block ):
+    def set_busy( self, operation ):
+        self.busy_until = monotonic() + self.timing[ operation ]
+    
+    
+    #----------------------------------------------------------------------------
+    def wait_ready( self ):
         
-        crc = 0x00
-        crcpoly = 0x80001b
+        delay = self.busy_until - monotonic()
         
-        for i in range( 0, len( block ), 2 ):
-            
-            if i + 1 < len( block ):
-                data_word = ( block[ i + 1 ] << 8 ) | block[ i ]
-            else:
-                data_word = block[ i ]
-                
-            crc = (( crc << 1 ) ^ data_word )
+        if delay > 0:
+            time.sleep( delay )
+    
+    
+    #----------------------------------------------------------------------------
+    def wait_reset( self, family_id ):
+        
+        deadline = monotonic() + self.timing[ 'reset' ]
         
-            if crc & 0x1000000:
-                crc ^= crcpoly
+        ## Probe the family ID until the device answers again ##
+        while monotonic() < deadline:
+            time.sleep( self.timing[ 'reset_poll' ] )
+            
+            if self.read_block( 0x00, 0x00, 1 )[0] == family_id:
+                return
         
-        return crc & 0xFFFFFF
+        ## No answer, fall back to the worst case reset time ##
+        self.busy_until = deadline
+    
+    
+    #----------------------------------------------------------------------------
+    def crc24( self, block ):
+        return CRC24( block ).digest()
     
     
     
@@ -305,6 +699,13 @@ class AT42QT1085:
     
         data[ command ] = 0x55
         
+        ## The configuration is reloaded from the non-volatile memory on reset ##
+        if command == self.COMMAND_RESET:
+            self.invalidate_shadow()
+            
+            # Its reset report is the next T6 message, the shadow is kept then
+            self.reset_pending = True
+        
         return self.write_config_object( self.OBJ_TYPE_COMMAND, data, 0 )
     
     
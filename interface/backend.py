@@ -0,0 +1,24 @@
+import os
+
+
+# Selects the devices used when none is given at construction
+BACKEND_ENV = "ALARM_CLOCK_BACKEND"
+
+BACKEND_HW = "hw"
+BACKEND_SIM = "sim"
+
+
+#----------------------------------------------------------------------------
+def get_backend():
+    
+    backend = os.environ.get( BACKEND_ENV, BACKEND_HW )
+    
+    if not backend in ( BACKEND_HW, BACKEND_SIM ):
+        raise ValueError( "Invalid backend '%s' (%s)" % ( backend, BACKEND_ENV ))
+    
+    return backend
+
+
+#----------------------------------------------------------------------------
+def is_simulated():
+    return get_backend() == BACKEND_SIM
@@ -0,0 +1,40 @@
+import os
+import time
+import ctypes
+
+
+CLOCK_REALTIME = 0
+CLOCK_MONOTONIC = 1
+
+
+#----------------------------------------------------------------------------
+# struct timespec
+#----------------------------------------------------------------------------
+class timespec( ctypes.Structure ):
+    _fields_ = [
+        ( "tv_sec", ctypes.c_long ),
+        ( "tv_nsec", ctypes.c_long ),
+    ]
+
+
+libc = ctypes.CDLL( None, use_errno = True )
+
+
+#----------------------------------------------------------------------------
+def clock_gettime( clock_id ):
+    ts = timespec()
+    
+    if libc.clock_gettime( clock_id, ctypes.byref( ts )) != 0:
+        errno = ctypes.get_errno()
+        raise OSError( errno, os.strerror( errno ))
+    
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+#----------------------------------------------------------------------------
+def monotonic():
+    return clock_gettime( CLOCK_MONOTONIC )
+
+
+if hasattr( time, "monotonic" ):
+    monotonic = time.monotonic
@@ -0,0 +1,137 @@
+from struct import Struct
+
+
+CRC24_POLY = 0x80001B
+CRC24_MASK = 0xFFFFFF
+
+
+#----------------------------------------------------------------------------
+# Precomputed tables
+#
+# Each 16 bits little endian word is processed as:
+#
+#   crc = ( crc << 1 ) ^ word
+#   if crc & 0x1000000: crc ^= CRC24_POLY
+#
+# Since the word never reaches bit 24, the update is linear in crc and 
+# processing 8 words at once becomes:
+#
+#   crc = (( crc << 8 ) & CRC24_MASK ) ^ CRC24_TABLE[ crc >> 16 ] ^ 
+#         ( w0 << 7 ) ^ ( w1 << 6 ) ^ ... ^ w7
+#----------------------------------------------------------------------------
+def _gen_table( nbits ):
+    
+    table = []
+    
+    for i in range( 1 << nbits ):
+        crc = i << ( 24 - nbits )
+        
+        for n in range( nbits ):
+            crc <<= 1
+            
+            if crc & 0x1000000:
+                crc ^= CRC24_POLY
+        
+        table.append( crc & CRC24_MASK )
+    
+    return table
+
+
+CRC24_TABLE = _gen_table( 8 )
+
+WORDS_8 = Struct( "<8H" )
+
+
+#=========================================================================================
+class CRC24:
+    
+    #----------------------------------------------------------------------------
+    def __init__( self, data = None ):
+        
+        self.crc = 0
+        self.pending = None
+        
+        if data is not None:
+            self.update( data )
+    
+    
+    #----------------------------------------------------------------------------
+    def copy( self ):
+        
+        other = CRC24()
+        other.crc = self.crc
+        other.pending = self.pending
+        
+        return other
+    
+    
+    #----------------------------------------------------------------------------
+    def update( self, data ):
+        
+        if type( data ) is not bytearray:
+            data = bytearray( data )
+        
+        if not data:
+            return self
+        
+        crc = self.crc
+        start = 0
+        
+        ## Complete the word left over by the previous update ##
+        if self.pending is not None:
+            crc = self.update_word( crc, ( data[ 0 ] << 8 ) | self.pending )
+            
+            self.pending = None
+            start = 1
+        
+        
+        ## Bulk of the data, 8 words at a time ##
+        end = start + (( len( data ) - start ) & ~0x0F )
+        table = CRC24_TABLE
+        
+        for offset in range( start, end, 16 ):
+            w0, w1, w2, w3, w4, w5, w6, w7 = WORDS_8.unpack_from( data, offset )
+            
+            crc = ((( crc << 8 ) & CRC24_MASK ) ^ table[ crc >> 16 ] ^
+                   ( w0 << 7 ) ^ ( w1 << 6 ) ^ ( w2 << 5 ) ^ ( w3 << 4 ) ^
+                   ( w4 << 3 ) ^ ( w5 << 2 ) ^ ( w6 << 1 ) ^ w7 )
+        
+        
+        ## Remaining words ##
+        for offset in range( end, len( data ) - 1, 2 ):
+            crc = self.update_word( crc, ( data[ offset + 1 ] << 8 ) | data[ offset ] )
+        
+        if ( len( data ) - end ) & 0x01:
+            self.pending = data[ -1 ]
+        
+        self.crc = crc
+        
+        return self
+    
+    
+    #----------------------------------------------------------------------------
+    def update_word( self, crc, data_word ):
+        
+        crc = ( crc << 1 ) ^ data_word
+        
+        if crc & 0x1000000:
+            crc ^= CRC24_POLY
+        
+        return crc & CRC24_MASK
+    
+    
+    #----------------------------------------------------------------------------
+    def digest( self ):
+        
+        ## An odd trailing byte is processed as a word with a null high byte ##
+        if self.pending is not None:
+            return self.update_word( self.crc, self.pending )
+        
+        return self.crc
+
+
+
+#----------------------------------------------------------------------------
+def crc24( data ):
+    return CRC24( data ).digest()
+
@@ -1,13 +1,26 @@
 import time
 
+from collections import namedtuple
+
+from i2c import get_bus
+from scheduler import BusScheduler
+from scheduler import PRIORITY_KEY
+from scheduler import PRIORITY_CLOCK
+from scheduler import PRIORITY_FADE
 from pca9634 import PCA9634
 from pca9634 import Digit
+from pca9634 import WritePlanner
 
 from pca9634 import STATE_ON
 from pca9634 import STATE_OFF
 from pca9634 import STATE_PWM
 from pca9634 import STATE_PWM_GLOBAL
 
+from pca9634 import MODE_ALLCALL
+from pca9634 import MODE_SUB1
+from pca9634 import MODE_SUB2
+from pca9634 import MODE_SUB3
+
 ADDR_DIGIT_1 = 0x68
 ADDR_DIGIT_2 = 0x69
 ADDR_DIGIT_3 = 0x6a
@@ -17,6 +30,7 @@ ADDR_DIGIT_BASE = 0x51
 ADDR_ALLCALL = 0x70
 ADDR_SUB_1 = 0x71
 ADDR_SUB_2 = 0x72
+ADDR_SUB_3 = 0x74
 
 LED_ID_ALARM = 0 
 LED_ID_PM = 3
@@ -25,30 +39,124 @@ LED_ID_LIGHT_RED = 5
 LED_ID_LIGHT_GREEN = 6
 LED_ID_LIGHT_BLUE = 7
 
+MINUTES_PER_DAY = 24 * 60
+
+# Position of each digit in the display text
+DIGIT_POS = ( 0, 1, 3, 4 )
+
+
+
+#=========================================================================================
+class Frame:
+    
+    #----------------------------------------------------------------------------
+    def __init__( self, text = "", pm = False, alarm = False, rgb = ( 0, 0, 0 ), 
+                  brightness = 0x01 ):
+        
+        self.text = text[ :5 ].ljust( 5 )
+        self.pm = pm
+        self.alarm = alarm
+        self.rgb = rgb
+        self.brightness = brightness
+    
+    
+    #----------------------------------------------------------------------------
+    def copy( self ):
+        return Frame( self.text, self.pm, self.alarm, self.rgb, self.brightness )
+
+
+
+#=========================================================================================
+class MinuteFrame( namedtuple( "MinuteFrame", "text pm glyphs diff" )):
+    __slots__ = ()
+
+
+
+#----------------------------------------------------------------------------
+def build_minute_table( digit, hour24 = False ):
+    
+    ## Render every minute of the day ##
+    frames = []
+    
+    for minute in range( MINUTES_PER_DAY ):
+        hour, minute = divmod( minute, 60 )
+        
+        if hour24:
+            text = "%02d:%02d" % ( hour, minute )
+            pm = False
+        else:
+            text = "%2d:%02d" % ( hour % 12 or 12, minute )
+            pm = hour >= 12
+        
+        glyphs = tuple([ digit.get_glyph( text[ pos ] ) for pos in DIGIT_POS ])
+        
+        frames.append(( text, pm, glyphs ))
+    
+    
+    ## Diff each minute against the next one ##
+    table = []
+    
+    for minute, ( text, pm, glyphs ) in enumerate( frames ):
+        next_glyphs = frames[ ( minute + 1 ) % MINUTES_PER_DAY ][2]
+        
+        diff = tuple([ ( index, glyph ) for index, glyph in enumerate( next_glyphs ) 
+                       if glyph != glyphs[ index ] ])
+        
+        table.append( MinuteFrame( text, pm, glyphs, diff ))
+    
+    return table
+
 
 
 #=========================================================================================
 class Display:
     
+    # Minute tables, indexed by ( hour24, def_led_state )
+    minute_tables = {}
+
+    
     
     #----------------------------------------------------------------------------
-    def __init__( self, bus = 0):
+    def __init__( self, bus = 0, hour24 = False, scheduled = False ):
         
         self.bus = 0
         self.alarm_on = False
+        self.hour24 = hour24
+        self.minute = None
+        
+        # Shared by all the chips, a frame is sent as a single transaction. When 
+        # scheduled, the writes are sent by a background thread by priority.
+        self.i2c = get_bus( bus )
+        
+        if scheduled:
+            chips = [ ADDR_DIGIT_BASE, ADDR_DIGIT_1, ADDR_DIGIT_2, ADDR_DIGIT_3, ADDR_DIGIT_4 ]
+            groups = [ ADDR_ALLCALL, ADDR_SUB_1, ADDR_SUB_2, ADDR_SUB_3 ]
+            
+            aliases = {}
+            for addr in chips:
+                aliases[ addr ] = groups
+            for addr in groups:
+                aliases[ addr ] = chips + [ group for group in groups if group != addr ]
+            
+            self.i2c = BusScheduler( self.i2c, aliases )
+        
+        # Held across staging a frame and sending it, shared with the chip shadows
+        self.lock = self.i2c.lock
         
+        self.base = PCA9634( self.i2c, ADDR_DIGIT_BASE )
         
-        self.base = PCA9634( bus, ADDR_DIGIT_BASE )
-        self.group_hour = PCA9634( bus, ADDR_SUB_1 )
-        self.group_min = PCA9634( bus, ADDR_SUB_2 )
         
+        # Digit segments and indicators follow the group dimming / blinking,
+        # the RGB light does not.
+        self.group_brightness = 0xFF
+        self.blinking = False
         
         ## Initalize digits ##
         self.digits = [
-            Digit( bus, ADDR_DIGIT_1, logic_inverted = True, def_led_state = STATE_PWM ),
-            Digit( bus, ADDR_DIGIT_2, logic_inverted = True, def_led_state = STATE_PWM ),
-            Digit( bus, ADDR_DIGIT_3, logic_inverted = True, def_led_state = STATE_PWM ),
-            Digit( bus, ADDR_DIGIT_4, logic_inverted = True, def_led_state = STATE_PWM ),
+            Digit( self.i2c, ADDR_DIGIT_1, logic_inverted = True, def_led_state = STATE_PWM_GLOBAL ),
+            Digit( self.i2c, ADDR_DIGIT_2, logic_inverted = True, def_led_state = STATE_PWM_GLOBAL ),
+            Digit( self.i2c, ADDR_DIGIT_3, logic_inverted = True, def_led_state = STATE_PWM_GLOBAL ),
+            Digit( self.i2c, ADDR_DIGIT_4, logic_inverted = True, def_led_state = STATE_PWM_GLOBAL ),
         ]
         
         self.digits[0].enable_sub1 = True
@@ -57,70 +165,202 @@ class Display:
         self.digits[3].enable_sub2 = True
         
         for digit in self.digits:
+            digit.enable_sub3 = True
             digit.set_mode()
         
 
         ## Initalize base PCA9634 ##
-        self.base.set_mode()
+        self.base.set_mode( False )
         
-        self.set_rgb( 0, 0, 0 )
-        self.base.set_led_state( LED_ID_LIGHT_RED, STATE_PWM )
-        self.base.set_led_state( LED_ID_LIGHT_GREEN, STATE_PWM )
-        self.base.set_led_state( LED_ID_LIGHT_BLUE, STATE_PWM )
-
+        self.base.set_led_state( LED_ID_LIGHT_RED, STATE_PWM, False )
+        self.base.set_led_state( LED_ID_LIGHT_GREEN, STATE_PWM, False )
+        self.base.set_led_state( LED_ID_LIGHT_BLUE, STATE_PWM, False )
         
-        ## Set default text ##
-        self.text = "--:--"
-        self.set_display( self.text, True)
+        self.chips = [ self.base ] + self.digits
         
+        # Identical writes are sent once through ALLCALL or a sub-address
+        self.planner = WritePlanner( self.chips, (
+            ( ADDR_ALLCALL, MODE_ALLCALL ),
+            ( ADDR_SUB_3, MODE_SUB3 ),
+            ( ADDR_SUB_1, MODE_SUB1 ),
+            ( ADDR_SUB_2, MODE_SUB2 ),
+        ))
         
-        self.set_digit_brightness( 0x01 )
         
+        ## Set default text ##
+        self.minute_table = self.get_minute_table()
         
+        self.frame = None
+        self.commit( Frame( "--:--", brightness = 0x01 ), True )
     
     
     #----------------------------------------------------------------------------
-    def set_display( self, text, force = False ):
-        
-        text = text[ :5 ].ljust( 5 )
-
-        ## Update first two digits ##
-        if ( text[0] != self.text[0] ) or force:
-            self.digits[0].set_digit( text[0] )
+    def next_frame( self ):
+        return self.frame.copy()
+    
+    
+    #----------------------------------------------------------------------------
+    def commit( self, frame, force = False ):
         
-        if ( text[1] != self.text[1] ) or force:
-            self.digits[1].set_digit( text[1] )
+        with self.lock:
+            last = self.frame
+            if last is None:
+                force = True
+            
+            text = frame.text[ :5 ].ljust( 5 )
+            
+            ## Digits ##
+            for pos, digit in (( 0, self.digits[0] ), ( 1, self.digits[1] ),
+                               ( 3, self.digits[2] ), ( 4, self.digits[3] )):
+                
+                if force or text[ pos ] != last.text[ pos ]:
+                    digit.set_digit( text[ pos ], False )
+            
+            
+            ## Indicators ##
+            if force or text[2] != last.text[2]:
+                self.base.set_led_state( LED_ID_DOTS, STATE_PWM_GLOBAL if text[2] == ":" else STATE_OFF, False )
+            
+            if force or frame.pm != last.pm:
+                self.base.set_led_state( LED_ID_PM, STATE_PWM_GLOBAL if frame.pm else STATE_OFF, False )
+            
+            if force or frame.alarm != last.alarm:
+                self.base.set_led_state( LED_ID_ALARM, STATE_PWM_GLOBAL if frame.alarm else STATE_OFF, False )
+            
+            
+            ## Brightness ##
+            if force or frame.brightness != last.brightness:
+                value = frame.brightness
+                
+                for digit in self.digits:
+                    digit.set_all_led_pwm( value, False )
+                
+                self.base.set_led_pwm( LED_ID_DOTS, value, False )
+                self.base.set_led_pwm( LED_ID_PM, value, False )
+                self.base.set_led_pwm( LED_ID_ALARM, value, False )
+            
+            
+            ## RGB light ##
+            if force or frame.rgb != last.rgb:
+                red, green, blue = self.scale_rgb( *frame.rgb )
+                
+                self.base.set_led_pwm( LED_ID_LIGHT_RED, red, False )
+                self.base.set_led_pwm( LED_ID_LIGHT_GREEN, green, False )
+                self.base.set_led_pwm( LED_ID_LIGHT_BLUE, blue, False )
+            
+            
+            ## Send the changed registers ##
+            self.send()
+            
+            frame.text = text
+            self.frame = frame
+            self.minute = None
+            
+            self.text = text
+            self.alarm_on = frame.alarm
+    
+    
+    #----------------------------------------------------------------------------
+    def send( self, planned = True ):
         
-        ## Update dots ##
-        if ( text[2] != self.text[2] ) or force:
-            if text[2] == ":":
-                self.base.set_led_state( 4, STATE_PWM )
-            else:
-                self.base.set_led_state( 4, STATE_OFF )
+        # The shadows are marked written as the writes are queued, if the batch 
+        # fails the registers it held are left to the next send.
+        with self.lock:
+            pending = [ ( chip, chip.dirty ) for chip in self.chips ]
+            
+            try:
+                with self.i2c.batch():
+                    if planned:
+                        self.planner.flush()
+                    else:
+                        for chip in self.chips:
+                            chip.flush()
+            
+            except IOError:
+                for chip, mask in pending:
+                    chip.mark_unknown( mask )
+                raise
+    
+    
+    #----------------------------------------------------------------------------
+    def set_display( self, text, force = False ):
         
-        ## Update last two digits ##
-        if ( text[3] != self.text[3] ) or force:
-            self.digits[2].set_digit( text[3] )
+        with self.lock:
+            frame = self.next_frame()
+            frame.text = text
+            
+            with self.i2c.priority( PRIORITY_KEY ):
+                self.commit( frame, force )
+    
+    
+    #----------------------------------------------------------------------------
+    def set_alarm( self, enabled ):
         
-        if ( text[4] != self.text[4] ) or force:
-            self.digits[3].set_digit( text[4] )
-
-        self.text = text
+        with self.lock:
+            frame = self.next_frame()
+            frame.alarm = enabled
+            
+            with self.i2c.priority( PRIORITY_KEY ):
+                self.commit( frame )
     
     
     #----------------------------------------------------------------------------
     def set_digit_brightness( self, value ):
         
-        self.group_hour.set_all_led_pwm( value )
-        self.group_min.set_all_led_pwm( value )
-        self.base.set_led_pwm( LED_ID_DOTS, value )
-        
-        self.base.set_led_pwm( LED_ID_PM, value )
-        self.base.set_led_pwm( LED_ID_ALARM, value )
+        with self.lock:
+            frame = self.next_frame()
+            frame.brightness = value
+            
+            with self.i2c.priority( PRIORITY_FADE ):
+                self.commit( frame )
 
         
     #----------------------------------------------------------------------------
-    def set_rgb( self, red, green, blue ):
+    def set_sleep( self, enabled ):
+        
+        with self.lock:
+            for chip in self.chips:
+                chip.low_power = enabled
+                chip.set_mode( False )
+            
+            with self.i2c.priority( PRIORITY_KEY ):
+                self.send()
+    
+    
+    #----------------------------------------------------------------------------
+    def set_brightness( self, value ):
+        
+        # Global dimming, the same GRPPWM on every chip goes out as one ALLCALL write
+        with self.lock:
+            self.group_brightness = value
+            
+            if not self.blinking:
+                for chip in self.chips:
+                    chip.set_group_pwm( value, False )
+            
+            with self.i2c.priority( PRIORITY_FADE ):
+                self.send()
+    
+    
+    #----------------------------------------------------------------------------
+    def set_blink( self, enabled, period = 23, duty = 0x80 ):
+        
+        # Blinks every ( period + 1 ) / 24 s, on for duty / 256 of it
+        with self.lock:
+            self.blinking = enabled
+            
+            for chip in self.chips:
+                if enabled:
+                    chip.set_group_blink( period, duty, False )
+                else:
+                    chip.set_group_pwm( self.group_brightness, False )
+            
+            with self.i2c.priority( PRIORITY_KEY ):
+                self.send()
+    
+    
+    #----------------------------------------------------------------------------
+    def scale_rgb( self, red, green, blue ):
 
         if red > 0:
             red = 89 + ( red * 167 / 256 )
@@ -131,31 +371,98 @@ class Display:
         if blue > 0:
             blue = 95 + ( blue * 161 / 256 )
         
+        return ( red, green, blue )
+    
+    
+    #----------------------------------------------------------------------------
+    def set_rgb( self, red, green, blue ):
         
-        self.base.set_led_pwm( LED_ID_LIGHT_RED, red )
-        self.base.set_led_pwm( LED_ID_LIGHT_GREEN, green )
-        self.base.set_led_pwm( LED_ID_LIGHT_BLUE, blue )
+        with self.lock:
+            frame = self.next_frame()
+            frame.rgb = ( red, green, blue )
+            
+            with self.i2c.priority( PRIORITY_FADE ):
+                self.commit( frame )
     
     
     #----------------------------------------------------------------------------
-    def print_time( self, ts = None ):
+    def get_minute_table( self ):
         
-        if ts is None:
-            ts = time.localtime()
+        digit = self.digits[0]
+        key = ( self.hour24, digit.def_led_state )
         
+        table = self.minute_tables.get( key )
+        if table is None:
+            table = build_minute_table( digit, self.hour24 )
+            self.minute_tables[ key ] = table
         
-        pm = ts.tm_hour >= 12
-        hr = ts.tm_hour
+        return table
+    
+    
+    #----------------------------------------------------------------------------
+    def set_hour24( self, enabled ):
         
-        if hr == 0:
-            hr = 12
+        with self.lock:
+            if enabled == self.hour24:
+                return
             
-        if hr > 12:
-            hr = hr % 12
-        
+            self.hour24 = enabled
+            self.minute_table = self.get_minute_table()
+            
+            if self.minute is not None:
+                minute = self.minute
+                
+                self.minute = None
+                self.print_minute( minute )
+    
+    
+    #----------------------------------------------------------------------------
+    def print_time( self, ts = None ):
         
-        self.set_display( str( hr ).rjust( 2 ) + ":" + str( ts.tm_min ).zfill( 2 ) )
+        if ts is None:
+            ts = time.localtime()
         
-        self.base.set_led_state( LED_ID_PM, STATE_PWM if pm else STATE_OFF )
+        with self.i2c.priority( PRIORITY_CLOCK ):
+            self.print_minute( ts.tm_hour * 60 + ts.tm_min )
+    
+    
+    #----------------------------------------------------------------------------
+    def print_minute( self, minute ):
         
-        
\ No newline at end of file
+        with self.lock:
+            last = self.minute
+            if minute == last:
+                return
+            
+            entry = self.minute_table[ minute ]
+            
+            
+            ## Not following the last minute, redraw through the frame diff ##
+            if last is None or minute != ( last + 1 ) % MINUTES_PER_DAY:
+                frame = self.next_frame()
+                frame.text = entry.text
+                frame.pm = entry.pm
+                
+                self.commit( frame )
+                self.minute = minute
+                return
+            
+            
+            ## Next minute, send the prebuilt digit writes ##
+            prev = self.minute_table[ last ]
+            
+            for index, glyph in prev.diff:
+                self.digits[ index ].set_glyph( glyph, False )
+            
+            if entry.pm != prev.pm:
+                self.base.set_led_state( LED_ID_PM, STATE_PWM_GLOBAL if entry.pm else STATE_OFF, False )
+            
+            self.send( False )
+            
+            frame = self.next_frame()
+            frame.text = entry.text
+            frame.pm = entry.pm
+            
+            self.frame = frame
+            self.text = entry.text
+            self.minute = minute
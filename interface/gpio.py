@@ -1,5 +1,44 @@
+import os
 import os.path
 import select
+import ctypes
+
+from backend import is_simulated
+
+
+#----------------------------------------------------------------------------
+# Positioned read / write, a single syscall without moving the file offset
+#----------------------------------------------------------------------------
+if hasattr( os, "pread" ):
+    pread = os.pread
+    pwrite = os.pwrite
+
+else:
+    libc = ctypes.CDLL( None, use_errno = True )
+    
+    libc.pread64.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int64 ]
+    libc.pwrite64.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int64 ]
+    libc.pread64.restype = ctypes.c_ssize_t
+    libc.pwrite64.restype = ctypes.c_ssize_t
+    
+    def pread( fd, n, offset ):
+        buf = ctypes.create_string_buffer( n )
+        
+        ret = libc.pread64( fd, buf, n, offset )
+        if ret < 0:
+            errno = ctypes.get_errno()
+            raise OSError( errno, os.strerror( errno ))
+        
+        return buf.raw[ :ret ]
+    
+    def pwrite( fd, data, offset ):
+        
+        ret = libc.pwrite64( fd, data, len( data ), offset )
+        if ret < 0:
+            errno = ctypes.get_errno()
+            raise OSError( errno, os.strerror( errno ))
+        
+        return ret
 
 
 #=========================================================================================
@@ -50,10 +89,46 @@ class GPIO():
     
     #----------------------------------------------------------------------------
     def __del__( self ):
+        self.close()
+    
+    
+    #----------------------------------------------------------------------------
+    def close( self ):
         
         if self.poll_edge:
             self.poll_edge.unregister( self.fd_value )
             self.poll_edge.close()
+            self.poll_edge = None
+        
+        if self.fd_value is not None:
+            os.close( self.fd_value )
+            self.fd_value = None
+    
+    
+    #----------------------------------------------------------------------------
+    def fileno( self ):
+        return self.open_value()
+    
+    
+    #----------------------------------------------------------------------------
+    def open_value( self ):
+        
+        if self.fd_value is not None:
+            return self.fd_value
+        
+        ## Input pins may not be writable ##
+        for flags in ( os.O_RDWR, os.O_RDONLY ):
+            try:
+                self.fd_value = os.open( self.io_path + "/value", flags )
+                break
+                
+            except OSError: 
+                pass
+        
+        else:
+            raise IOError( "Unable to open value of gpio '%s'" % ( self.io_name ) )
+        
+        return self.fd_value
     
     
     #----------------------------------------------------------------------------
@@ -161,29 +236,24 @@ class GPIO():
     #----------------------------------------------------------------------------
     def write( self, value ):
         
+        fd = self.open_value()
+        
         try:
-
-            f = open( self.io_path + "/value", "w" )
+            pwrite( fd, str( value ), 0 )
             
-            f.write( str( value ) )
-            f.close()
-            
-        except IOError: 
+        except OSError: 
             raise IOError( "Unable to write value of gpio '%s'" % ( self.io_name ) )
     
     
     #----------------------------------------------------------------------------
     def read( self ):
         
+        fd = self.open_value()
+        
         try:
-            f = open( self.io_path + "/value", "r" )
+            return int( pread( fd, 1, 0 ))
             
-            val = int( f.read( 1 ) )
-            f.close()
-            
-            return val
-            
-        except IOError: 
+        except OSError: 
             raise IOError( "Unable to read value of gpio '%s'" % ( self.io_name ) )
     
     
@@ -191,10 +261,18 @@ class GPIO():
     def wait_edge( self ):
         
         if self.poll_edge is None:
-            self.fd_value = open( self.io_path + "/value", "r" )
-            
             self.poll_edge = select.epoll()
-            self.poll_edge.register( self.fd_value, select.EPOLLET )
+            self.poll_edge.register( self.open_value(), select.EPOLLPRI | select.EPOLLET )
             
         self.poll_edge.poll()
-        
\ No newline at end of file
+
+
+
+#----------------------------------------------------------------------------
+def open_gpio( kernel_id, mode ):
+
+    if is_simulated():
+        from sim import open_gpio
+        return open_gpio( kernel_id, mode )
+
+    return GPIO( kernel_id, mode )
@@ -0,0 +1,593 @@
+import os
+import errno
+import fcntl
+import select
+import ctypes
+from struct import Struct
+from collections import namedtuple
+
+from ioctl_numbers import _IOWR
+from gpio import GPIO
+from clock import monotonic
+
+
+
+#----------------------------------------------------------------------------
+# GPIO character device uAPI v2 (linux/gpio.h)
+#----------------------------------------------------------------------------
+GPIO_V2_LINES_MAX = 64
+GPIO_V2_LINE_NUM_ATTRS_MAX = 10
+GPIO_MAX_NAME_SIZE = 32
+
+GPIO_V2_LINE_FLAG_USED = 0x01
+GPIO_V2_LINE_FLAG_ACTIVE_LOW = 0x02
+GPIO_V2_LINE_FLAG_INPUT = 0x04
+GPIO_V2_LINE_FLAG_OUTPUT = 0x08
+GPIO_V2_LINE_FLAG_EDGE_RISING = 0x10
+GPIO_V2_LINE_FLAG_EDGE_FALLING = 0x20
+GPIO_V2_LINE_FLAG_OPEN_DRAIN = 0x40
+GPIO_V2_LINE_FLAG_OPEN_SOURCE = 0x80
+GPIO_V2_LINE_FLAG_BIAS_PULL_UP = 0x100
+GPIO_V2_LINE_FLAG_BIAS_PULL_DOWN = 0x200
+GPIO_V2_LINE_FLAG_BIAS_DISABLED = 0x400
+GPIO_V2_LINE_FLAG_EVENT_CLOCK_REALTIME = 0x800
+
+GPIO_V2_LINE_ATTR_ID_FLAGS = 1
+GPIO_V2_LINE_ATTR_ID_OUTPUT_VALUES = 2
+GPIO_V2_LINE_ATTR_ID_DEBOUNCE = 3
+
+GPIO_V2_LINE_EVENT_RISING_EDGE = 1
+GPIO_V2_LINE_EVENT_FALLING_EDGE = 2
+
+
+class gpio_v2_line_attribute_value( ctypes.Union ):
+    _fields_ = [
+        ( "flags", ctypes.c_uint64 ),
+        ( "values", ctypes.c_uint64 ),
+        ( "debounce_period_us", ctypes.c_uint32 ),
+    ]
+
+class gpio_v2_line_attribute( ctypes.Structure ):
+    _fields_ = [
+        ( "id", ctypes.c_uint32 ),
+        ( "padding", ctypes.c_uint32 ),
+        ( "u", gpio_v2_line_attribute_value ),
+    ]
+
+class gpio_v2_line_config_attribute( ctypes.Structure ):
+    _fields_ = [
+        ( "attr", gpio_v2_line_attribute ),
+        ( "mask", ctypes.c_uint64 ),
+    ]
+
+class gpio_v2_line_config( ctypes.Structure ):
+    _fields_ = [
+        ( "flags", ctypes.c_uint64 ),
+        ( "num_attrs", ctypes.c_uint32 ),
+        ( "padding", ctypes.c_uint32 * 5 ),
+        ( "attrs", gpio_v2_line_config_attribute * GPIO_V2_LINE_NUM_ATTRS_MAX ),
+    ]
+
+class gpio_v2_line_request( ctypes.Structure ):
+    _fields_ = [
+        ( "offsets", ctypes.c_uint32 * GPIO_V2_LINES_MAX ),
+        ( "consumer", ctypes.c_char * GPIO_MAX_NAME_SIZE ),
+        ( "config", gpio_v2_line_config ),
+        ( "num_lines", ctypes.c_uint32 ),
+        ( "event_buffer_size", ctypes.c_uint32 ),
+        ( "padding", ctypes.c_uint32 * 5 ),
+        ( "fd", ctypes.c_int32 ),
+    ]
+
+class gpio_v2_line_values( ctypes.Structure ):
+    _fields_ = [
+        ( "bits", ctypes.c_uint64 ),
+        ( "mask", ctypes.c_uint64 ),
+    ]
+
+# struct gpio_v2_line_event
+GPIO_V2_LINE_EVENT = Struct( "=QIIII24x" )
+
+
+GPIO_V2_GET_LINE_IOCTL = _IOWR( 0xB4, 0x07, ctypes.sizeof( gpio_v2_line_request ))
+GPIO_V2_LINE_SET_CONFIG_IOCTL = _IOWR( 0xB4, 0x0D, ctypes.sizeof( gpio_v2_line_config ))
+GPIO_V2_LINE_GET_VALUES_IOCTL = _IOWR( 0xB4, 0x0E, ctypes.sizeof( gpio_v2_line_values ))
+GPIO_V2_LINE_SET_VALUES_IOCTL = _IOWR( 0xB4, 0x0F, ctypes.sizeof( gpio_v2_line_values ))
+
+
+
+#----------------------------------------------------------------------------
+# Edge event, timestamp from the kernel (CLOCK_MONOTONIC by default)
+#----------------------------------------------------------------------------
+EdgeEvent = namedtuple( "EdgeEvent", "timestamp_ns offset rising seqno line_seqno" )
+
+
+#----------------------------------------------------------------------------
+def gen_line_config( config, flags, debounce_us = 0, output = None ):
+    
+    config.flags = flags
+    config.num_attrs = 0
+    
+    if debounce_us:
+        attr = config.attrs[ config.num_attrs ]
+        attr.attr.id = GPIO_V2_LINE_ATTR_ID_DEBOUNCE
+        attr.attr.u.debounce_period_us = debounce_us
+        attr.mask = 0x01
+        config.num_attrs += 1
+    
+    if output is not None:
+        attr = config.attrs[ config.num_attrs ]
+        attr.attr.id = GPIO_V2_LINE_ATTR_ID_OUTPUT_VALUES
+        attr.attr.u.values = 0x01 if output else 0x00
+        attr.mask = 0x01
+        config.num_attrs += 1
+    
+    return config
+
+
+
+#=========================================================================================
+class LineHandle:
+    
+    #----------------------------------------------------------------------------
+    def __init__( self, fd ):
+        
+        self.fd = fd
+        
+        ## Events are read in batches, never block on an empty queue ##
+        flags = fcntl.fcntl( self.fd, fcntl.F_GETFL )
+        fcntl.fcntl( self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK )
+    
+    
+    #----------------------------------------------------------------------------
+    def fileno( self ):
+        return self.fd
+    
+    
+    #----------------------------------------------------------------------------
+    def close( self ):
+        
+        if self.fd is not None:
+            os.close( self.fd )
+            self.fd = None
+    
+    
+    #----------------------------------------------------------------------------
+    def set_config( self, flags, debounce_us = 0, output = None ):
+        
+        config = gen_line_config( gpio_v2_line_config(), flags, debounce_us, output )
+        
+        fcntl.ioctl( self.fd, GPIO_V2_LINE_SET_CONFIG_IOCTL, config, True )
+    
+    
+    #----------------------------------------------------------------------------
+    def get_value( self ):
+        
+        values = gpio_v2_line_values( 0, 0x01 )
+        
+        fcntl.ioctl( self.fd, GPIO_V2_LINE_GET_VALUES_IOCTL, values, True )
+        
+        return values.bits & 0x01
+    
+    
+    #----------------------------------------------------------------------------
+    def set_value( self, value ):
+        
+        values = gpio_v2_line_values( 0x01 if value else 0x00, 0x01 )
+        
+        fcntl.ioctl( self.fd, GPIO_V2_LINE_SET_VALUES_IOCTL, values, True )
+    
+    
+    #----------------------------------------------------------------------------
+    def read_events( self, max_events = 16 ):
+        
+        try:
+            data = os.read( self.fd, GPIO_V2_LINE_EVENT.size * max_events )
+        
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            
+            raise
+        
+        events = []
+        
+        for offset in range( 0, len( data ), GPIO_V2_LINE_EVENT.size ):
+            timestamp, event_id, line, seqno, line_seqno = \
+                GPIO_V2_LINE_EVENT.unpack_from( data, offset )
+            
+            events.append( EdgeEvent( timestamp, line, event_id == GPIO_V2_LINE_EVENT_RISING_EDGE,
+                                      seqno, line_seqno ))
+        
+        return events
+
+
+
+#=========================================================================================
+class GPIOChipDevice:
+    
+    #----------------------------------------------------------------------------
+    def __init__( self, index ):
+        
+        self.path = "/dev/gpiochip%d" % ( index )
+        
+        try:
+            self.fd = os.open( self.path, os.O_RDWR )
+        
+        except OSError:
+            raise IOError( "Unable to open '%s'" % ( self.path ) )
+    
+    
+    #----------------------------------------------------------------------------
+    def __del__( self ):
+        os.close( self.fd )
+    
+    
+    #----------------------------------------------------------------------------
+    def request_line( self, offset, flags, debounce_us = 0, output = None, consumer = "" ):
+        
+        req = gpio_v2_line_request()
+        req.offsets[0] = offset
+        req.num_lines = 1
+        req.consumer = consumer[ :GPIO_MAX_NAME_SIZE - 1 ]
+        
+        gen_line_config( req.config, flags, debounce_us, output )
+        
+        try:
+            fcntl.ioctl( self.fd, GPIO_V2_GET_LINE_IOCTL, req, True )
+        
+        except IOError:
+            raise IOError( "Unable to request line %d of '%s'" % ( offset, self.path ) )
+        
+        return LineHandle( req.fd )
+
+
+
+#=========================================================================================
+class FakeLineHandle( LineHandle ):
+    
+    #----------------------------------------------------------------------------
+    def __init__( self, chip, offset, flags, debounce_us, output ):
+        
+        self.chip = chip
+        self.offset = offset
+        self.line_seqno = 0
+        
+        self.fd, self.fd_event = os.pipe()
+        
+        LineHandle.__init__( self, self.fd )
+        
+        fl = fcntl.fcntl( self.fd_event, fcntl.F_GETFL )
+        fcntl.fcntl( self.fd_event, fcntl.F_SETFL, fl | os.O_NONBLOCK )
+        
+        self.set_config( flags, debounce_us, output )
+    
+    
+    #----------------------------------------------------------------------------
+    def close( self ):
+        
+        if self.fd is not None:
+            os.close( self.fd_event )
+            self.chip.release_line( self )
+        
+        LineHandle.close( self )
+    
+    
+    #----------------------------------------------------------------------------
+    def set_config( self, flags, debounce_us = 0, output = None ):
+        
+        self.flags = flags
+        self.debounce_us = debounce_us
+        
+        if output is not None:
+            self.set_value( output )
+    
+    
+    #----------------------------------------------------------------------------
+    def get_value( self ):
+        return self.chip.values[ self.offset ]
+    
+    
+    #----------------------------------------------------------------------------
+    def set_value( self, value ):
+        
+        if not self.flags & GPIO_V2_LINE_FLAG_OUTPUT:
+            raise IOError( "Line %d is not an output" % ( self.offset ))
+        
+        self.chip.values[ self.offset ] = 1 if value else 0
+    
+    
+    #----------------------------------------------------------------------------
+    def push_event( self, rising, timestamp_ns, seqno ):
+        
+        if rising and not self.flags & GPIO_V2_LINE_FLAG_EDGE_RISING:
+            return
+        
+        if not rising and not self.flags & GPIO_V2_LINE_FLAG_EDGE_FALLING:
+            return
+        
+        self.line_seqno += 1
+        
+        event_id = GPIO_V2_LINE_EVENT_RISING_EDGE if rising else GPIO_V2_LINE_EVENT_FALLING_EDGE
+        
+        ## Like the kernel, drop the event when the queue is full ##
+        try:
+            os.write( self.fd_event, GPIO_V2_LINE_EVENT.pack( timestamp_ns, event_id, self.offset,
+                                                              seqno, self.line_seqno ))
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+
+
+#=========================================================================================
+class FakeGPIOChip:
+    
+    #----------------------------------------------------------------------------
+    def __init__( self, nlines = 32 ):
+        
+        self.values = [ 0 ] * nlines
+        self.lines = {}
+        self.seqno = 0
+    
+    
+    #----------------------------------------------------------------------------
+    def request_line( self, offset, flags, debounce_us = 0, output = None, consumer = "" ):
+        
+        if offset in self.lines:
+            raise IOError( "Line %d is busy" % ( offset ))
+        
+        line = FakeLineHandle( self, offset, flags, debounce_us, output )
+        self.lines[ offset ] = line
+        
+        return line
+    
+    
+    #----------------------------------------------------------------------------
+    def release_line( self, line ):
+        
+        if self.lines.get( line.offset ) is line:
+            del self.lines[ line.offset ]
+    
+    
+    #----------------------------------------------------------------------------
+    def set_input( self, offset, value, timestamp_ns = None ):
+        
+        value = 1 if value else 0
+        
+        if self.values[ offset ] == value:
+            return
+        
+        self.values[ offset ] = value
+        
+        
+        ## Queue the edge event on the requested line ##
+        line = self.lines.get( offset )
+        
+        if line is not None and line.flags & GPIO_V2_LINE_FLAG_INPUT:
+            if timestamp_ns is None:
+                timestamp_ns = int( monotonic() * 1e9 )
+            
+            self.seqno += 1
+            
+            line.push_event( value == 1, timestamp_ns, self.seqno )
+
+
+
+#=========================================================================================
+class GPIOLine:
+    
+    PIN_INPUT   = GPIO.PIN_INPUT
+    PIN_OUTPUT  = GPIO.PIN_OUTPUT
+    PIN_LOW     = GPIO.PIN_LOW
+    PIN_HIGH    = GPIO.PIN_HIGH
+    
+    EDGE_NONE       = GPIO.EDGE_NONE
+    EDGE_RISING     = GPIO.EDGE_RISING
+    EDGE_FALLING    = GPIO.EDGE_FALLING
+    EDGE_BOTH       = GPIO.EDGE_BOTH
+    
+    
+    poll_edge = None
+    line = None
+    
+    
+    #----------------------------------------------------------------------------
+    def __init__( self, kernel_id, mode, chip = None, debounce_us = 0, consumer = "alarm-clock" ):
+        
+        self.kernel_id = kernel_id
+        
+        if not 0 <= kernel_id < 160:
+            raise ValueError( "Invalid gpio kernel id %d, not a line of PIOA..PIOE" % ( kernel_id ))
+        
+        ## Each chip drives a bank of 32 lines (PIOA..PIOE) ##
+        self.offset = kernel_id % 32
+        self.io_name = "%s%d" % ( "ABCDE"[ kernel_id / 32 ], self.offset )
+        
+        if chip is None:
+            chip = GPIOChipDevice( kernel_id / 32 )
+        
+        self.chip = chip
+        self.consumer = consumer
+        self.debounce_us = debounce_us
+        
+        self.mode = mode
+        self.edge = self.EDGE_NONE
+        
+        self.set_direction( mode )
+        self.export()
+    
+    
+    #----------------------------------------------------------------------------
+    def __del__( self ):
+        self.close()
+    
+    
+    #----------------------------------------------------------------------------
+    def close( self ):
+        
+        if self.poll_edge:
+            self.poll_edge.close()
+            self.poll_edge = None
+        
+        self.unexport()
+    
+    
+    #----------------------------------------------------------------------------
+    def fileno( self ):
+        return self.line.fileno()
+    
+    
+    #----------------------------------------------------------------------------
+    def line_config( self ):
+        
+        output = None
+        
+        if self.mode == self.PIN_INPUT:
+            flags = GPIO_V2_LINE_FLAG_INPUT
+            
+            if self.edge in ( self.EDGE_RISING, self.EDGE_BOTH ):
+                flags |= GPIO_V2_LINE_FLAG_EDGE_RISING
+            
+            if self.edge in ( self.EDGE_FALLING, self.EDGE_BOTH ):
+                flags |= GPIO_V2_LINE_FLAG_EDGE_FALLING
+            
+            debounce_us = self.debounce_us
+        
+        else:
+            flags = GPIO_V2_LINE_FLAG_OUTPUT
+            debounce_us = 0
+            
+            if self.mode == self.PIN_HIGH:
+                output = 1
+            elif self.mode == self.PIN_LOW:
+                output = 0
+        
+        return ( flags, debounce_us, output )
+    
+    
+    #----------------------------------------------------------------------------
+    def export( self ):
+        
+        if self.line is not None:
+            return
+        
+        flags, debounce_us, output = self.line_config()
+        
+        self.line = self.chip.request_line( self.offset, flags, debounce_us, output, self.consumer )
+    
+    
+    #----------------------------------------------------------------------------
+    def unexport( self ):
+        
+        if self.line is None:
+            return
+        
+        self.line.close()
+        self.line = None
+    
+    
+    #----------------------------------------------------------------------------
+    def update_config( self ):
+        
+        if self.line is None:
+            return
+        
+        flags, debounce_us, output = self.line_config()
+        
+        try:
+            self.line.set_config( flags, debounce_us, output )
+        
+        except IOError:
+            raise IOError( "Unable to configure line for gpio '%s'" % ( self.io_name ) )
+    
+    
+    #----------------------------------------------------------------------------
+    def set_direction( self, mode ):
+        
+        if not mode in ( self.PIN_INPUT, self.PIN_OUTPUT, self.PIN_LOW, self.PIN_HIGH ):
+            raise ValueError( "Invalid pin direction" )
+        
+        self.mode = mode
+        self.update_config()
+    
+    
+    #----------------------------------------------------------------------------
+    def get_direction( self ):
+        return self.PIN_INPUT if self.mode == self.PIN_INPUT else self.PIN_OUTPUT
+    
+    
+    #----------------------------------------------------------------------------
+    def set_edge( self, edge ):
+        
+        if not edge in ( self.EDGE_NONE, self.EDGE_RISING, self.EDGE_FALLING, self.EDGE_BOTH ):
+            raise ValueError( "Invalid edge parameter" )
+        
+        self.edge = edge
+        self.update_config()
+    
+    
+    #----------------------------------------------------------------------------
+    def get_edge( self ):
+        return self.edge
+    
+    
+    #----------------------------------------------------------------------------
+    def set_debounce( self, debounce_us ):
+        
+        self.debounce_us = debounce_us
+        self.update_config()
+    
+    
+    #----------------------------------------------------------------------------
+    def high( self ):
+        self.write( 1 )
+    
+    
+    #----------------------------------------------------------------------------
+    def low( self ):
+        self.write( 0 )
+    
+    
+    #----------------------------------------------------------------------------
+    def write( self, value ):
+        
+        try:
+            self.line.set_value( value )
+        
+        except IOError:
+            raise IOError( "Unable to write value of gpio '%s'" % ( self.io_name ) )
+    
+    
+    #----------------------------------------------------------------------------
+    def read( self ):
+        
+        try:
+            return self.line.get_value()
+        
+        except IOError:
+            raise IOError( "Unable to read value of gpio '%s'" % ( self.io_name ) )
+    
+    
+    #----------------------------------------------------------------------------
+    def read_events( self, max_events = 16 ):
+        return self.line.read_events( max_events )
+    
+    
+    #----------------------------------------------------------------------------
+    def wait_edge( self, timeout = -1 ):
+        
+        if self.poll_edge is None:
+            self.poll_edge = select.epoll()
+            self.poll_edge.register( self.line.fileno(), select.EPOLLIN )
+        
+        ## Return every edge queued so far ##
+        events = self.line.read_events()
+        
+        while not events:
+            if not self.poll_edge.poll( timeout ):
+                return []
+            
+            events = self.line.read_events()
+        
+        return events
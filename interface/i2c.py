@@ -0,0 +1,325 @@
+import os
+import ctypes
+import threading
+from fcntl import ioctl
+from contextlib import contextmanager
+
+from backend import is_simulated
+from clock import monotonic
+
+import metrics
+
+
+
+I2C_SLAVE   = 0x0703
+I2C_FUNCS   = 0x0705
+I2C_RDWR    = 0x0707
+
+I2C_FUNC_I2C = 0x00000001
+
+# i2c_msg flags
+I2C_M_RD = 0x0001
+
+# Maximum number of messages in a single I2C_RDWR transaction
+I2C_RDWR_IOCTL_MAX_MSGS = 42
+
+
+#----------------------------------------------------------------------------
+# struct i2c_msg
+#----------------------------------------------------------------------------
+class i2c_msg( ctypes.Structure ):
+    _fields_ = [
+        ( "addr", ctypes.c_uint16 ),
+        ( "flags", ctypes.c_uint16 ),
+        ( "len", ctypes.c_uint16 ),
+        ( "buf", ctypes.POINTER( ctypes.c_uint8 )),
+    ]
+
+
+#----------------------------------------------------------------------------
+# struct i2c_rdwr_ioctl_data
+#----------------------------------------------------------------------------
+class i2c_rdwr_ioctl_data( ctypes.Structure ):
+    _fields_ = [
+        ( "msgs", ctypes.POINTER( i2c_msg )),
+        ( "nmsgs", ctypes.c_uint32 ),
+    ]
+
+
+
+#=========================================================================================
+class I2CDevDevice:
+
+    #----------------------------------------------------------------------------
+    def __init__( self, bus ):
+
+        self.fd = None
+        self.fd = os.open( "/dev/i2c-%d" % bus, os.O_RDWR )
+
+
+    #----------------------------------------------------------------------------
+    def __del__( self ):
+        self.close()
+
+
+    #----------------------------------------------------------------------------
+    def close( self ):
+
+        if self.fd is not None:
+            os.close( self.fd )
+            self.fd = None
+
+
+    #----------------------------------------------------------------------------
+    def fileno( self ):
+        return self.fd
+
+
+    #----------------------------------------------------------------------------
+    def ioctl( self, request, arg, mutate = True ):
+        return ioctl( self.fd, request, arg, mutate )
+
+
+#----------------------------------------------------------------------------
+def open_device( bus ):
+
+    if is_simulated():
+        from sim import get_i2c_device
+        return get_i2c_device( bus )
+
+    return I2CDevDevice( bus )
+
+
+
+# Shared bus handles, indexed by bus number
+buses = {}
+buses_lock = threading.Lock()
+
+
+#----------------------------------------------------------------------------
+def get_bus( bus ):
+    
+    with buses_lock:
+        handle = buses.get( bus )
+        
+        if handle is None:
+            handle = I2CBus( bus )
+            buses[ bus ] = handle
+        
+        return handle
+
+
+
+#=========================================================================================
+class I2CBus:
+
+    # Size of the buffer holding the data of the queued messages
+    max_batch_bytes = 1024
+
+
+    #----------------------------------------------------------------------------
+    def __init__( self, bus, device = None ):
+
+        self.bus = bus
+
+        # i2c-dev node, or any object answering the same ioctls
+        if device is None:
+            device = open_device( bus )
+
+        self.device = device
+
+        ## Combined transactions need a plain I2C adapter ##
+        funcs = ctypes.c_ulong()
+        self.device.ioctl( I2C_FUNCS, funcs, True )
+
+        if not funcs.value & I2C_FUNC_I2C:
+            self.close()
+            raise IOError( "I2C bus %d does not support combined transactions" % bus )
+
+
+        ## Preallocated message queue ##
+        self.msgs = ( i2c_msg * I2C_RDWR_IOCTL_MAX_MSGS )()
+        self.data = ( ctypes.c_uint8 * self.max_batch_bytes )()
+        self.data_addr = ctypes.addressof( self.data )
+
+        self.request = i2c_rdwr_ioctl_data( self.msgs, 0 )
+
+        self.nmsgs = 0
+        self.used = 0
+        self.depth = 0
+        
+        # Held for a single call or for a whole batch
+        self.lock = threading.RLock()
+        
+        ## Counters ##
+        self.transactions = 0
+        self.messages = 0
+        self.bytes = 0
+        
+        name = "i2c-%d" % bus
+        self.metric_transaction = metrics.histogram( "i2c.transaction", name )
+        self.metric_bytes = metrics.counter( "i2c.bytes", name )
+        self.metric_errors = metrics.counter( "i2c.errors", name )
+
+
+    #----------------------------------------------------------------------------
+    def close( self ):
+        self.device.close()
+
+
+    #----------------------------------------------------------------------------
+    @contextmanager
+    def batch( self ):
+
+        # Messages queued until the outermost batch ends go out in a single
+        # transaction, with only one STOP condition at the end.
+        with self.lock:
+            self.depth += 1
+
+            try:
+                yield self
+
+            except:
+                self.depth -= 1
+
+                if not self.depth:
+                    self.nmsgs = 0
+                    self.used = 0
+                raise
+
+            self.depth -= 1
+
+            if not self.depth:
+                self.flush()
+
+
+    #----------------------------------------------------------------------------
+    @contextmanager
+    def priority( self, level ):
+
+        # Commands are sent in call order, see BusScheduler for prioritized sends
+        yield self
+
+
+    #----------------------------------------------------------------------------
+    def reserve( self, nmsgs, length ):
+
+        # Messages that must share a transaction, the queued ones are sent first
+        # when they do not fit behind them.
+        if length > self.max_batch_bytes:
+            raise ValueError( "I2CBus:queue: Message too long (%d bytes)" % length )
+
+        if self.nmsgs + nmsgs > I2C_RDWR_IOCTL_MAX_MSGS or self.used + length > self.max_batch_bytes:
+            self.flush()
+
+
+    #----------------------------------------------------------------------------
+    def queue( self, addr, flags, data = None, length = 0 ):
+
+        if data is not None:
+            length = len( data )
+
+        self.reserve( 1, length )
+
+        offset = self.used
+
+        if data is not None:
+            self.data[ offset:offset + length ] = data
+
+        msg = self.msgs[ self.nmsgs ]
+        msg.addr = addr
+        msg.flags = flags
+        msg.len = length
+        msg.buf = ctypes.cast( self.data_addr + offset, ctypes.POINTER( ctypes.c_uint8 ))
+
+        self.nmsgs += 1
+        self.used += length
+
+        return offset
+
+
+    #----------------------------------------------------------------------------
+    def flush( self ):
+
+        if not self.nmsgs:
+            return 0
+
+        self.request.nmsgs = self.nmsgs
+
+        start = monotonic() if metrics.enabled else None
+
+        try:
+            self.device.ioctl( I2C_RDWR, self.request )
+
+            self.transactions += 1
+            self.messages += self.nmsgs
+            self.bytes += self.used
+
+            if start is not None:
+                self.metric_transaction.observe( monotonic() - start )
+                self.metric_bytes.add( self.used )
+
+        except IOError:
+            if start is not None:
+                self.metric_errors.add()
+            raise
+
+        finally:
+            count = self.nmsgs
+
+            self.nmsgs = 0
+            self.used = 0
+
+        return count
+
+
+    #----------------------------------------------------------------------------
+    def get_stats( self ):
+
+        return {
+            "bus": self.bus,
+            "transactions": self.transactions,
+            "messages": self.messages,
+            "bytes": self.bytes,
+        }
+
+
+    #----------------------------------------------------------------------------
+    def write_byte_data( self, addr, reg, value ):
+
+        with self.lock:
+            self.queue( addr, 0, [ reg, value ] )
+
+            if not self.depth:
+                self.flush()
+
+
+    #----------------------------------------------------------------------------
+    def write_i2c_block_data( self, addr, reg, values ):
+
+        with self.lock:
+            self.queue( addr, 0, [ reg ] + list( values ))
+
+            if not self.depth:
+                self.flush()
+
+
+    #----------------------------------------------------------------------------
+    def read_i2c_block_data( self, addr, reg, length ):
+
+        # The read completes the pending transaction, after the register
+        # pointer write with a repeated start.
+        with self.lock:
+            self.reserve( 2, 1 + length )
+
+            self.queue( addr, 0, [ reg ] )
+            offset = self.queue( addr, I2C_M_RD, length = length )
+
+            self.flush()
+
+            return self.data[ offset:offset + length ]
+
+
+    #----------------------------------------------------------------------------
+    def read_byte_data( self, addr, reg ):
+        return self.read_i2c_block_data( addr, reg, 1 )[0]
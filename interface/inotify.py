@@ -0,0 +1,92 @@
+import os
+import errno
+import ctypes
+from struct import Struct
+
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+# struct inotify_event, followed by the name ( len bytes, nul padded )
+INOTIFY_EVENT = Struct( "=iIII" )
+
+libc = ctypes.CDLL( None, use_errno = True )
+
+
+
+#=========================================================================================
+class INotify:
+    
+    #----------------------------------------------------------------------------
+    def __init__( self ):
+        
+        self.fd = libc.inotify_init1( IN_NONBLOCK | IN_CLOEXEC )
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError( err, os.strerror( err ))
+    
+    
+    #----------------------------------------------------------------------------
+    def __del__( self ):
+        self.close()
+    
+    
+    #----------------------------------------------------------------------------
+    def close( self ):
+        
+        if self.fd is not None:
+            os.close( self.fd )
+            self.fd = None
+    
+    
+    #----------------------------------------------------------------------------
+    def fileno( self ):
+        return self.fd
+    
+    
+    #----------------------------------------------------------------------------
+    def add_watch( self, path, mask ):
+        
+        wd = libc.inotify_add_watch( self.fd, path, mask )
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError( err, os.strerror( err ), path )
+        
+        return wd
+    
+    
+    #----------------------------------------------------------------------------
+    def read( self ):
+        
+        try:
+            data = os.read( self.fd, 4096 )
+        
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            
+            raise
+        
+        
+        ## ( wd, mask, cookie, name ) ##
+        events = []
+        offset = 0
+        
+        while offset < len( data ):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from( data, offset )
+            offset += INOTIFY_EVENT.size
+            
+            name = data[ offset:offset + length ].rstrip( "\0" )
+            offset += length
+            
+            events.append(( wd, mask, cookie, name ))
+        
+        return events
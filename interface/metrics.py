@@ -0,0 +1,305 @@
+import os
+import json
+import errno
+import socket
+import threading
+from bisect import bisect_left
+
+from clock import monotonic
+
+
+# Collection is off unless enabled here or with enable()
+METRICS_ENV = "ALARM_CLOCK_METRICS"
+METRICS_FILE_ENV = "ALARM_CLOCK_METRICS_FILE"
+METRICS_SOCKET_ENV = "ALARM_CLOCK_METRICS_SOCKET"
+
+# Upper bounds of the latency buckets (seconds), the last bucket is unbounded
+LATENCY_BUCKETS = ( 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0 )
+
+DEF_INTERVAL = 10
+
+
+# Checked by the instrumented code before taking any measure
+enabled = os.environ.get( METRICS_ENV, "" ) not in ( "", "0" )
+
+
+#----------------------------------------------------------------------------
+def enable():
+    global enabled
+    enabled = True
+
+
+#----------------------------------------------------------------------------
+def disable():
+    global enabled
+    enabled = False
+
+
+
+#=========================================================================================
+class Metric:
+
+    # Each thread updates its own shard without locking, shards are summed
+    # when a snapshot is taken.
+
+    #----------------------------------------------------------------------------
+    def __init__( self, name, device, size ):
+
+        self.name = name
+        self.device = device
+        self.size = size
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+
+
+    #----------------------------------------------------------------------------
+    def shard( self ):
+
+        try:
+            return self.local.shard
+
+        except AttributeError:
+            shard = [ 0 ] * self.size
+
+            with self.lock:
+                self.shards.append( shard )
+
+            self.local.shard = shard
+            return shard
+
+
+    #----------------------------------------------------------------------------
+    def totals( self ):
+
+        with self.lock:
+            shards = list( self.shards )
+
+        return [ sum( values ) for values in zip( *shards ) ] or [ 0 ] * self.size
+
+
+
+#=========================================================================================
+class Counter( Metric ):
+
+    #----------------------------------------------------------------------------
+    def __init__( self, name, device = "" ):
+        Metric.__init__( self, name, device, 1 )
+
+
+    #----------------------------------------------------------------------------
+    def add( self, value = 1 ):
+        self.shard()[0] += value
+
+
+    #----------------------------------------------------------------------------
+    def snapshot( self ):
+        return self.totals()[0]
+
+
+
+#=========================================================================================
+class Histogram( Metric ):
+
+    #----------------------------------------------------------------------------
+    def __init__( self, name, device = "", buckets = LATENCY_BUCKETS ):
+
+        self.buckets = tuple( buckets )
+
+        # Bucket counts, then the sum and count of the observed values
+        Metric.__init__( self, name, device, len( self.buckets ) + 3 )
+
+
+    #----------------------------------------------------------------------------
+    def observe( self, value ):
+
+        shard = self.shard()
+
+        shard[ bisect_left( self.buckets, value ) ] += 1
+        shard[ -2 ] += value
+        shard[ -1 ] += 1
+
+
+    #----------------------------------------------------------------------------
+    def observe_since( self, start ):
+        self.observe( monotonic() - start )
+
+
+    #----------------------------------------------------------------------------
+    def snapshot( self ):
+
+        totals = self.totals()
+
+        return {
+            "buckets": [ [ bound, count ] for bound, count in zip( self.buckets + ( None, ), totals[ :-2 ] ) ],
+            "sum": totals[ -2 ],
+            "count": totals[ -1 ],
+        }
+
+
+
+#=========================================================================================
+class Registry:
+
+    #----------------------------------------------------------------------------
+    def __init__( self ):
+
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.start = monotonic()
+
+
+    #----------------------------------------------------------------------------
+    def get( self, cls, name, device, *args ):
+
+        key = ( name, device )
+
+        with self.lock:
+            metric = self.metrics.get( key )
+
+            if metric is None:
+                metric = cls( name, device, *args )
+                self.metrics[ key ] = metric
+
+            elif not isinstance( metric, cls ):
+                raise ValueError( "Metric '%s' (%s) is already registered as a %s" %
+                                  ( name, device, metric.__class__.__name__ ))
+
+        return metric
+
+
+    #----------------------------------------------------------------------------
+    def counter( self, name, device = "" ):
+        return self.get( Counter, name, device )
+
+
+    #----------------------------------------------------------------------------
+    def histogram( self, name, device = "", buckets = LATENCY_BUCKETS ):
+        return self.get( Histogram, name, device, buckets )
+
+
+    #----------------------------------------------------------------------------
+    def snapshot( self ):
+
+        with self.lock:
+            metrics = self.metrics.values()
+
+        counters = {}
+        histograms = {}
+
+        for metric in metrics:
+            table = counters if isinstance( metric, Counter ) else histograms
+            table.setdefault( metric.name, {} )[ metric.device ] = metric.snapshot()
+
+        return {
+            "enabled": enabled,
+            "uptime": monotonic() - self.start,
+            "pid": os.getpid(),
+            "counters": counters,
+            "histograms": histograms,
+        }
+
+
+    #----------------------------------------------------------------------------
+    def dumps( self ):
+        return json.dumps( self.snapshot(), sort_keys = True )
+
+
+registry = Registry()
+
+
+#----------------------------------------------------------------------------
+def counter( name, device = "" ):
+    return registry.counter( name, device )
+
+
+#----------------------------------------------------------------------------
+def histogram( name, device = "", buckets = LATENCY_BUCKETS ):
+    return registry.histogram( name, device, buckets )
+
+
+#----------------------------------------------------------------------------
+def snapshot():
+    return registry.snapshot()
+
+
+
+#----------------------------------------------------------------------------
+# Exporters, served from the application reactor
+#----------------------------------------------------------------------------
+def write_snapshot( path ):
+
+    ## Readers never see a partial file ##
+    tmp = path + ".tmp"
+
+    with open( tmp, "w" ) as f:
+        f.write( registry.dumps() )
+
+    os.rename( tmp, path )
+
+
+#----------------------------------------------------------------------------
+def export_file( reactor, path, interval = DEF_INTERVAL ):
+
+    # Rewrites the snapshot file every interval seconds
+    def update():
+        try:
+            write_snapshot( path )
+        except ( IOError, OSError ):
+            pass
+
+    update()
+
+    return reactor.add_timer( update, interval, interval )
+
+
+#----------------------------------------------------------------------------
+def export_socket( reactor, path ):
+
+    # Each connection receives a snapshot, then is closed
+    try:
+        os.unlink( path )
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    server = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    server.bind( path )
+    server.listen( 4 )
+    server.setblocking( False )
+
+    def accept():
+        try:
+            conn, addr = server.accept()
+        except socket.error:
+            return
+
+        try:
+            conn.setblocking( True )
+            conn.settimeout( 1.0 )
+            conn.sendall( registry.dumps() + "\n" )
+
+        except socket.error:
+            pass
+
+        finally:
+            conn.close()
+
+    reactor.add_reader( server, accept )
+
+    return server
+
+
+#----------------------------------------------------------------------------
+def export( reactor ):
+
+    # Exporters configured in the environment
+    path = os.environ.get( METRICS_FILE_ENV )
+    if path:
+        export_file( reactor, path )
+
+    path = os.environ.get( METRICS_SOCKET_ENV )
+    if path:
+        export_socket( reactor, path )
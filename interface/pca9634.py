@@ -1,4 +1,6 @@
-import smbus
+import threading
+
+from i2c import get_bus
 
 
 #----------------------------------------------------------------------------
@@ -25,6 +27,21 @@ REG_ALLCALLADDR = 0x11
 
 REG_AUTOINCREMENT = 0x80
 
+# Registers held in the shadow register file (MODE1..LEDOUT1)
+NUM_SHADOW_REGS = REG_LEDOUT1 + 1
+
+# Clean registers rewritten to join two dirty ranges in a single block write
+MAX_WRITE_GAP = 2
+
+
+#----------------------------------------------------------------------------
+# Power-on group addresses, with the mode register 1 bit enabling each
+#----------------------------------------------------------------------------
+DEF_ALLCALL_ADDR = 0x70
+DEF_SUBADR1 = 0x71
+DEF_SUBADR2 = 0x72
+DEF_SUBADR3 = 0x74
+
 
 #----------------------------------------------------------------------------
 # Mode register 1 options
@@ -50,6 +67,8 @@ MODE_NO_SUB3 = 0x00
 MODE_ALLCALL = 0x01
 MODE_NO_ALLCALL = 0x00
 
+MODE_GROUP_MASK = MODE_SUB1 | MODE_SUB2 | MODE_SUB3 | MODE_ALLCALL
+
 
 #----------------------------------------------------------------------------
 # Mode register 2 options
@@ -76,19 +95,83 @@ STATE_PWM = 0x02
 STATE_PWM_GLOBAL = 0x03
 
 
+DEF_GROUPS = (
+    ( DEF_ALLCALL_ADDR, MODE_ALLCALL ),
+    ( DEF_SUBADR3, MODE_SUB3 ),
+    ( DEF_SUBADR1, MODE_SUB1 ),
+    ( DEF_SUBADR2, MODE_SUB2 ),
+)
+
+
+#----------------------------------------------------------------------------
+def block_ranges( needed, writable ):
+    
+    ranges = []
+    
+    for reg in range( NUM_SHADOW_REGS ):
+        if not ( needed >> reg ) & 0x01:
+            continue
+        
+        ## Join the previous range if the registers in between can be rewritten ##
+        if ranges:
+            gap = reg - ranges[ -1 ][ 1 ]
+            mask = (( 1 << gap ) - 1 ) << ranges[ -1 ][ 1 ]
+            
+            if gap <= MAX_WRITE_GAP and ( writable & mask ) == mask:
+                ranges[ -1 ][ 1 ] = reg + 1
+                continue
+        
+        ranges.append([ reg, reg + 1 ])
+    
+    return ranges
+
+
+#----------------------------------------------------------------------------
+def ranges_mask( ranges ):
+    
+    mask = 0x00
+    
+    for start, end in ranges:
+        mask |= (( 1 << ( end - start )) - 1 ) << start
+    
+    return mask
+
+
+#----------------------------------------------------------------------------
+def pack_led_state( led_state ):
+    
+    reg0 = led_state[0] & 0x3 | \
+           ( led_state[1] & 0x3 ) << 2 | \
+           ( led_state[2] & 0x3 ) << 4 | \
+           ( led_state[3] & 0x3 ) << 6
+    
+    reg1 = led_state[4] & 0x3 | \
+           ( led_state[5] & 0x3 ) << 2 | \
+           ( led_state[6] & 0x3 ) << 4 | \
+           ( led_state[7] & 0x3 ) << 6
+    
+    return ( reg0, reg1 )
+
+
+
 #=========================================================================================
 class PCA9634:
 
     #----------------------------------------------------------------------------
     def __init__( self, bus, address, initialize = False, logic_inverted = False, 
                   outdrv_totem = True, low_power = False, 
-                  def_led_state = STATE_ON ):
+                  def_led_state = STATE_ON, broadcast = False ):
         
         
         self.led_state = [ 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00 ]
         
         self.address = address
-        self.smbus = smbus.SMBus( bus )
+        
+        # Bus number, or a bus object shared between chips (SMBus compatible)
+        if isinstance( bus, int ):
+            self.smbus = get_bus( bus )
+        else:
+            self.smbus = bus
         
         self.def_led_state = def_led_state
         self.low_power = low_power
@@ -103,6 +186,23 @@ class PCA9634:
         self.enable_allcall = True
         
         
+        ## Shadow register file ##
+        self.regs = [ 0x00 ] * NUM_SHADOW_REGS
+        self.known = 0x00
+        self.dirty = 0x00
+        
+        # Mode register 1 as last sent, selects the group addresses the chip answers
+        self.mode1_written = None
+        
+        # Sub-address or all call address shared by several chips, the registers 
+        # may be changed through the chips own address and are never cached.
+        self.broadcast = broadcast
+        
+        # Guards the shadow, the bus lock when there is one so that a caller 
+        # holding it may stage and send a batch as a whole.
+        self.lock = getattr( self.smbus, "lock", None ) or threading.RLock()
+        
+        
         if initialize:
             self.set_mode()
         
@@ -110,7 +210,113 @@ class PCA9634:
 
 
     #----------------------------------------------------------------------------
-    def set_mode( self ):
+    def write_reg( self, reg, value ):
+        
+        bit = 1 << reg
+        
+        with self.lock:
+            if ( self.known & bit ) and self.regs[ reg ] == value:
+                return
+            
+            self.regs[ reg ] = value
+            self.dirty |= bit
+    
+    
+    #----------------------------------------------------------------------------
+    def dirty_ranges( self ):
+        return block_ranges( self.dirty, self.known )
+    
+    
+    #----------------------------------------------------------------------------
+    def flush( self ):
+        
+        with self.lock:
+            if not self.dirty:
+                return 0
+            
+            ranges = self.dirty_ranges()
+            
+            for start, end in ranges:
+                sent = self.write_block( self.address, start, self.regs[ start:end ] )
+                self.mark_written( ranges_mask([( start, end )]), sent )
+            
+            return len( ranges )
+    
+    
+    #----------------------------------------------------------------------------
+    def mark_written( self, mask, pending = None ):
+        
+        # Writes queued by a scheduler (pending Future) are known once they are sent
+        with self.lock:
+            self.dirty &= ~mask
+            
+            mode1 = self.regs[ REG_MODE_1 ]
+            
+            if pending is None:
+                self.mark_sent( mask, mode1 )
+            else:
+                pending.add_done_callback( lambda future: self.write_done( future, mask, mode1 ))
+    
+    
+    #----------------------------------------------------------------------------
+    def write_done( self, future, mask, mode1 ):
+        
+        if future.error is not None:
+            self.mark_unknown( mask )
+        else:
+            self.mark_sent( mask, mode1 )
+    
+    
+    #----------------------------------------------------------------------------
+    def mark_sent( self, mask, mode1 ):
+        
+        with self.lock:
+            if mask & ( 1 << REG_MODE_1 ):
+                self.mode1_written = mode1
+            
+            if not self.broadcast:
+                self.known |= mask
+    
+    
+    #----------------------------------------------------------------------------
+    def mark_unknown( self, mask ):
+        
+        # A transaction holding these registers failed, they may or may not have 
+        # reached the chip and are sent again by the next flush.
+        with self.lock:
+            if mask & ( 1 << REG_MODE_1 ):
+                self.mode1_written = None
+            
+            self.known &= ~mask
+            self.dirty |= mask
+    
+    
+    #----------------------------------------------------------------------------
+    def write_block( self, address, start, values ):
+        
+        if len( values ) == 1:
+            return self.smbus.write_byte_data( address, start, values[0] )
+        else:
+            return self.smbus.write_i2c_block_data( address, start | REG_AUTOINCREMENT, values )
+    
+    
+    #----------------------------------------------------------------------------
+    def group_member( self, mode_bit ):
+        
+        if self.broadcast:
+            return False
+        
+        # Unknown while never set or while its group addresses are being changed
+        written = self.mode1_written
+        
+        if written is None or ( written ^ self.regs[ REG_MODE_1 ] ) & MODE_GROUP_MASK:
+            return None
+        
+        return bool( written & mode_bit )
+    
+    
+    #----------------------------------------------------------------------------
+    def set_mode( self, update = True ):
         
         mode1 = 0x80
         mode2 = 0x01
@@ -143,21 +349,32 @@ class PCA9634:
         if self.group_blinking:
             mode2 |= MODE_GROUP_BLINKING
         
-        self.smbus.write_byte_data( self.address, REG_MODE_1, mode1 )
-        self.smbus.write_byte_data( self.address, REG_MODE_2, mode2 )
+        self.write_reg( REG_MODE_1, mode1 )
+        self.write_reg( REG_MODE_2, mode2 )
+        
+        if update:
+            self.flush()
         
     #----------------------------------------------------------------------------
-    def set_led_pwm( self, id, value ):
+    def set_led_pwm( self, id, value, update = True ):
         
         if id < 0 or id > 7:
             raise ValueError('PCA9634:set_led_pwm: Invalid led ID')
         
-        self.smbus.write_byte_data( self.address, REG_PWM0 + id, value )
+        self.write_reg( REG_PWM0 + id, value )
+        
+        if update:
+            self.flush()
 
 
     #----------------------------------------------------------------------------
-    def set_all_led_pwm( self, value ):
-        self.smbus.write_i2c_block_data( self.address, REG_PWM0 | REG_AUTOINCREMENT, [value] * 8 )
+    def set_all_led_pwm( self, value, update = True ):
+        
+        for id in range( 8 ):
+            self.write_reg( REG_PWM0 + id, value )
+        
+        if update:
+            self.flush()
 
 
     #----------------------------------------------------------------------------
@@ -165,14 +382,14 @@ class PCA9634:
         if id < 0 or id > 7:
             raise ValueError('PCA9634:set_led_state: Invalid led ID')
             
-        self.led_state[id] = state
-        
-        if update:
-            self.update_led_state()
+        with self.lock:
+            self.led_state[id] = state
+            
+            self.update_led_state( update )
 
 
     #----------------------------------------------------------------------------
-    def set_group_pwm( self, value ):
+    def set_group_pwm( self, value, update = True ):
         
         if value < 0 or value > 255:
             raise ValueError('PCA9634:set_group_pwm: Invalid pwm value (0-255)')
@@ -180,12 +397,15 @@ class PCA9634:
         # Set the group control to dimming mode
         if self.group_blinking:
             self.group_blinking = False
-            self.set_mode()
+            self.set_mode( False )
+        
+        self.write_reg( REG_GRPPWM, value )
         
-        self.smbus.write_byte_data( self.address, REG_GRPPWM, value )
+        if update:
+            self.flush()
 
     #----------------------------------------------------------------------------
-    def set_group_blink( self, period, duty ):
+    def set_group_blink( self, period, duty, update = True ):
         
         if duty < 0 or duty > 255:
             raise ValueError('PCA9634:set_group_blink: Invalid duty value (0-255)')
@@ -196,27 +416,171 @@ class PCA9634:
         # Set the group control to blinking mode
         if not self.group_blinking:
             self.group_blinking = True
-            self.set_mode()
+            self.set_mode( False )
+        
+        self.write_reg( REG_GRPFREQ, period )
+        self.write_reg( REG_GRPPWM, duty )
         
-        self.smbus.write_byte_data( self.address, REG_GRPFREQ, period )
-        self.smbus.write_byte_data( self.address, REG_GRPPWM, duty )
+        if update:
+            self.flush()
 
 
     #----------------------------------------------------------------------------
-    def update_led_state( self ):
-        reg0 = self.led_state[0] & 0x3 | \
-               ( self.led_state[1] & 0x3 ) << 2 | \
-               ( self.led_state[2] & 0x3 ) << 4 | \
-               ( self.led_state[3] & 0x3 ) << 6
+    def update_led_state( self, update = True ):
+        
+        with self.lock:
+            reg0, reg1 = pack_led_state( self.led_state )
+            
+            self.write_reg( REG_LEDOUT0, reg0 )
+            self.write_reg( REG_LEDOUT1, reg1 )
+        
+        if update:
+            self.flush()
+
+
+
+#=========================================================================================
+class WritePlanner:
+    
+    #----------------------------------------------------------------------------
+    def __init__( self, chips, groups = DEF_GROUPS ):
+        
+        self.chips = chips
+        self.groups = groups
+        
+        # Group writes update the shadows of several chips, all on the same bus
+        self.lock = chips[0].lock if chips else threading.RLock()
+    
+    
+    #----------------------------------------------------------------------------
+    def group_ranges( self, members, known, dirty ):
+        
+        # Members are indexes in chips, known / dirty are indexed the same way
+        
+        ## Registers dirty on two members or more ##
+        seen = 0x00
+        shared = 0x00
+        
+        for i in members:
+            shared |= seen & dirty[ i ]
+            seen |= dirty[ i ]
+        
+        if not shared:
+            return []
+        
+        
+        ## Of those, the ones holding the same value on every member ##
+        writable = 0x00
+        needed = 0x00
+        
+        regs = [ self.chips[ i ].regs for i in members ]
+        present = [ known[ i ] | dirty[ i ] for i in members ]
+        
+        for reg in range(( shared & -shared ).bit_length() - 1, shared.bit_length() ):
+            bit = 1 << reg
+            value = regs[0][ reg ]
+            
+            for n in range( len( members )):
+                if not present[ n ] & bit or regs[ n ][ reg ] != value:
+                    break
+            else:
+                writable |= bit
+                needed |= shared & bit
+        
+        return block_ranges( needed, writable )
+    
+    
+    #----------------------------------------------------------------------------
+    def plan( self ):
+        
+        chips = self.chips
+        dirty = [ chip.dirty for chip in chips ]
+        
+        # Nothing to share when a single chip has pending writes
+        if len( dirty ) - dirty.count( 0 ) < 2:
+            return []
+        
+        known = [ chip.known for chip in chips ]
+        
+        members = []
+        for address, mode_bit in self.groups:
+            group = []
+            
+            # Every chip must be known to answer the address or to ignore it
+            for i, chip in enumerate( chips ):
+                member = chip.group_member( mode_bit )
+                
+                if member is None:
+                    break
+                
+                if member:
+                    group.append( i )
+            else:
+                if len( group ) > 1:
+                    members.append(( address, group ))
+        
         
-        reg1 = self.led_state[4] & 0x3 | \
-               ( self.led_state[5] & 0x3 ) << 2 | \
-               ( self.led_state[6] & 0x3 ) << 4 | \
-               ( self.led_state[7] & 0x3 ) << 6
+        ## Pick the group write saving the most transactions, until none does ##
         
-        self.smbus.write_i2c_block_data( self.address, 
-                                         REG_LEDOUT0 | REG_AUTOINCREMENT, 
-                                         [ reg0, reg1 ])
+        # Transactions left to each chip, only the members of a group write change
+        costs = [ len( block_ranges( dirty[ i ], known[ i ] )) for i in range( len( chips )) ]
+        writes = []
+        
+        while True:
+            best = None
+            best_gain = 0
+            
+            for address, group in members:
+                ranges = self.group_ranges( group, known, dirty )
+                if not ranges:
+                    continue
+                
+                mask = ranges_mask( ranges )
+                new_costs = [ len( block_ranges( dirty[ i ] & ~mask, known[ i ] | mask )) for i in group ]
+                
+                gain = sum([ costs[ i ] for i in group ]) - sum( new_costs ) - len( ranges )
+                
+                if gain > best_gain:
+                    best_gain = gain
+                    best = ( address, group, ranges, mask, new_costs )
+            
+            if best is None:
+                break
+            
+            address, group, ranges, mask, new_costs = best
+            
+            for i, cost in zip( group, new_costs ):
+                known[ i ] |= mask
+                dirty[ i ] &= ~mask
+                costs[ i ] = cost
+            
+            writes.append(( address, [ chips[ i ] for i in group ], ranges ))
+        
+        return writes
+    
+    
+    #----------------------------------------------------------------------------
+    def flush( self ):
+        
+        count = 0
+        
+        with self.lock:
+            for address, group, ranges in self.plan():
+                chip = group[0]
+                
+                for start, end in ranges:
+                    sent = chip.write_block( address, start, chip.regs[ start:end ] )
+                    mask = ranges_mask([( start, end )])
+                    
+                    for member in group:
+                        member.mark_written( mask, sent )
+                
+                count += len( ranges )
+            
+            for chip in self.chips:
+                count += chip.flush()
+        
+        return count
 
 
 
@@ -246,20 +610,111 @@ class Digit( PCA9634 ):
         "H" : [ 0, 0, 1, 1, 0, 1, 1, 1 ],
         "L" : [ 0, 0, 0, 0, 1, 1, 1, 0 ],
         "U" : [ 0, 1, 1, 1, 1, 1, 1, 0 ],
+        "G" : [ 0, 1, 0, 1, 1, 1, 1, 0 ],
+        "I" : [ 0, 0, 0, 0, 0, 1, 1, 0 ],
+        "J" : [ 0, 0, 1, 1, 1, 1, 0, 0 ],
+        "P" : [ 0, 1, 1, 0, 0, 1, 1, 1 ],
+        "S" : [ 0, 1, 0, 1, 1, 0, 1, 1 ],
+        "b" : [ 0, 0, 0, 1, 1, 1, 1, 1 ],
+        "c" : [ 0, 0, 0, 0, 1, 1, 0, 1 ],
+        "d" : [ 0, 0, 1, 1, 1, 1, 0, 1 ],
+        "h" : [ 0, 0, 0, 1, 0, 1, 1, 1 ],
+        "n" : [ 0, 0, 0, 1, 0, 1, 0, 1 ],
+        "o" : [ 0, 0, 0, 1, 1, 1, 0, 1 ],
+        "r" : [ 0, 0, 0, 0, 0, 1, 0, 1 ],
+        "t" : [ 0, 0, 0, 0, 1, 1, 1, 1 ],
+        "u" : [ 0, 0, 0, 1, 1, 1, 0, 0 ],
+        "y" : [ 0, 0, 1, 1, 1, 0, 1, 1 ],
+        "=" : [ 0, 0, 0, 0, 1, 0, 0, 1 ],
     }
     
+    # Segment names, in led order
+    segment_names = ".abcdefg"
+    
+    # Compiled fonts, indexed by def_led_state
+    glyph_cache = {}
+    
+    
     #----------------------------------------------------------------------------
-    def set_digit( self, character ):
+    @classmethod
+    def load_font( cls, path ):
+        
+        try:
+            with open( path, "r" ) as f:
+                lines = f.read().splitlines()
+            
+        except IOError:
+            raise IOError( "Unable to read font file '%s'" % ( path ))
         
-        if not character in self.char_table:
-            character = " "
         
-        states = self.char_table[ character ]
+        ## <character> <segments>, segments as 8 bits or segment names (a-g) ##
+        table = dict( cls.char_table )
         
-        for index, item in enumerate(states):
-            if item:
-                self.led_state[index] = self.def_led_state
+        for line in lines:
+            if not line.strip():
+                continue
+            
+            character = line[0]
+            segments = line[ 1: ].strip()
+            
+            if len( segments ) == 8 and not segments.strip( "01" ):
+                states = [ int( c ) for c in segments ]
+            
+            elif not segments.strip( cls.segment_names ):
+                states = [ 1 if name in segments else 0 for name in cls.segment_names ]
+            
             else:
-                self.led_state[index] = STATE_OFF
+                raise ValueError( "Invalid segments for character '%s' in font '%s'" % ( character, path ))
+            
+            table[ character ] = states
+        
+        cls.char_table = table
+        cls.glyph_cache.clear()
+    
+    
+    #----------------------------------------------------------------------------
+    def compile_font( self ):
+        
+        key = self.def_led_state
+        
+        glyphs = {}
+        
+        for character, states in self.char_table.items():
+            led_state = tuple([ self.def_led_state if item else STATE_OFF for item in states ])
+            
+            glyphs[ character ] = pack_led_state( led_state ) + ( led_state, )
+        
+        self.glyph_cache[ key ] = glyphs
+        
+        return glyphs
+    
+    
+    #----------------------------------------------------------------------------
+    def get_glyph( self, character ):
         
-        self.update_led_state()
\ No newline at end of file
+        glyphs = self.glyph_cache.get( self.def_led_state )
+        if glyphs is None:
+            glyphs = self.compile_font()
+        
+        glyph = glyphs.get( character )
+        if glyph is None:
+            glyph = glyphs[ " " ]
+        
+        return glyph
+    
+    
+    #----------------------------------------------------------------------------
+    def set_glyph( self, glyph, update = True ):
+        
+        with self.lock:
+            reg0, reg1, self.led_state[:] = glyph
+            
+            self.write_reg( REG_LEDOUT0, reg0 )
+            self.write_reg( REG_LEDOUT1, reg1 )
+        
+        if update:
+            self.flush()    
+    
+    #----------------------------------------------------------------------------
+    def set_digit( self, character, update = True ):
+        self.set_glyph( self.get_glyph( character ), update )
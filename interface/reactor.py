@@ -0,0 +1,195 @@
+import os
+import time
+import errno
+import select
+
+from timerfd import TimerFD
+from timerfd import CLOCK_MONOTONIC
+from timerfd import CLOCK_REALTIME
+from timerfd import TFD_TIMER_ABSTIME
+from timerfd import TFD_TIMER_CANCEL_ON_SET
+
+from inotify import INotify
+from inotify import IN_CLOSE_WRITE
+from inotify import IN_MOVED_TO
+from inotify import IN_CREATE
+from inotify import IN_ATTRIB
+
+from clock import monotonic
+
+
+# Timezone definition read by the C library
+LOCALTIME_PATH = "/etc/localtime"
+
+
+
+#=========================================================================================
+class Reactor:
+    
+    #----------------------------------------------------------------------------
+    def __init__( self ):
+        
+        self.poll = select.epoll()
+        self.handlers = {}
+        self.running = False
+        
+        # Monotonic time the handlers being called were woken up, None outside 
+        # of a dispatch. Stands for the event time of sources without a timestamp.
+        self.wakeup = None
+    
+    
+    #----------------------------------------------------------------------------
+    def close( self ):
+        
+        self.poll.close()
+        self.handlers = {}
+    
+    
+    #----------------------------------------------------------------------------
+    def add_reader( self, fileobj, callback, events = select.EPOLLIN ):
+        
+        fd = fileobj if type( fileobj ) is int else fileobj.fileno()
+        
+        if fd in self.handlers:
+            raise ValueError( "File descriptor %d is already registered" % ( fd ))
+        
+        self.poll.register( fd, events )
+        self.handlers[ fd ] = callback
+        
+        return fd
+    
+    
+    #----------------------------------------------------------------------------
+    def remove( self, fileobj ):
+        
+        fd = fileobj if type( fileobj ) is int else fileobj.fileno()
+        
+        if fd in self.handlers:
+            self.poll.unregister( fd )
+            del self.handlers[ fd ]
+    
+    
+    #----------------------------------------------------------------------------
+    def add_gpio( self, gpio, callback ):
+        
+        ## Character device lines queue edge events, sysfs pins raise POLLPRI ##
+        if hasattr( gpio, "read_events" ):
+            events = select.EPOLLIN
+        else:
+            events = select.EPOLLPRI | select.EPOLLET
+        
+        return self.add_reader( gpio, callback, events )
+    
+    
+    #----------------------------------------------------------------------------
+    def add_timer( self, callback, value, interval = 0, clock_id = CLOCK_MONOTONIC, 
+                   flags = 0 ):
+        
+        timer = TimerFD( clock_id )
+        timer.set( value, interval, flags )
+        
+        def expired():
+            if timer.read():
+                callback()
+        
+        self.add_reader( timer, expired )
+        
+        return timer
+    
+    
+    #----------------------------------------------------------------------------
+    def add_wallclock_timer( self, callback, period = 60, watch_timezone = True ):
+        
+        # Fires on each multiple of period in wall clock time, and right away when
+        # the clock is set or the timezone changes.
+        timer = TimerFD( CLOCK_REALTIME )
+        
+        def arm():
+            deadline = ( int( time.time() ) // period + 1 ) * period
+            timer.set( deadline, 0, TFD_TIMER_ABSTIME | TFD_TIMER_CANCEL_ON_SET )
+        
+        def expired():
+            try:
+                if not timer.read():
+                    return
+            
+            except OSError as e:
+                if e.errno != errno.ECANCELED:
+                    raise
+                
+                time.tzset()
+            
+            callback()
+            arm()
+        
+        arm()
+        self.add_reader( timer, expired )
+        
+        
+        ## The timezone is replaced without touching the clock ##
+        if watch_timezone:
+            timer.inotify = INotify()
+            timer.inotify.add_watch( os.path.dirname( LOCALTIME_PATH ), 
+                                     IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ATTRIB )
+            
+            name = os.path.basename( LOCALTIME_PATH )
+            
+            def timezone_changed():
+                events = timer.inotify.read()
+                
+                if any([ event[3] == name for event in events ]):
+                    time.tzset()
+                    
+                    callback()
+                    arm()
+            
+            self.add_reader( timer.inotify, timezone_changed )
+        
+        return timer
+    
+    
+    #----------------------------------------------------------------------------
+    def remove_timer( self, timer ):
+        
+        inotify = getattr( timer, "inotify", None )
+        
+        if inotify is not None:
+            self.remove( inotify )
+            inotify.close()
+        
+        self.remove( timer )
+        timer.close()
+    
+    
+    #----------------------------------------------------------------------------
+    def run_once( self, timeout = -1 ):
+        
+        ready = self.poll.poll( timeout )
+        
+        self.wakeup = monotonic()
+        
+        try:
+            for fd, events in ready:
+                
+                # The handler may have been removed by a previous one
+                callback = self.handlers.get( fd )
+                
+                if callback is not None:
+                    callback()
+        
+        finally:
+            self.wakeup = None
+    
+    
+    #----------------------------------------------------------------------------
+    def run( self ):
+        
+        self.running = True
+        
+        while self.running:
+            self.run_once()
+    
+    
+    #----------------------------------------------------------------------------
+    def stop( self ):
+        self.running = False
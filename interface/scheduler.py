@@ -0,0 +1,474 @@
+import heapq
+import threading
+from contextlib import contextmanager
+
+import metrics
+from pca9634 import REG_AUTOINCREMENT
+
+
+#----------------------------------------------------------------------------
+# Priorities, lower values are sent first
+#----------------------------------------------------------------------------
+PRIORITY_KEY = 0
+PRIORITY_CLOCK = 1
+PRIORITY_FADE = 2
+
+PRIORITY_DEFAULT = PRIORITY_CLOCK
+
+# Registers sent per transaction, a full display frame fits in one
+MAX_BATCH_REGS = 128
+
+
+# Queued command fields
+CMD_PRIORITY = 0
+CMD_SEQ = 1
+CMD_ADDR = 2
+CMD_REG = 3
+CMD_VALUE = 4
+CMD_FUTURES = 5
+CMD_READ = 6
+
+
+
+#=========================================================================================
+class Future:
+
+    #----------------------------------------------------------------------------
+    def __init__( self ):
+
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+        # Number of queued registers still to be sent
+        self.parts = 0
+
+        # Called with the future once done, by the thread completing it
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+
+    #----------------------------------------------------------------------------
+    def done( self ):
+        return self.event.is_set()
+
+
+    #----------------------------------------------------------------------------
+    def set_result( self, value ):
+        self.finish( value, None )
+
+
+    #----------------------------------------------------------------------------
+    def set_exception( self, error ):
+        self.finish( None, error )
+
+
+    #----------------------------------------------------------------------------
+    def finish( self, value, error ):
+
+        # Only the first outcome counts, a register sent after another part of
+        # the future failed does not turn it into a success.
+        with self.lock:
+            if self.event.is_set():
+                return
+
+            self.value = value
+            self.error = error
+            self.event.set()
+
+            callbacks = self.callbacks
+            self.callbacks = []
+
+        for callback in callbacks:
+            callback( self )
+
+
+    #----------------------------------------------------------------------------
+    def add_done_callback( self, callback ):
+
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append( callback )
+                return
+
+        callback( self )
+
+
+    #----------------------------------------------------------------------------
+    def part_done( self, value = None ):
+
+        self.parts -= 1
+
+        if self.parts <= 0:
+            self.set_result( value )
+
+
+    #----------------------------------------------------------------------------
+    def result( self, timeout = None ):
+
+        if not self.event.wait( timeout ):
+            raise RuntimeError( "Future:result: Timed out waiting for the bus" )
+
+        if self.error is not None:
+            raise self.error
+
+        return self.value
+
+
+
+#=========================================================================================
+class BusScheduler:
+
+    #----------------------------------------------------------------------------
+    def __init__( self, bus, aliases = None, start = True ):
+
+        self.bus = bus
+
+        # Addresses reaching the same registers (group addresses and their members)
+        self.aliases = aliases or {}
+
+        # Heap of ( priority, seq, key ), entries no longer matching the queued
+        # command are stale and skipped.
+        self.heap = []
+        self.pending = {}
+        self.seq = 0
+
+        self.cond = threading.Condition( threading.Lock() )
+        self.local = threading.local()
+
+        # Held by the callers while they stage and submit a batch, like I2CBus.lock.
+        # Completion callbacks take it too, never wait for the bus while holding it.
+        self.lock = threading.RLock()
+
+        self.running = False
+        self.busy = False
+        self.thread = None
+
+        ## Counters ##
+        self.submitted = 0
+        self.coalesced = 0
+        self.errors = 0
+
+        self.metric_errors = metrics.counter( "scheduler.errors", "i2c-%s" % getattr( bus, "bus", "" ))
+
+        if start:
+            self.start()
+
+
+    #----------------------------------------------------------------------------
+    def start( self ):
+
+        if self.running:
+            return
+
+        self.running = True
+
+        self.thread = threading.Thread( target = self.run, name = "i2c-scheduler" )
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    #----------------------------------------------------------------------------
+    def stop( self, drain = True ):
+
+        with self.cond:
+            if not drain:
+                self.cancel_pending()
+
+            self.running = False
+            self.cond.notify_all()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+    #----------------------------------------------------------------------------
+    def cancel_pending( self ):
+
+        error = IOError( "BusScheduler: Stopped before the command was sent" )
+
+        for command in self.pending.values():
+            for future in command[ CMD_FUTURES ]:
+                future.set_exception( error )
+
+        self.pending.clear()
+        del self.heap[:]
+
+
+    #----------------------------------------------------------------------------
+    def get_priority( self ):
+        return getattr( self.local, "priority", PRIORITY_DEFAULT )
+
+
+    #----------------------------------------------------------------------------
+    @contextmanager
+    def priority( self, level ):
+
+        # Priority of the commands submitted by this thread within the block
+        last = self.get_priority()
+        self.local.priority = level
+
+        try:
+            yield self
+        finally:
+            self.local.priority = last
+
+
+    #----------------------------------------------------------------------------
+    @contextmanager
+    def batch( self ):
+
+        # Commands submitted within the block are queued together, so they are
+        # sent in the same transaction.
+        batch = getattr( self.local, "batch", None )
+        if batch is not None:
+            yield self
+            return
+
+        self.local.batch = []
+
+        try:
+            yield self
+
+            batch = self.local.batch
+        finally:
+            self.local.batch = None
+
+        with self.cond:
+            for args in batch:
+                self.enqueue( *args )
+
+            self.cond.notify_all()
+
+
+    #----------------------------------------------------------------------------
+    def submit( self, addr, regs, length = 0 ):
+
+        future = Future()
+        args = ( addr, regs, length, self.get_priority(), future )
+
+        batch = getattr( self.local, "batch", None )
+        if batch is not None and regs is not None:
+            batch.append( args )
+            return future
+
+        with self.cond:
+            # A read waits for its result, send what the batch holds so far first
+            if batch:
+                for queued in batch:
+                    self.enqueue( *queued )
+                del batch[:]
+
+            self.enqueue( *args )
+            self.cond.notify_all()
+
+        return future
+
+
+    #----------------------------------------------------------------------------
+    def push( self, key, command ):
+        heapq.heappush( self.heap, ( command[ CMD_PRIORITY ], command[ CMD_SEQ ], key ))
+
+
+    #----------------------------------------------------------------------------
+    def enqueue( self, addr, regs, length, priority, future ):
+
+        if not self.running:
+            raise IOError( "BusScheduler: Not running" )
+
+        self.submitted += 1
+
+        ## Reads are never merged, ( register, length ) is kept in place of the value ##
+        if regs is None:
+            self.seq += 1
+
+            key = ( None, self.seq )
+            command = [ priority, self.seq, addr, None, length, [ future ], True ]
+
+            future.parts += 1
+
+            self.pending[ key ] = command
+            self.push( key, command )
+            return
+
+
+        ## Writes to a register replace the queued value ##
+        for reg, value in regs:
+            self.seq += 1
+
+            key = ( addr, reg )
+            command = self.pending.get( key )
+
+            if command is None:
+                command = [ priority, self.seq, addr, reg, value, [ future ], False ]
+                self.pending[ key ] = command
+
+            else:
+                # Sent in the place of the latest write, at the most urgent priority
+                command[ CMD_PRIORITY ] = min( command[ CMD_PRIORITY ], priority )
+                command[ CMD_SEQ ] = self.seq
+                command[ CMD_VALUE ] = value
+                command[ CMD_FUTURES ].append( future )
+
+                self.coalesced += 1
+
+            future.parts += 1
+
+            # An older write reaching the same register through a group address
+            # must not be sent after this one.
+            for alias in self.aliases.get( addr, () ):
+                other = self.pending.get(( alias, reg ))
+
+                if other is not None and other[ CMD_PRIORITY ] > command[ CMD_PRIORITY ]:
+                    other[ CMD_PRIORITY ] = command[ CMD_PRIORITY ]
+                    self.push(( alias, reg ), other )
+
+            self.push( key, command )
+
+
+    #----------------------------------------------------------------------------
+    def next_commands( self ):
+
+        commands = []
+
+        while self.heap and len( commands ) < MAX_BATCH_REGS:
+            priority, seq, key = heapq.heappop( self.heap )
+
+            command = self.pending.get( key )
+            if command is None or command[ CMD_SEQ ] != seq or command[ CMD_PRIORITY ] != priority:
+                continue
+
+            del self.pending[ key ]
+            commands.append( command )
+
+            # A read ends the transaction
+            if command[ CMD_READ ]:
+                break
+
+        return commands
+
+
+    #----------------------------------------------------------------------------
+    def build_messages( self, commands ):
+
+        # Sent in submission order, consecutive registers of a chip are joined
+        # into auto-increment block writes.
+        messages = []
+        last = None
+
+        for command in sorted( commands, key = lambda command: command[ CMD_SEQ ] ):
+            addr = command[ CMD_ADDR ]
+
+            if command[ CMD_READ ]:
+                messages.append([ addr, None, command[ CMD_VALUE ], [ command ]])
+                last = None
+                continue
+
+            reg = command[ CMD_REG ]
+
+            if last is not None and last[0] == addr and last[1] + len( last[2] ) == reg:
+                last[2].append( command[ CMD_VALUE ])
+                last[3].append( command )
+                continue
+
+            last = [ addr, reg, [ command[ CMD_VALUE ]], [ command ]]
+            messages.append( last )
+
+        return messages
+
+
+    #----------------------------------------------------------------------------
+    def send( self, commands ):
+
+        results = []
+
+        try:
+            with self.bus.batch():
+                for addr, reg, values, cmds in self.build_messages( commands ):
+
+                    if reg is None:
+                        reg, length = values
+                        results.append(( cmds, self.bus.read_i2c_block_data( addr, reg, length )))
+
+                    elif len( values ) == 1:
+                        self.bus.write_byte_data( addr, reg, values[0] )
+                        results.append(( cmds, None ))
+
+                    else:
+                        self.bus.write_i2c_block_data( addr, reg | REG_AUTOINCREMENT, values )
+                        results.append(( cmds, None ))
+
+        except Exception as e:
+            self.errors += 1
+
+            if metrics.enabled:
+                self.metric_errors.add()
+
+            for command in commands:
+                for future in command[ CMD_FUTURES ]:
+                    future.set_exception( e )
+            return
+
+        for cmds, result in results:
+            for command in cmds:
+                for future in command[ CMD_FUTURES ]:
+                    future.part_done( result )
+
+
+    #----------------------------------------------------------------------------
+    def run( self ):
+
+        while True:
+            with self.cond:
+                while self.running and not self.heap:
+                    self.cond.wait()
+
+                if not self.heap:
+                    return
+
+                commands = self.next_commands()
+                self.busy = True
+
+            if commands:
+                self.send( commands )
+
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+
+
+    #----------------------------------------------------------------------------
+    def flush( self ):
+
+        # Wait until every queued command has been sent
+        with self.cond:
+            while self.pending or self.busy:
+                self.cond.wait()
+
+
+    #----------------------------------------------------------------------------
+    def write_byte_data( self, addr, reg, value ):
+        return self.submit( addr, [( reg, value )] )
+
+
+    #----------------------------------------------------------------------------
+    def write_i2c_block_data( self, addr, reg, values ):
+
+        # Without auto-increment every byte lands in the same register
+        if not reg & REG_AUTOINCREMENT:
+            return self.submit( addr, [( reg, values[ -1 ] )] )
+
+        reg &= ~REG_AUTOINCREMENT
+
+        return self.submit( addr, [ ( reg + index, value ) for index, value in enumerate( values ) ] )
+
+
+    #----------------------------------------------------------------------------
+    def read_i2c_block_data( self, addr, reg, length ):
+        return self.submit( addr, None, ( reg, length )).result()
+
+
+    #----------------------------------------------------------------------------
+    def read_byte_data( self, addr, reg ):
+        return self.read_i2c_block_data( addr, reg, 1 )[0]
@@ -0,0 +1,728 @@
+import time
+import errno
+import ctypes
+import threading
+from collections import deque
+
+from ioctl_numbers import _IOC_NRSHIFT, _IOC_NRMASK
+from ioctl_numbers import _IOC_TYPESHIFT, _IOC_TYPEMASK
+from ioctl_numbers import _IOC_SIZESHIFT, _IOC_SIZEMASK
+
+from spi import SPI_IOC_MAGIC
+from spi import SPI_IOC_TRANSFER
+
+from i2c import I2C_FUNCS
+from i2c import I2C_RDWR
+from i2c import I2C_FUNC_I2C
+from i2c import I2C_M_RD
+
+from pca9634 import Digit
+from pca9634 import REG_MODE_1
+from pca9634 import REG_MODE_2
+from pca9634 import REG_PWM0
+from pca9634 import REG_PWM7
+from pca9634 import REG_GRPPWM
+from pca9634 import REG_GRPFREQ
+from pca9634 import REG_LEDOUT0
+from pca9634 import REG_LEDOUT1
+from pca9634 import REG_SUBADR1
+from pca9634 import REG_SUBADR2
+from pca9634 import REG_SUBADR3
+from pca9634 import REG_ALLCALLADDR
+from pca9634 import MODE_SUB1
+from pca9634 import MODE_SUB2
+from pca9634 import MODE_SUB3
+from pca9634 import MODE_ALLCALL
+from pca9634 import MODE_CHANGE_ON_ACK
+
+from gpiochip import FakeGPIOChip
+from gpiochip import GPIOLine
+
+from clock import monotonic
+from crc24 import crc24
+
+
+
+#----------------------------------------------------------------------------
+# Simulated AT42QT1085
+#----------------------------------------------------------------------------
+AT42QT1085_FAMILY_ID = 0x8A
+AT42QT1085_VARIANT_ID = 0x01
+AT42QT1085_VERSION = 0x10
+AT42QT1085_BUILD = 0xAA
+
+# ( type, size, instances, reports per instance ), in address order
+AT42QT1085_OBJECTS = (
+    ( 5, 5, 1, 0 ),         # T5 message processor
+    ( 6, 5, 1, 1 ),         # T6 command processor
+    ( 7, 3, 1, 0 ),         # T7 power config
+    ( 13, 4, 8, 1 ),        # T13 keys
+    ( 29, 4, 16, 1 ),       # T29 GPIO / PWM
+    ( 31, 4, 8, 1 ),        # T31 haptic events
+)
+
+T5_MESSAGE = 5
+T6_COMMAND = 6
+T13_KEY = 13
+
+COMMAND_RESET = 0
+COMMAND_BACKUP = 1
+COMMAND_CALIBRATE = 2
+COMMAND_REPORT = 3
+
+# T6 status byte
+STATUS_RESET = 0x80
+STATUS_CAL = 0x10
+
+# Report ID of an empty message queue
+REPORT_ID_NONE = 0xFF
+
+WRITE_ACK = 0xAA
+
+
+
+#=========================================================================================
+class AT42QT1085Sim:
+
+    #----------------------------------------------------------------------------
+    def __init__( self, objects = AT42QT1085_OBJECTS, reset_time = 0.010 ):
+
+        self.lock = threading.RLock()
+        self.reset_time = reset_time
+        self.reset_until = 0
+
+        self.mode = 0
+        self.speed = 0
+        self.bpw = 8
+
+
+        ## Information block : header, object table, checksum ##
+        info = bytearray(( AT42QT1085_FAMILY_ID, AT42QT1085_VARIANT_ID, AT42QT1085_VERSION,
+                           AT42QT1085_BUILD, 0, 0, len( objects ) ))
+
+        addr = 7 + ( 6 * len( objects )) + 3
+        report_id = 1
+
+        self.objects = {}
+        self.reports = {}
+
+        for obj_type, size, ninst, nreports in objects:
+            info.extend(( obj_type, addr & 0xFF, addr >> 8, size - 1, ninst - 1, nreports ))
+
+            self.objects[ obj_type ] = {
+                'addr' : addr,
+                'size' : size,
+                'ninst' : ninst,
+                'report_id' : report_id,
+            }
+
+            for n in range( nreports * ninst ):
+                self.reports[( obj_type, n )] = report_id
+                report_id += 1
+
+            addr += size * ninst
+
+        crc = crc24( info )
+        info.extend(( crc & 0xFF, ( crc >> 8 ) & 0xFF, crc >> 16 ))
+
+        self.config_start = len( info )
+
+        self.memory = info + bytearray( addr - len( info ))
+        self.nvm = self.memory[ self.config_start: ]
+
+
+        ## Message queue, the CHANGE line is asserted (low) while not empty ##
+        self.fifo = deque()
+        self.change = None
+
+        self.keys = [ False ] * self.objects[ T13_KEY ][ 'ninst' ]
+        self.load_message()
+
+
+        ## SPI frame in progress ##
+        self.frame = bytearray()
+        self.access = None
+
+        ## Counters ##
+        self.ioctls = 0
+        self.transfers = 0
+        self.bytes = 0
+        self.frames = 0
+
+
+    #----------------------------------------------------------------------------
+    def close( self ):
+        pass
+
+
+    #----------------------------------------------------------------------------
+    def attach_change( self, kernel_id ):
+
+        self.change = ( get_gpio_chip( kernel_id / 32 ), kernel_id % 32 )
+        self.update_change()
+
+
+    #----------------------------------------------------------------------------
+    def update_change( self ):
+
+        if self.change is not None:
+            chip, offset = self.change
+            chip.set_input( offset, 0 if self.fifo else 1 )
+
+
+    #----------------------------------------------------------------------------
+    def object_range( self, obj_type ):
+
+        obj = self.objects[ obj_type ]
+        return ( obj[ 'addr' ], obj[ 'addr' ] + obj[ 'size' ] * obj[ 'ninst' ] )
+
+
+    #----------------------------------------------------------------------------
+    def push_message( self, obj_type, instance, data ):
+
+        size = self.objects[ T5_MESSAGE ][ 'size' ]
+
+        msg = bytearray( size )
+        msg[0] = self.reports[( obj_type, instance )]
+        msg[ 1:1 + len( data ) ] = data
+
+        with self.lock:
+            self.fifo.append( msg )
+            self.update_change()
+
+
+    #----------------------------------------------------------------------------
+    def load_message( self ):
+
+        ## Next message into T5, popped from the queue by the read ##
+        start, end = self.object_range( T5_MESSAGE )
+
+        if self.fifo:
+            self.memory[ start:end ] = self.fifo.popleft()
+        else:
+            self.memory[ start:end ] = [ REPORT_ID_NONE ] * ( end - start )
+
+        self.update_change()
+
+
+    #----------------------------------------------------------------------------
+    def key_config( self, key ):
+
+        obj = self.objects[ T13_KEY ]
+        return self.memory[ obj[ 'addr' ] + key * obj[ 'size' ]]
+
+
+    #----------------------------------------------------------------------------
+    def set_key( self, key, pressed ):
+
+        with self.lock:
+            if self.keys[ key ] == pressed:
+                return
+
+            self.keys[ key ] = pressed
+
+            ## Disabled keys and masked reports do not queue messages ##
+            config = self.key_config( key )
+
+            if not config & 0x01:
+                return
+
+            if config & ( 0x80 if pressed else 0x40 ):
+                return
+
+            self.push_message( T13_KEY, key, [ 1 if pressed else 0 ] )
+
+
+    #----------------------------------------------------------------------------
+    def press( self, key, duration = 0.1 ):
+
+        self.set_key( key, True )
+
+        if duration is not None:
+            timer = threading.Timer( duration, self.set_key, ( key, False ))
+            timer.daemon = True
+            timer.start()
+
+
+    #----------------------------------------------------------------------------
+    def play( self, script ):
+
+        # Presses keys at the given times, script entries are
+        # ( seconds from now, key, duration )
+        def run():
+            start = monotonic()
+
+            for when, key, duration in sorted( script ):
+                delay = start + when - monotonic()
+
+                if delay > 0:
+                    time.sleep( delay )
+
+                self.press( key, duration )
+
+        thread = threading.Thread( target = run, name = "at42qt1085-keys" )
+        thread.daemon = True
+        thread.start()
+
+        return thread
+
+
+    #----------------------------------------------------------------------------
+    def run_command( self, command ):
+
+        if command == COMMAND_RESET:
+            self.reset_until = monotonic() + self.reset_time
+            self.memory[ self.config_start: ] = self.nvm
+
+            self.fifo.clear()
+            self.keys = [ False ] * len( self.keys )
+            self.load_message()
+
+            self.push_message( T6_COMMAND, 0, [ STATUS_RESET ] )
+
+        elif command == COMMAND_BACKUP:
+            self.nvm = self.memory[ self.config_start: ]
+
+        elif command == COMMAND_CALIBRATE:
+            self.push_message( T6_COMMAND, 0, [ STATUS_CAL ] )
+
+        elif command == COMMAND_REPORT:
+            for key, pressed in enumerate( self.keys ):
+                self.push_message( T13_KEY, key, [ 1 if pressed else 0 ] )
+
+
+    #----------------------------------------------------------------------------
+    def ioctl( self, request, arg, mutate = True ):
+
+        if ( request >> _IOC_TYPESHIFT ) & _IOC_TYPEMASK != SPI_IOC_MAGIC:
+            raise IOError( errno.ENOTTY, "Inappropriate ioctl for device" )
+
+        self.ioctls += 1
+
+        ## Mode, bit order, word length and speed settings are accepted as is ##
+        if ( request >> _IOC_NRSHIFT ) & _IOC_NRMASK != 0:
+            return arg
+
+        size = ( request >> _IOC_SIZESHIFT ) & _IOC_SIZEMASK
+        raw = ctypes.string_at( ctypes.addressof( arg ), size )
+
+        with self.lock:
+            self.transfer_message( raw, size / SPI_IOC_TRANSFER.size )
+
+        return 0
+
+
+    #----------------------------------------------------------------------------
+    def transfer_message( self, raw, count ):
+
+        for i in range( count ):
+            tx_buf, rx_buf, length, speed, delay_usecs, bpw, cs_change, pad = \
+                SPI_IOC_TRANSFER.unpack_from( raw, i * SPI_IOC_TRANSFER.size )
+
+            if tx_buf:
+                tx = bytearray( ctypes.string_at( tx_buf, length ))
+            else:
+                tx = bytearray( length )
+
+            rx = bytearray([ self.clock_byte( b ) for b in tx ])
+
+            if rx_buf:
+                ctypes.memmove( rx_buf, str( rx ), length )
+
+            self.transfers += 1
+            self.bytes += length
+
+            # cs_change releases the chip select after a transfer, except on
+            # the last one of the message where it keeps it asserted.
+            if bool( cs_change ) != ( i == count - 1 ):
+                self.end_frame()
+
+
+    #----------------------------------------------------------------------------
+    def clock_byte( self, value ):
+
+        pos = len( self.frame )
+        self.frame.append( value )
+
+        ## Address and length ##
+        if pos < 3:
+            if pos == 2:
+                self.start_access()
+
+            return 0x00
+
+        access = self.access
+        index = pos - 3
+
+        if access is None or index >= access[2]:
+            return 0x00
+
+        read, addr, length = access
+        addr += index
+
+        if addr >= len( self.memory ):
+            return 0x00
+
+        if read:
+            return self.memory[ addr ]
+
+        ## The information block and the message processor are read only ##
+        msg_start, msg_end = self.object_range( T5_MESSAGE )
+
+        if addr < self.config_start or msg_start <= addr < msg_end:
+            return 0x00
+
+        self.memory[ addr ] = value
+
+        return WRITE_ACK
+
+
+    #----------------------------------------------------------------------------
+    def start_access( self ):
+
+        # No answer while the device is resetting
+        if monotonic() < self.reset_until:
+            self.access = None
+            return
+
+        addr_low, addr_hi, length = self.frame[ :3 ]
+
+        read = bool( addr_low & 0x01 )
+        addr = ( addr_low >> 1 ) | ( addr_hi << 7 )
+
+        self.access = ( read, addr, length )
+
+        if read and addr == self.objects[ T5_MESSAGE ][ 'addr' ]:
+            self.load_message()
+
+
+    #----------------------------------------------------------------------------
+    def end_frame( self ):
+
+        access = self.access
+
+        self.frame = bytearray()
+        self.access = None
+        self.frames += 1
+
+        if access is None or access[0]:
+            return
+
+        ## Commands written to T6 ##
+        start, end = self.object_range( T6_COMMAND )
+
+        for addr in range( start, end ):
+            if self.memory[ addr ] == 0x55:
+                self.memory[ addr ] = 0x00
+                self.run_command( addr - start )
+
+
+    #----------------------------------------------------------------------------
+    def get_stats( self ):
+
+        return {
+            "ioctls": self.ioctls,
+            "transfers": self.transfers,
+            "bytes": self.bytes,
+            "frames": self.frames,
+        }
+
+
+
+#----------------------------------------------------------------------------
+# Simulated PCA9634
+#----------------------------------------------------------------------------
+PCA9634_NUM_REGS = REG_ALLCALLADDR + 1
+
+PCA9634_DEFAULTS = bytearray([ 0x11, 0x05 ] + [ 0x00 ] * 8 + [ 0xFF, 0x00, 0x00, 0x00,
+                               0xE2, 0xE4, 0xE8, 0xE0 ])
+
+# Auto-increment options of the control register, ( first, last ) register
+AUTOINCREMENT_RANGES = {
+    0x80 : ( REG_MODE_1, REG_ALLCALLADDR ),
+    0xA0 : ( REG_PWM0, REG_PWM7 ),
+    0xC0 : ( REG_GRPPWM, REG_GRPFREQ ),
+    0xE0 : ( REG_PWM0, REG_GRPFREQ ),
+}
+
+# Registers driving the outputs
+OUTPUT_REGS = slice( REG_PWM0, REG_LEDOUT1 + 1 )
+
+
+
+#=========================================================================================
+class PCA9634Sim:
+
+    #----------------------------------------------------------------------------
+    def __init__( self, address ):
+
+        self.address = address
+        self.regs = bytearray( PCA9634_DEFAULTS )
+        self.pointer = 0
+        self.ai = 0
+
+        # Output registers as last latched
+        self.outputs = self.regs[ OUTPUT_REGS ]
+        self.latches = 0
+
+
+    #----------------------------------------------------------------------------
+    def answers( self, addr ):
+
+        if addr == self.address:
+            return True
+
+        mode1 = self.regs[ REG_MODE_1 ]
+
+        for bit, reg in (( MODE_ALLCALL, REG_ALLCALLADDR ), ( MODE_SUB1, REG_SUBADR1 ),
+                         ( MODE_SUB2, REG_SUBADR2 ), ( MODE_SUB3, REG_SUBADR3 )):
+            if mode1 & bit and self.regs[ reg ] >> 1 == addr:
+                return True
+
+        return False
+
+
+    #----------------------------------------------------------------------------
+    def advance( self ):
+
+        bounds = AUTOINCREMENT_RANGES.get( self.ai )
+
+        if bounds is None:
+            return
+
+        first, last = bounds
+
+        if self.pointer == last or not first <= self.pointer <= last:
+            self.pointer = first
+        else:
+            self.pointer += 1
+
+
+    #----------------------------------------------------------------------------
+    def write( self, data ):
+
+        ## Control register, then data from the register pointer ##
+        self.pointer = ( data[0] & 0x1F ) % PCA9634_NUM_REGS
+        self.ai = data[0] & 0xE0
+
+        for value in data[ 1: ]:
+            if self.pointer == REG_MODE_1:
+                value = ( value & 0x1F ) | self.ai
+
+            self.regs[ self.pointer ] = value
+            self.advance()
+
+            if self.regs[ REG_MODE_2 ] & MODE_CHANGE_ON_ACK:
+                self.latch()
+
+
+    #----------------------------------------------------------------------------
+    def read( self, length ):
+
+        data = bytearray()
+
+        for i in range( length ):
+            data.append( self.regs[ self.pointer ] )
+            self.advance()
+
+        return data
+
+
+    #----------------------------------------------------------------------------
+    def latch( self ):
+
+        outputs = self.regs[ OUTPUT_REGS ]
+
+        if outputs != self.outputs:
+            self.outputs = outputs
+            self.latches += 1
+
+
+    #----------------------------------------------------------------------------
+    def led_states( self ):
+
+        ledout0 = self.outputs[ REG_LEDOUT0 - REG_PWM0 ]
+        ledout1 = self.outputs[ REG_LEDOUT1 - REG_PWM0 ]
+
+        return [ ( ledout0 >> ( i * 2 )) & 0x03 for i in range( 4 ) ] + \
+               [ ( ledout1 >> ( i * 2 )) & 0x03 for i in range( 4 ) ]
+
+
+
+#=========================================================================================
+class I2CBusSim:
+
+    #----------------------------------------------------------------------------
+    def __init__( self, addresses = () ):
+
+        self.lock = threading.Lock()
+        self.chips = {}
+
+        for addr in addresses:
+            self.chips[ addr ] = PCA9634Sim( addr )
+
+        ## Counters ##
+        self.ioctls = 0
+        self.messages = 0
+        self.bytes = 0
+
+
+    #----------------------------------------------------------------------------
+    def close( self ):
+        pass
+
+
+    #----------------------------------------------------------------------------
+    def ioctl( self, request, arg, mutate = True ):
+
+        if request == I2C_FUNCS:
+            arg.value = I2C_FUNC_I2C
+            return 0
+
+        if request != I2C_RDWR:
+            raise IOError( errno.ENOTTY, "Inappropriate ioctl for device" )
+
+        with self.lock:
+            self.ioctls += 1
+
+            for i in range( arg.nmsgs ):
+                self.transfer( arg.msgs[ i ] )
+
+            ## Outputs change on the STOP condition ##
+            for chip in self.chips.values():
+                chip.latch()
+
+        return arg.nmsgs
+
+
+    #----------------------------------------------------------------------------
+    def transfer( self, msg ):
+
+        targets = [ chip for chip in self.chips.values() if chip.answers( msg.addr ) ]
+
+        if not targets:
+            raise IOError( errno.EREMOTEIO, "No acknowledge from address 0x%02x" % msg.addr )
+
+        self.messages += 1
+        self.bytes += msg.len
+
+        if msg.flags & I2C_M_RD:
+            # Group addresses are write only
+            if len( targets ) > 1 or targets[0].address != msg.addr:
+                raise IOError( errno.EREMOTEIO, "No acknowledge from address 0x%02x" % msg.addr )
+
+            data = targets[0].read( msg.len )
+            ctypes.memmove( msg.buf, str( data ), msg.len )
+
+        else:
+            data = bytearray( ctypes.string_at( msg.buf, msg.len ))
+
+            for chip in targets:
+                chip.write( data )
+
+
+    #----------------------------------------------------------------------------
+    def read_digits( self, addresses ):
+
+        ## Characters shown by 7 segment digits, '?' when not in the font ##
+        # Numbers win over the letters sharing their segments ( 5 / S )
+        font = dict([ ( tuple([ bool( s ) for s in states[ 1: ]] ), char )
+                      for char, states in sorted( Digit.char_table.items(), reverse = True ) ])
+
+        text = ""
+
+        for addr in addresses:
+            states = self.chips[ addr ].led_states()
+            text += font.get( tuple([ bool( s ) for s in states[ 1: ]] ), "?" )
+
+        return text
+
+
+    #----------------------------------------------------------------------------
+    def get_stats( self ):
+
+        return {
+            "ioctls": self.ioctls,
+            "messages": self.messages,
+            "bytes": self.bytes,
+            "latches": sum([ chip.latches for chip in self.chips.values() ]),
+        }
+
+
+
+#----------------------------------------------------------------------------
+# Simulated board
+#----------------------------------------------------------------------------
+
+# PCA9634 fitted on the display board
+BOARD_PCA9634 = ( 0x51, 0x68, 0x69, 0x6a, 0x6b )
+
+spi_devices = {}
+i2c_devices = {}
+gpio_chips = {}
+
+
+#----------------------------------------------------------------------------
+def get_spi_device( bus, client ):
+
+    device = spi_devices.get(( bus, client ))
+
+    if device is None:
+        device = AT42QT1085Sim()
+        spi_devices[( bus, client )] = device
+
+    return device
+
+
+#----------------------------------------------------------------------------
+def get_i2c_device( bus ):
+
+    device = i2c_devices.get( bus )
+
+    if device is None:
+        device = I2CBusSim( BOARD_PCA9634 )
+        i2c_devices[ bus ] = device
+
+    return device
+
+
+#----------------------------------------------------------------------------
+def get_gpio_chip( index ):
+
+    chip = gpio_chips.get( index )
+
+    if chip is None:
+        chip = FakeGPIOChip()
+        gpio_chips[ index ] = chip
+
+    return chip
+
+
+#----------------------------------------------------------------------------
+def open_gpio( kernel_id, mode ):
+    return GPIOLine( kernel_id, mode, chip = get_gpio_chip( kernel_id / 32 ))
+
+
+#----------------------------------------------------------------------------
+def parse_key_script( script ):
+
+    # "<seconds>:<key>[:<duration>]", comma separated
+    events = []
+
+    for item in script.split( "," ):
+        if not item.strip():
+            continue
+
+        fields = item.split( ":" )
+
+        try:
+            when = float( fields[0] )
+            key = int( fields[1] )
+            duration = float( fields[2] ) if len( fields ) > 2 else 0.1
+
+        except ( ValueError, IndexError ):
+            raise ValueError( "Invalid key script entry '%s'" % ( item ))
+
+        events.append(( when, key, duration ))
+
+    return events
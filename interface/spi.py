@@ -1,10 +1,14 @@
 import time
 import ctypes
 from struct import pack
-from struct import unpack
+from struct import Struct
 from fcntl import ioctl
-from ioctl_numbers import _IOR, _IOW
+from ioctl_numbers import _IOR, _IOW, _IOC_SIZEMASK
 from gpio import GPIO
+from backend import is_simulated
+from clock import monotonic
+
+import metrics
 
 
 
@@ -30,8 +34,59 @@ SPI_IOC_WR_BITS_PER_WORD = _IOW(SPI_IOC_MAGIC, 3, "=B")
 SPI_IOC_RD_MAX_SPEED_HZ  = _IOR(SPI_IOC_MAGIC, 4, "=I")
 SPI_IOC_WR_MAX_SPEED_HZ  = _IOW(SPI_IOC_MAGIC, 4, "=I")
 
+# struct spi_ioc_transfer
+SPI_IOC_TRANSFER = Struct( "=QQIIHBBI" )
+
+# cs_change field of struct spi_ioc_transfer
+SPI_IOC_TRANSFER_CS_CHANGE = Struct( "=B" )
+SPI_IOC_TRANSFER_CS_CHANGE_OFFSET = 27
+
+# Maximum number of transfers in a single message (limited by the ioctl size field)
+SPI_IOC_MAX_TRANSFERS = _IOC_SIZEMASK / SPI_IOC_TRANSFER.size
+
+# SPI_IOC_MESSAGE(n) request numbers, indexed by the number of transfers
+SPI_IOC_MESSAGES = [ _IOW(SPI_IOC_MAGIC, 0, SPI_IOC_TRANSFER.size * n) 
+                     for n in range( SPI_IOC_MAX_TRANSFERS + 1 ) ]
+
 def SPI_IOC_MESSAGE(size):
-    return _IOW(SPI_IOC_MAGIC, 0, "=" + ("QQIIHBBI" * size))
+    return SPI_IOC_MESSAGES[ size ]
+
+
+#----------------------------------------------------------------------------
+def buffer_address( buf ):
+    
+    # Address of a bytearray, through a ctypes array sharing its memory. Valid
+    # while the bytearray is alive and not resized.
+    return ctypes.addressof(( ctypes.c_uint8 * len( buf )).from_buffer( buf ))
+
+
+
+#=========================================================================================
+class SpidevDevice:
+    
+    #----------------------------------------------------------------------------
+    def __init__( self, bus, client ):
+        self.handle = open( "/dev/spidev%d.%d" % ( bus, client ), "w+" )
+    
+    
+    #----------------------------------------------------------------------------
+    def close( self ):
+        self.handle.close()
+    
+    
+    #----------------------------------------------------------------------------
+    def ioctl( self, request, arg, mutate = True ):
+        return ioctl( self.handle, request, arg, mutate )
+
+
+#----------------------------------------------------------------------------
+def open_device( bus, client ):
+    
+    if is_simulated():
+        from sim import get_spi_device
+        return get_spi_device( bus, client )
+    
+    return SpidevDevice( bus, client )
 
 
 
@@ -50,18 +105,38 @@ class SPI:
     SPI_NO_CS       = 0x40
     SPI_READY       = 0x80
     
+    # Maximum number of bytes per message (spidev 'bufsiz' module parameter)
+    max_frame_bytes = 4096
+    
     
     #----------------------------------------------------------------------------
-    def __init__( self, bus, client, mode = SPI_MODE_0, speed = 5000000 ):
+    def __init__( self, bus, client, mode = SPI_MODE_0, speed = 5000000, device = None ):
         
         self.speed = speed
         self.mode = mode
         self.delay = 0
         self.bpw = 8
         
-        dev = "/dev/spidev%d.%d" % ( bus, client )
+        # spidev node, or any object answering the same ioctls
+        if device is None:
+            device = open_device( bus, client )
+        
+        self.device = device
+        
+        ## Preallocated transfer buffers ##
+        self.txbuf = ( ctypes.c_uint8 * self.max_frame_bytes )()
+        self.rxbuf = ( ctypes.c_uint8 * self.max_frame_bytes )()
+        self.descbuf = ctypes.create_string_buffer( SPI_IOC_MAX_TRANSFERS * SPI_IOC_TRANSFER.size )
         
-        self.handle = open( dev, "w+" )
+        self.tx_addr = ctypes.addressof( self.txbuf )
+        self.rx_addr = ctypes.addressof( self.rxbuf )
+        
+        self.segment_cache = {}
+        
+        ## Frame latency and traffic ##
+        name = "spidev%d.%d" % ( bus, client )
+        self.metric_transfer = metrics.histogram( "spi.transfer", name )
+        self.metric_bytes = metrics.counter( "spi.bytes", name )
         
         self.set_mode( mode )
         self.set_speed( speed )
@@ -69,15 +144,15 @@ class SPI:
     
     #----------------------------------------------------------------------------
     def __del__( self ):
-        self.handle.close()
+        self.device.close()
     
     
     #----------------------------------------------------------------------------
     def set_mode( self, mode ):
         p = pack("=B", mode)
 
-        ioctl(self.handle, SPI_IOC_RD_MODE, p)
-        ioctl(self.handle, SPI_IOC_WR_MODE, p)
+        self.device.ioctl(SPI_IOC_RD_MODE, p)
+        self.device.ioctl(SPI_IOC_WR_MODE, p)
 
         self.mode = mode
     
@@ -86,8 +161,8 @@ class SPI:
     def set_speed( self, speed ):
         p = pack("=I", speed)
 
-        ioctl(self.handle, SPI_IOC_RD_MAX_SPEED_HZ, p)
-        ioctl(self.handle, SPI_IOC_WR_MAX_SPEED_HZ, p)
+        self.device.ioctl(SPI_IOC_RD_MAX_SPEED_HZ, p)
+        self.device.ioctl(SPI_IOC_WR_MAX_SPEED_HZ, p)
         
         self.speed = speed
     
@@ -96,49 +171,143 @@ class SPI:
     def set_bpw( self, bpw ):
         p = pack("=B", bpw)
 
-        ioctl(self.handle, SPI_IOC_RD_BITS_PER_WORD, p)
-        ioctl(self.handle, SPI_IOC_WR_BITS_PER_WORD, p)
+        self.device.ioctl(SPI_IOC_RD_BITS_PER_WORD, p)
+        self.device.ioctl(SPI_IOC_WR_BITS_PER_WORD, p)
 
         self.bpw = bpw
     
     
     #----------------------------------------------------------------------------
-    def transfer_byte_delay( self, data, byte_delay_ms = 0 ):
-        if type(data) is list:
-            data = pack( len( data ) * 'B', * data)
+    def transfer_segments( self, data, segments, cs_hold = False, rxbuf = None ):
+        
+        start_time = monotonic() if metrics.enabled else None
         
-        txbuf = ctypes.create_string_buffer( data )
-        rxbuf = ctypes.create_string_buffer( len( data ))
+        length = len( data )
         
-        for i in range( len( data )):
+        if sum( seg[0] for seg in segments ) != length:
+            raise ValueError( "Segments length does not match the frame length" )
+        
+        if rxbuf is not None and len( rxbuf ) < length:
+            raise ValueError( "Receive buffer too small" )
+        
+        # Nothing to send
+        if not segments:
+            return rxbuf if rxbuf is not None else bytearray()
+        
+        # A transfer can not be split across messages
+        if max( seg[0] for seg in segments ) > self.max_frame_bytes:
+            raise ValueError( "Segment too long (max %d bytes)" % ( self.max_frame_bytes ))
+        
+        
+        ## Transmit buffer, bytearrays are sent in place, anything else is copied ##
+        if type( data ) is not bytearray:
+            if isinstance( data, memoryview ):
+                data = data.tobytes()
+            elif not isinstance( data, str ):
+                data = str( bytearray( data ))
+            
+            if length > self.max_frame_bytes:
+                data = bytearray( data )
+            else:
+                ctypes.memmove( self.tx_addr, data, length )
+                tx = self.tx_addr
+        
+        if type( data ) is bytearray:
+            tx = buffer_address( data )
+        
+        
+        ## Receive buffer, the caller's bytearray is filled in place ##
+        if type( rxbuf ) is bytearray:
+            received = rxbuf
+            rx = buffer_address( rxbuf )
+        
+        elif length > self.max_frame_bytes:
+            received = bytearray( length )
+            rx = buffer_address( received )
+        
+        else:
+            received = None
+            rx = self.rx_addr
+        
+        
+        ## Send the frame, split in messages that fits the kernel limits ##
+        offset = 0
+        start = 0
+        nbytes = 0
+        last = len( segments ) - 1
+        
+        for i, seg in enumerate( segments ):
+            seg_len, delay_usecs, cs_change = seg
             
-            p = pack("=QQIIHBBI", ctypes.addressof( txbuf ) + i,
-                ctypes.addressof( rxbuf ) + i, 1,
-                self.speed, self.delay, self.bpw,
-                i < len( data ) - 1, 0)
+            if i > start and (( i - start == SPI_IOC_MAX_TRANSFERS ) or 
+                              ( nbytes + seg_len > self.max_frame_bytes )):
+                self.submit( start, i, segments[ i - 1 ][2] )
+                
+                start = i
+                nbytes = 0
             
-            ioctl(self.handle, SPI_IOC_MESSAGE(1), p)
+            # On the last transfer of a message, cs_change keeps the chip
+            # select asserted until the next message.
+            if i == last:
+                cs_change = cs_hold
             
-            if byte_delay_ms:
-                time.sleep( byte_delay_ms * 0.001)
-      
-        return unpack( len( data ) * 'B', ctypes.string_at(rxbuf, len( data )))
+            SPI_IOC_TRANSFER.pack_into( self.descbuf, ( i - start ) * SPI_IOC_TRANSFER.size, 
+                tx + offset, rx + offset, seg_len, self.speed, delay_usecs, self.bpw, 
+                cs_change, 0 )
+            
+            offset += seg_len
+            nbytes += seg_len
+        
+        self.submit( start, len( segments ))
+        
+        if start_time is not None:
+            self.metric_transfer.observe( monotonic() - start_time )
+            self.metric_bytes.add( length )
+        
+        # Copied out of the preallocated buffer, reused by the next transfer
+        if received is None:
+            received = bytearray( ctypes.string_at( self.rx_addr, length ))
+        
+        if rxbuf is None or received is rxbuf:
+            return received
+        
+        rxbuf[ :length ] = received
+        return rxbuf
     
     
     #----------------------------------------------------------------------------
-    def transfer( self, data, cs_change = True ):
+    def submit( self, start, end, cs_change = None ):
         
-        if type(data) is list:
-            data = pack( len( data ) * 'B', * data)
+        # The message is cut before the end of the frame, invert cs_change on
+        # its last transfer to keep the expected chip select state.
+        if cs_change is not None:
+            SPI_IOC_TRANSFER_CS_CHANGE.pack_into( self.descbuf, 
+                ( end - start - 1 ) * SPI_IOC_TRANSFER.size + SPI_IOC_TRANSFER_CS_CHANGE_OFFSET, 
+                not cs_change )
+        
+        self.device.ioctl( SPI_IOC_MESSAGES[ end - start ], self.descbuf, True )
+    
+    
+    #----------------------------------------------------------------------------
+    def transfer_byte_delay( self, data, byte_delay_ms = 0, rxbuf = None ):
         
-        txbuf = ctypes.create_string_buffer( data )
-        rxbuf = ctypes.create_string_buffer( len( data))
+        key = ( len( data ), byte_delay_ms )
         
-        p = pack("=QQIIHBBI", ctypes.addressof( txbuf ),
-                ctypes.addressof( rxbuf ), len( data ),
-                self.speed, self.delay, self.bpw,
-                not cs_change, 0)
+        segments = self.segment_cache.get( key )
+        if segments is None:
+            
+            delay_usecs = int( byte_delay_ms * 1000 )
+            if delay_usecs > 0xFFFF:
+                raise ValueError( "Invalid byte delay (0-65ms)" )
+            
+            segments = [( 1, delay_usecs, False )] * len( data )
+            self.segment_cache[ key ] = segments
+        
+        return self.transfer_segments( data, segments, rxbuf = rxbuf )
     
-        ioctl(self.handle, SPI_IOC_MESSAGE(1), p)
-
-        return ctypes.string_at(rxbuf, len( data ))    
\ No newline at end of file
+    
+    #----------------------------------------------------------------------------
+    def transfer( self, data, cs_change = True, rxbuf = None ):
+        
+        return self.transfer_segments( data, [( len( data ), self.delay, False )], 
+                                       not cs_change, rxbuf )
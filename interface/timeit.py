@@ -1,14 +1,23 @@
-import time
+import functools
+
+import metrics
+from clock import monotonic
+
 
 def timeit(method):
 
+    # Call durations go to the "call" histogram when metrics are enabled
+    histogram = metrics.histogram("call", method.__module__ + "." + method.__name__)
+
+    @functools.wraps(method)
     def timed(*args, **kw):
-        ts = time.time()
-        result = method(*args, **kw)
-        te = time.time()
+        if not metrics.enabled:
+            return method(*args, **kw)
 
-        print '%r (%r, %r) %2.4f sec' % \
-              (method.__name__, args, kw, te-ts)
-        return result
+        ts = monotonic()
+        try:
+            return method(*args, **kw)
+        finally:
+            histogram.observe(monotonic() - ts)
 
-    return timed
\ No newline at end of file
+    return timed
@@ -0,0 +1,99 @@
+import os
+import errno
+import ctypes
+from struct import Struct
+
+from clock import timespec
+from clock import CLOCK_REALTIME
+from clock import CLOCK_MONOTONIC
+
+
+TFD_NONBLOCK = 0o4000
+TFD_CLOEXEC = 0o2000000
+
+TFD_TIMER_ABSTIME = 0x01
+TFD_TIMER_CANCEL_ON_SET = 0x02
+
+
+#----------------------------------------------------------------------------
+# struct itimerspec
+#----------------------------------------------------------------------------
+class itimerspec( ctypes.Structure ):
+    _fields_ = [
+        ( "it_interval", timespec ),
+        ( "it_value", timespec ),
+    ]
+
+
+EXPIRATIONS = Struct( "=Q" )
+
+libc = ctypes.CDLL( None, use_errno = True )
+
+
+#----------------------------------------------------------------------------
+def set_timespec( ts, value ):
+    ts.tv_sec = int( value )
+    ts.tv_nsec = int(( value - int( value )) * 1e9 )
+
+
+
+#=========================================================================================
+class TimerFD:
+    
+    #----------------------------------------------------------------------------
+    def __init__( self, clock_id = CLOCK_MONOTONIC ):
+        
+        self.clock_id = clock_id
+        self.spec = itimerspec()
+        
+        self.fd = libc.timerfd_create( clock_id, TFD_NONBLOCK | TFD_CLOEXEC )
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError( err, os.strerror( err ))
+    
+    
+    #----------------------------------------------------------------------------
+    def __del__( self ):
+        self.close()
+    
+    
+    #----------------------------------------------------------------------------
+    def close( self ):
+        
+        if self.fd is not None:
+            os.close( self.fd )
+            self.fd = None
+    
+    
+    #----------------------------------------------------------------------------
+    def fileno( self ):
+        return self.fd
+    
+    
+    #----------------------------------------------------------------------------
+    def set( self, value, interval = 0, flags = 0 ):
+        
+        set_timespec( self.spec.it_value, value )
+        set_timespec( self.spec.it_interval, interval )
+        
+        if libc.timerfd_settime( self.fd, flags, ctypes.byref( self.spec ), None ) != 0:
+            err = ctypes.get_errno()
+            raise OSError( err, os.strerror( err ))
+    
+    
+    #----------------------------------------------------------------------------
+    def disarm( self ):
+        self.set( 0 )
+    
+    
+    #----------------------------------------------------------------------------
+    def read( self ):
+        
+        try:
+            return EXPIRATIONS.unpack( os.read( self.fd, EXPIRATIONS.size ))[0]
+        
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return 0
+            
+            raise
@@ -1,10 +1,26 @@
+import os
+
 from interface import Display
 from interface import AT42QT1085
 from interface import GPIO
+from interface import open_gpio
+from interface import Reactor
+from interface import AlarmEngine
+from interface import backend
+from interface import metrics
+from interface.clock import monotonic
+
+KEY_SNOOZE = 2
+
+KPD_SPI_BUS = 32766
+KPD_SPI_CLIENT = 0
+KPD_CHANGE_GPIO = 83
 
-import time
-import Queue
-from threading import Thread
+# Delay before draining again a CHANGE line left asserted (seconds)
+KPD_RETRY_DELAY = 0.05
+
+# Key presses played by the simulated keypad, "<seconds>:<key>[:<duration>],..."
+SIM_KEYS_ENV = "ALARM_CLOCK_SIM_KEYS"
 
 
 
@@ -13,10 +29,27 @@ class Application:
     
     #----------------------------------------------------------------------------
     def init_keypad( self ):
-        self.keypad = AT42QT1085( 32766, 0 )
+        cache_file = "/var/cache/at42qt1085.json"
+        
+        self.gpio_kpd_ch = open_gpio( KPD_CHANGE_GPIO, GPIO.PIN_INPUT )
+        
+        if backend.is_simulated():
+            from interface import sim
+            
+            ## Keypad runs in process and drives the CHANGE line, nothing is cached ##
+            device = sim.get_spi_device( KPD_SPI_BUS, KPD_SPI_CLIENT )
+            device.attach_change( KPD_CHANGE_GPIO )
+            device.play( sim.parse_key_script( os.environ.get( SIM_KEYS_ENV, "" )))
+            
+            cache_file = None
         
-        self.gpio_kpd_ch = GPIO( 83, GPIO.PIN_INPUT )
         self.gpio_kpd_ch.set_edge( GPIO.EDGE_FALLING )
+        
+        self.metric_edge = metrics.histogram( "gpio.edge_to_handle", "gpio%d" % KPD_CHANGE_GPIO )
+        
+        self.keypad = AT42QT1085( KPD_SPI_BUS, KPD_SPI_CLIENT, shadow = True, 
+                                   cache_file = cache_file,
+                                   change = self.gpio_kpd_ch )
 
 
         ## Disable haptic events (T31) ##
@@ -65,64 +98,109 @@ class Application:
     def process_keypad( self, msg ):
         
         
-        key = msg['inst']
-        state = msg['data'][0]
+        key = msg.inst
+        state = msg.data[0]
         
-        print key, state
+        if key == KEY_SNOOZE and state and self.ringing is not None:
+            self.alarms.snooze( self.ringing.id )
+            self.ringing = None
     
     
     #----------------------------------------------------------------------------
-    def worker_keypad( self ):
+    def handle_keypad( self ):
         
-        while True:
-            if self.gpio_kpd_ch.read() == 0:
-                msg = self.keypad.read_next_message()
-                
-                if msg is None:
-                    continue
-                
-                if msg['type'] == AT42QT1085.OBJ_TYPE_KEY:
-                    self.process_keypad( msg )
-                else:
-                    print msg
-            
-            self.gpio_kpd_ch.wait_edge()
+        # Edge events of a character device line stay queued until read
+        if hasattr( self.gpio_kpd_ch, "read_events" ):
+            events = self.gpio_kpd_ch.read_events()
             
-           
-
+            ## Edge timestamps are taken on CLOCK_MONOTONIC ##
+            if events and metrics.enabled:
+                now = monotonic()
+                
+                for event in events:
+                    self.metric_edge.observe( now - event.timestamp_ns * 1e-9 )
+        
+        # A sysfs pin has no edge timestamp, timed from the reactor wake up
+        elif metrics.enabled and self.reactor.wakeup is not None:
+            self.metric_edge.observe( monotonic() - self.reactor.wakeup )
+        
+        # Reading the CHANGE line also acknowledges the edge
+        if self.gpio_kpd_ch.read() != 0:
+            return
+        
+        for msg in self.keypad.messages():
+            if msg.type == AT42QT1085.OBJ_TYPE_KEY:
+                self.process_keypad( msg )
+            else:
+                print msg
+        
+        ## Still asserted after a full drain (stuck line or a flood), try again later ##
+        if self.gpio_kpd_ch.read() == 0 and self.keypad_retry is None:
+            self.keypad_retry = self.reactor.add_timer( self.retry_keypad, KPD_RETRY_DELAY )
+    
+    
+    #----------------------------------------------------------------------------
+    def retry_keypad( self ):
+        
+        self.reactor.remove_timer( self.keypad_retry )
+        self.keypad_retry = None
+        
+        self.handle_keypad()
+    
+    
     #----------------------------------------------------------------------------
     def init_display( self ):
         self.disp = Display( 0 )
     
     
     #----------------------------------------------------------------------------
-    def run( self ):
+    def init_alarms( self ):
+        
+        self.alarms = AlarmEngine()
+        self.ringing = None
+    
+    
+    #----------------------------------------------------------------------------
+    def alarm_fired( self, rule ):
+        
+        print "Alarm", rule
         
-        self.kpd_queue = Queue.Queue()
+        self.ringing = rule
+    
+    
+    #----------------------------------------------------------------------------
+    def clock_tick( self ):
+        
+        self.alarms.check_timezone()
+        self.disp.print_time()
+    
+    
+    #----------------------------------------------------------------------------
+    def run( self ):
         
         self.init_keypad()
         self.init_display()
+        self.init_alarms()
         
         
-        t = Thread( target = self.worker_keypad )
-        t.daemon = True
-        t.start()
+        ## Single reactor for the keypad and the clock ##
+        self.reactor = Reactor()
         
+        self.reactor.add_gpio( self.gpio_kpd_ch, self.handle_keypad )
+        self.keypad_retry = None
         
+        # Refresh the clock on minute boundaries and when the time is set
+        self.reactor.add_wallclock_timer( self.clock_tick, 60 )
         
-        while True:
-            self.disp.print_time()
-            
-            try:
-                key = self.kpd_queue.get( timeout = 1 )
-                
-                print key
-                
-                
-            except Queue.Empty:
-                pass
-            
-            time.sleep(1)
+        self.alarms.attach( self.reactor, self.alarm_fired )
+        
+        # Snapshot file and socket, when configured in the environment
+        metrics.export( self.reactor )
+        
+        self.disp.print_time()
+        self.handle_keypad()
+        
+        self.reactor.run()
         
         
 
@@ -0,0 +1,92 @@
+import time
+import unittest
+
+from interface.alarm import AlarmRule
+from interface.alarm import AlarmEngine
+from interface.alarm import WORKDAYS
+
+
+
+#=========================================================================================
+class AlarmSnoozeTest( unittest.TestCase ):
+
+    #----------------------------------------------------------------------------
+    def setUp( self ):
+
+        self.now = time.time()
+        self.engine = AlarmEngine( snooze_time = 300 )
+
+
+    #----------------------------------------------------------------------------
+    def fire( self, rule ):
+
+        self.engine.add( rule, self.now )
+        when, due = self.engine.next_due()
+
+        self.assertIs( due, rule )
+        self.assertEqual( self.engine.pop_due( when ), [ rule ] )
+
+        return when
+
+
+    #----------------------------------------------------------------------------
+    def test_once_disabled_after_firing( self ):
+
+        rule = AlarmRule( 1, 7, 30 )
+        self.fire( rule )
+
+        self.assertFalse( rule.enabled )
+        self.assertIsNone( self.engine.next_due() )
+
+
+    #----------------------------------------------------------------------------
+    def test_snoozed_once_survives_recompute( self ):
+
+        rule = AlarmRule( 1, 7, 30 )
+        when = self.fire( rule )
+
+        self.engine.snooze( 1, when )
+        self.assertEqual( self.engine.next_due(), ( when + 300, rule ))
+
+        self.engine.recompute( when + 10 )
+        self.assertEqual( self.engine.next_due(), ( when + 300, rule ))
+
+        # Rings once more, then it is gone
+        self.assertEqual( self.engine.pop_due( when + 300 ), [ rule ] )
+        self.assertIsNone( self.engine.next_due() )
+
+        self.engine.recompute( when + 310 )
+        self.assertIsNone( self.engine.next_due() )
+
+
+    #----------------------------------------------------------------------------
+    def test_dismiss_once( self ):
+
+        rule = AlarmRule( 1, 7, 30 )
+        when = self.fire( rule )
+
+        self.engine.snooze( 1, when )
+        self.engine.dismiss( 1, when + 10 )
+
+        self.assertIsNone( self.engine.next_due() )
+
+
+    #----------------------------------------------------------------------------
+    def test_snoozed_repeating( self ):
+
+        rule = AlarmRule( 1, 7, 30, days = WORKDAYS )
+        when = self.fire( rule )
+
+        self.engine.snooze( 1, when )
+        self.engine.recompute( when + 10 )
+        self.assertEqual( self.engine.next_due(), ( when + 300, rule ))
+
+        # Back to the next workday once dismissed
+        self.engine.dismiss( 1, when + 10 )
+        self.assertGreater( self.engine.next_due()[0], when + 300 )
+        self.assertTrue( rule.enabled )
+
+
+
+if __name__ == "__main__":
+    unittest.main()
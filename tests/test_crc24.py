@@ -0,0 +1,126 @@
+import random
+import unittest
+
+from interface.crc24 import CRC24
+from interface.crc24 import CRC24_MASK
+from interface.crc24 import CRC24_POLY
+from interface.crc24 import crc24
+
+
+# ( data, CRC24 ) computed with the original word by word AT42QT1085.crc24()
+KNOWN_VECTORS = (
+    ( bytearray(), 0x000000 ),
+    ( bytearray( b"\x01" ), 0x000001 ),
+    ( bytearray( b"123456789" ), 0x022A0B ),
+    ( bytearray( range( 37 )), 0xF0C5E7 ),
+    ( bytearray( range( 256 )), 0xEF3F62 ),
+)
+
+
+
+#----------------------------------------------------------------------------
+def crc24_reference( block ):
+
+    # Original AT42QT1085.crc24(), one little endian word at a time
+    crc = 0x00
+
+    for i in range( 0, len( block ), 2 ):
+
+        if i + 1 < len( block ):
+            data_word = ( block[ i + 1 ] << 8 ) | block[ i ]
+        else:
+            data_word = block[ i ]
+
+        crc = (( crc << 1 ) ^ data_word )
+
+        if crc & 0x1000000:
+            crc ^= CRC24_POLY
+
+        crc &= CRC24_MASK
+
+    return crc
+
+
+
+#=========================================================================================
+class CRC24Test( unittest.TestCase ):
+
+    #----------------------------------------------------------------------------
+    def test_known_vectors( self ):
+
+        for data, expected in KNOWN_VECTORS:
+            self.assertEqual( crc24( data ), expected, "%d bytes" % len( data ))
+
+
+    #----------------------------------------------------------------------------
+    def test_random_against_reference( self ):
+
+        # Lengths around the 16 bytes blocks of the table path
+        rand = random.Random( 24 )
+
+        for length in range( 0, 300 ) + [ 4096 ]:
+            data = bytearray( rand.getrandbits( 8 ) for i in range( length ))
+
+            self.assertEqual( crc24( data ), crc24_reference( data ), "%d bytes" % length )
+
+
+    #----------------------------------------------------------------------------
+    def test_random_chunks( self ):
+
+        rand = random.Random( 42 )
+
+        for length in range( 0, 300, 7 ):
+            data = bytearray( rand.getrandbits( 8 ) for i in range( length ))
+
+            crc = CRC24()
+            offset = 0
+
+            while offset < length:
+                chunk = rand.randrange( 40 )
+                crc.update( data[ offset : offset + chunk ] )
+                offset += chunk
+
+            self.assertEqual( crc.digest(), crc24_reference( data ), "%d bytes" % length )
+
+
+    #----------------------------------------------------------------------------
+    def test_input_types( self ):
+
+        data, expected = KNOWN_VECTORS[2]
+
+        self.assertEqual( crc24( bytes( data )), expected )
+        self.assertEqual( crc24( list( data )), expected )
+
+
+    #----------------------------------------------------------------------------
+    def test_incremental( self ):
+
+        # Chunks of every size, words are split across updates on odd sizes
+        for data, expected in KNOWN_VECTORS:
+            for chunk in range( 1, 8 ):
+                crc = CRC24()
+
+                for offset in range( 0, len( data ), chunk ):
+                    crc.update( data[ offset : offset + chunk ] )
+
+                self.assertEqual( crc.digest(), expected, "%d bytes by %d" % ( len( data ), chunk ))
+
+
+    #----------------------------------------------------------------------------
+    def test_copy( self ):
+
+        data, expected = KNOWN_VECTORS[3]
+
+        crc = CRC24( data[ :11 ] )
+        other = crc.copy()
+
+        crc.update( data[ 11: ] )
+        other.update( data[ 11: ] )
+
+        self.assertEqual( crc.digest(), expected )
+        self.assertEqual( other.digest(), expected )
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+import unittest
+
+from interface.gpiochip import GPIOLine
+from interface.gpiochip import FakeGPIOChip
+
+
+# PIOC19, offset 19 of the third chip
+KERNEL_ID = 83
+OFFSET = 19
+
+
+
+#=========================================================================================
+class FakeGPIOChipTest( unittest.TestCase ):
+
+    #----------------------------------------------------------------------------
+    def setUp( self ):
+
+        self.chip = FakeGPIOChip()
+        self.line = GPIOLine( KERNEL_ID, GPIOLine.PIN_INPUT, chip = self.chip )
+
+
+    #----------------------------------------------------------------------------
+    def tearDown( self ):
+        self.line.close()
+
+
+    #----------------------------------------------------------------------------
+    def toggle( self, count ):
+
+        for i in range( count ):
+            self.chip.set_input( OFFSET, 1, timestamp_ns = 1000 * ( 2 * i + 1 ))
+            self.chip.set_input( OFFSET, 0, timestamp_ns = 1000 * ( 2 * i + 2 ))
+
+
+    #----------------------------------------------------------------------------
+    def test_no_edge( self ):
+
+        self.toggle( 2 )
+
+        self.assertEqual( self.line.read_events(), [] )
+        self.assertEqual( self.line.wait_edge( 0 ), [] )
+
+
+    #----------------------------------------------------------------------------
+    def test_falling( self ):
+
+        self.line.set_edge( GPIOLine.EDGE_FALLING )
+        self.toggle( 2 )
+
+        events = self.line.read_events()
+
+        self.assertEqual([ event.rising for event in events ], [ False, False ])
+        self.assertEqual([ event.timestamp_ns for event in events ], [ 2000, 4000 ])
+        self.assertEqual([ event.line_seqno for event in events ], [ 1, 2 ])
+        self.assertEqual( self.line.read_events(), [] )
+
+
+    #----------------------------------------------------------------------------
+    def test_rising( self ):
+
+        self.line.set_edge( GPIOLine.EDGE_RISING )
+        self.toggle( 2 )
+
+        events = self.line.read_events()
+
+        self.assertEqual([ event.rising for event in events ], [ True, True ])
+        self.assertEqual([ event.timestamp_ns for event in events ], [ 1000, 3000 ])
+
+
+    #----------------------------------------------------------------------------
+    def test_both( self ):
+
+        self.line.set_edge( GPIOLine.EDGE_BOTH )
+        self.toggle( 3 )
+
+        events = self.line.wait_edge( 0 )
+
+        self.assertEqual([ event.rising for event in events ], [ True, False ] * 3 )
+        self.assertEqual([ event.offset for event in events ], [ OFFSET ] * 6 )
+        self.assertEqual([ event.seqno for event in events ], range( 1, 7 ))
+
+
+    #----------------------------------------------------------------------------
+    def test_unchanged_value( self ):
+
+        self.line.set_edge( GPIOLine.EDGE_BOTH )
+
+        self.chip.set_input( OFFSET, 0 )
+        self.chip.set_input( OFFSET, 1 )
+        self.chip.set_input( OFFSET, 1 )
+
+        self.assertEqual( len( self.line.read_events() ), 1 )
+        self.assertEqual( self.line.read(), 1 )
+
+
+    #----------------------------------------------------------------------------
+    def test_read_batches( self ):
+
+        self.line.set_edge( GPIOLine.EDGE_BOTH )
+        self.toggle( 10 )
+
+        self.assertEqual( len( self.line.read_events( 16 )), 16 )
+        self.assertEqual( len( self.line.read_events( 16 )), 4 )
+
+
+    #----------------------------------------------------------------------------
+    def test_output( self ):
+
+        self.assertRaises( IOError, self.line.write, 1 )
+
+        self.line.set_direction( GPIOLine.PIN_HIGH )
+        self.assertEqual( self.line.read(), 1 )
+
+        self.line.low()
+        self.assertEqual( self.chip.values[ OFFSET ], 0 )
+
+
+    #----------------------------------------------------------------------------
+    def test_busy_line( self ):
+        self.assertRaises( IOError, GPIOLine, KERNEL_ID, GPIOLine.PIN_INPUT, chip = self.chip )
+
+
+    #----------------------------------------------------------------------------
+    def test_invalid_line( self ):
+
+        self.assertRaises( ValueError, GPIOLine, 160, GPIOLine.PIN_INPUT, chip = self.chip )
+        self.assertRaises( ValueError, GPIOLine, -1, GPIOLine.PIN_INPUT, chip = self.chip )
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+import unittest
+
+from interface import scheduler
+from interface.i2c import I2CBus
+from interface.sim import I2CBusSim
+from interface.scheduler import Future
+from interface.scheduler import BusScheduler
+from interface.scheduler import PRIORITY_KEY
+from interface.scheduler import PRIORITY_FADE
+from interface.pca9634 import REG_PWM0
+from interface.pca9634 import REG_PWM1
+
+
+ADDR_CHIP_1 = 0x68
+ADDR_CHIP_2 = 0x69
+ADDR_ALLCALL = 0x70
+
+# No chip answers it
+ADDR_MISSING = 0x40
+
+
+
+#=========================================================================================
+class BusSchedulerTest( unittest.TestCase ):
+
+    #----------------------------------------------------------------------------
+    def setUp( self ):
+
+        self.sim = I2CBusSim(( ADDR_CHIP_1, ADDR_CHIP_2 ))
+
+        chips = [ ADDR_CHIP_1, ADDR_CHIP_2 ]
+        aliases = { ADDR_CHIP_1: [ ADDR_ALLCALL ], ADDR_CHIP_2: [ ADDR_ALLCALL ], ADDR_ALLCALL: chips }
+
+        # Not started, the queue is sent by drain() from the test thread
+        self.scheduler = BusScheduler( I2CBus( 0, self.sim ), aliases, start = False )
+        self.scheduler.running = True
+
+        self.max_batch_regs = scheduler.MAX_BATCH_REGS
+
+
+    #----------------------------------------------------------------------------
+    def tearDown( self ):
+        scheduler.MAX_BATCH_REGS = self.max_batch_regs
+
+
+    #----------------------------------------------------------------------------
+    def drain( self ):
+
+        transactions = 0
+
+        while self.scheduler.heap:
+            commands = self.scheduler.next_commands()
+
+            if commands:
+                self.scheduler.send( commands )
+                transactions += 1
+
+        return transactions
+
+
+    #----------------------------------------------------------------------------
+    def reg( self, addr, reg ):
+        return self.sim.chips[ addr ].regs[ reg ]
+
+
+    #----------------------------------------------------------------------------
+    def test_coalesce( self ):
+
+        first = self.scheduler.write_byte_data( ADDR_CHIP_1, REG_PWM0, 0x10 )
+        second = self.scheduler.write_byte_data( ADDR_CHIP_1, REG_PWM0, 0x20 )
+
+        self.assertEqual( self.drain(), 1 )
+
+        self.assertEqual( self.sim.messages, 1 )
+        self.assertEqual( self.scheduler.coalesced, 1 )
+        self.assertEqual( self.reg( ADDR_CHIP_1, REG_PWM0 ), 0x20 )
+
+        self.assertTrue( first.done() and second.done() )
+        self.assertEqual( self.scheduler.pending, {} )
+
+
+    #----------------------------------------------------------------------------
+    def test_block_write( self ):
+
+        with self.scheduler.batch():
+            self.scheduler.write_byte_data( ADDR_CHIP_1, REG_PWM0, 0x01 )
+            self.scheduler.write_byte_data( ADDR_CHIP_1, REG_PWM1, 0x02 )
+
+        self.drain()
+
+        # Consecutive registers are joined in a single auto-increment write
+        self.assertEqual( self.sim.messages, 1 )
+        self.assertEqual( self.reg( ADDR_CHIP_1, REG_PWM0 ), 0x01 )
+        self.assertEqual( self.reg( ADDR_CHIP_1, REG_PWM1 ), 0x02 )
+
+
+    #----------------------------------------------------------------------------
+    def test_priority( self ):
+
+        scheduler.MAX_BATCH_REGS = 1
+
+        with self.scheduler.priority( PRIORITY_FADE ):
+            self.scheduler.write_byte_data( ADDR_CHIP_1, REG_PWM0, 0x10 )
+
+        with self.scheduler.priority( PRIORITY_KEY ):
+            self.scheduler.write_byte_data( ADDR_CHIP_2, REG_PWM0, 0x20 )
+
+        commands = self.scheduler.next_commands()
+
+        self.assertEqual([ command[ scheduler.CMD_ADDR ] for command in commands ], [ ADDR_CHIP_2 ])
+
+
+    #----------------------------------------------------------------------------
+    def test_stale_entries( self ):
+
+        # Raising the priority of a queued write pushes a second heap entry
+        with self.scheduler.priority( PRIORITY_FADE ):
+            self.scheduler.write_byte_data( ADDR_CHIP_1, REG_PWM0, 0x10 )
+
+        with self.scheduler.priority( PRIORITY_KEY ):
+            self.scheduler.write_byte_data( ADDR_CHIP_1, REG_PWM0, 0x20 )
+
+        self.assertEqual( len( self.scheduler.heap ), 2 )
+
+        commands = self.scheduler.next_commands()
+
+        self.assertEqual( len( commands ), 1 )
+        self.assertEqual( commands[0][ scheduler.CMD_VALUE ], 0x20 )
+        self.assertEqual( commands[0][ scheduler.CMD_PRIORITY ], PRIORITY_KEY )
+
+        self.assertEqual( self.scheduler.next_commands(), [] )
+        self.assertEqual( self.scheduler.heap, [] )
+
+
+    #----------------------------------------------------------------------------
+    def test_alias_order( self ):
+
+        # One register per transaction, the order of the transactions decides
+        scheduler.MAX_BATCH_REGS = 1
+
+        with self.scheduler.priority( PRIORITY_FADE ):
+            self.scheduler.write_byte_data( ADDR_ALLCALL, REG_PWM0, 0x10 )
+
+        with self.scheduler.priority( PRIORITY_KEY ):
+            self.scheduler.write_byte_data( ADDR_CHIP_1, REG_PWM0, 0x20 )
+
+        self.assertEqual( self.drain(), 2 )
+
+        # The group write is promoted and sent first, the later write wins
+        self.assertEqual( self.reg( ADDR_CHIP_1, REG_PWM0 ), 0x20 )
+        self.assertEqual( self.reg( ADDR_CHIP_2, REG_PWM0 ), 0x10 )
+
+
+    #----------------------------------------------------------------------------
+    def test_error( self ):
+
+        future = self.scheduler.write_byte_data( ADDR_MISSING, REG_PWM0, 0x10 )
+        self.drain()
+
+        self.assertRaises( IOError, future.result, 0 )
+        self.assertEqual( self.scheduler.errors, 1 )
+
+
+
+#=========================================================================================
+class FutureTest( unittest.TestCase ):
+
+    #----------------------------------------------------------------------------
+    def test_callback( self ):
+
+        done = []
+
+        future = Future()
+        future.add_done_callback( done.append )
+        future.set_result( 1 )
+
+        # Called at once when already done
+        future.add_done_callback( done.append )
+
+        self.assertEqual( done, [ future, future ] )
+        self.assertEqual( future.result( 0 ), 1 )
+
+
+    #----------------------------------------------------------------------------
+    def test_finish_once( self ):
+
+        done = []
+        error = IOError( "failed" )
+
+        future = Future()
+        future.parts = 2
+        future.add_done_callback( done.append )
+
+        future.set_exception( error )
+        future.part_done()
+        future.part_done()
+
+        self.assertEqual( len( done ), 1 )
+        self.assertRaises( IOError, future.result, 0 )
+
+
+
+if __name__ == "__main__":
+    unittest.main()